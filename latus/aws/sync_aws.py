@@ -20,22 +20,23 @@ import latus.aws
 from latus.aws.table_events import TableEvents
 from latus.aws.table_node import TableNodes
 import latus.walker
+import latus.event_filter
+import latus.coalesce
+import latus.stat_index
 import latus.hash
+import latus.blob_store
+import latus.blob_cache
+import latus.blob_gc
 import latus.miv
 from latus import nodedb
 import latus.usage
 import latus.crypto
+import latus.pipeline
 from latus import logger
 from latus import preferences
 from latus import util
 from latus import activity_timer
-from latus.const import TIME_OUT, LatusFileSystemEvent, DetectionSource, ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION, FILTER_TIME_OUT
-
-
-latus_to_watchdog_events = {latus.const.LatusFileSystemEvent.moved: watchdog.events.EVENT_TYPE_MOVED,
-                            latus.const.LatusFileSystemEvent.deleted: watchdog.events.EVENT_TYPE_DELETED,
-                            latus.const.LatusFileSystemEvent.created: watchdog.events.EVENT_TYPE_CREATED,
-                            latus.const.LatusFileSystemEvent.modified: watchdog.events.EVENT_TYPE_MODIFIED}
+from latus.const import TIME_OUT, LatusFileSystemEvent, DetectionSource, ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION
 
 
 def activity_trigger(func):
@@ -54,30 +55,22 @@ def activity_trigger(func):
 class EventFilter(threading.Thread):
     def __init__(self):
         super().__init__()
-        self.filter_list = []
+        # filter events aren't consumed - they filter all the watchdog events for their path until they time out
+        self.filter_events = latus.event_filter.FilterStore(consume=False)
         self.exit_event = threading.Event()
 
     def run(self):
         while not self.exit_event.is_set():
-            events_to_remove = []
-            for filter_event in self.filter_list:
-                if filter_event['countdown'] > 0:
-                    logger.log.info('counting down filter event %s' % str(filter_event))
-                    filter_event['countdown'] -= 1
-                else:
-                    events_to_remove.append(filter_event)
-            for event_to_remove in events_to_remove:
-                if event_to_remove['seen_count'] != 1:
-                    logger.log.warn('seen_count is not 1 : %s' % (event_to_remove))
-                self.filter_list.remove(event_to_remove)
-                logger.log.info('removing filter event %s' % str(event_to_remove))
+            for expired_event in self.filter_events.expire():
+                if expired_event.seen_count != 1:
+                    logger.log.warn('seen_count is not 1 : %s' % str(expired_event))
+                logger.log.info('removing filter event %s' % str(expired_event))
             self.exit_event.wait(1)
 
     # todo: need src and dest for moves - right now we just use the dest
     def add_event(self, path, event_type):
-        event = {'path': path, 'countdown': FILTER_TIME_OUT, 'seen_count': 0, 'event_type': event_type}
-        logger.log.info('filter add_event : %s' % str(event))
-        self.filter_list.append(event)
+        filter_event = self.filter_events.add(path, event_type)
+        logger.log.info('filter add_event : %s' % str(filter_event))
 
     def test_event(self, watchdog_event):
         # test if this path should be filtered out
@@ -85,23 +78,19 @@ class EventFilter(threading.Thread):
             # always filter out directory events
             logger.log.info('filtering out watchdog directory event : %s' % str(watchdog_event))
             return True
-        found_one = False
-        for filter_event in self.filter_list:
-            if watchdog_event.src_path == filter_event['path']:
-                filter_event['seen_count'] += 1  # assume it's the most senior entry
-                found_one = True
-                if latus_to_watchdog_events[filter_event['event_type']] != watchdog_event.event_type:
-                    logger.log.warn('event type mismatch : expected %s, got %s' % (filter_event, watchdog_event))
-                break
-        if found_one:
-            logger.log.info('event filtered : %s' % watchdog_event)
-        return found_one
+        latus_event = latus.event_filter.watchdog_to_latus_events.get(watchdog_event.event_type)
+        filter_event = self.filter_events.test(watchdog_event.src_path, latus_event)
+        if filter_event is None:
+            return False
+        if filter_event.event != latus_event:
+            logger.log.warn('event type mismatch : expected %s, got %s' % (filter_event, watchdog_event))
+        logger.log.info('event filtered : %s' % watchdog_event)
+        return True
 
     def request_exit(self):
         self.exit_event.set()
-        if len(self.filter_list) > 0:
-            for filter_event in self.filter_list:
-                logger.log.info('leftover filter event : %s' % str(filter_event))
+        for filter_event in self.filter_events.get_all():
+            logger.log.info('leftover filter event : %s' % str(filter_event))
 
 g_event_filter = EventFilter()
 g_event_filter.start()
@@ -139,9 +128,17 @@ class Sync(watchdog.events.FileSystemEventHandler):
         util.make_dir(self.latus_folder)
 
         self.observer = watchdog.observers.Observer()
-        self.observer.schedule(self, self.latus_folder, recursive=True)
+        # merge bursts of events for a file before they get to our on_* handlers
+        self.coalescer = latus.coalesce.EventCoalescer(self, self.active_timer)
+        self.observer.schedule(self.coalescer, self.latus_folder, recursive=True)
+
+        node_db = latus.nodedb.get_node_db(self.app_data_folder, pref.get_node_id(), True)  # make DB if doesn't already exist
 
-        latus.nodedb.NodeDB(self.app_data_folder, pref.get_node_id(), True)  # make DB if doesn't already exist
+        latus.miv.set_mode(pref.get_miv_mode())
+        latus.miv.init_from_watermarks(pref.get_node_id(), node_db.get_watermarks())
+
+        self.stat_index = latus.stat_index.StatIndex(self.app_data_folder)
+        latus.hash.init_cache(self.app_data_folder)
 
         self.fs_scan(DetectionSource.initial_scan)
 
@@ -150,6 +147,7 @@ class Sync(watchdog.events.FileSystemEventHandler):
         else:
             poll_period = 10*60
         self.aws_db_sync = AWSDBSync(self.app_data_folder, poll_period)
+        self.blob_gc = latus.blob_gc.BlobGC(self.app_data_folder)
 
     def get_type(self):
         return 'local'
@@ -162,8 +160,10 @@ class Sync(watchdog.events.FileSystemEventHandler):
     def start(self):
         if self.usage_uploader:
             self.usage_uploader.start()
+        self.coalescer.start()
         self.observer.start()
         self.aws_db_sync.start()
+        self.blob_gc.start()
 
     @activity_trigger
     def request_exit(self, time_out=TIME_OUT):
@@ -173,15 +173,21 @@ class Sync(watchdog.events.FileSystemEventHandler):
         self.observer.join(time_out)
         if self.observer.is_alive():
             logger.log.warn('%s - %s - request_exit failed to stop observer' % (pref.get_node_id(), self.get_type()))
+        if not self.coalescer.request_exit(time_out):
+            logger.log.warn('%s - %s - request_exit failed to stop coalescer' % (pref.get_node_id(), self.get_type()))
         self.active_timer.reset()
         self.aws_db_sync.request_exit()
+        if not self.blob_gc.request_exit(time_out):
+            logger.log.warn('%s - %s - request_exit failed to stop blob gc' % (pref.get_node_id(), self.get_type()))
+        latus.hash.flush_cache()
         logger.log.info('%s - %s - request_exit end' % (pref.get_node_id(), self.get_type()))
-        return self.observer.is_alive() or self.aws_db_sync.is_alive()
+        return self.observer.is_alive() or self.coalescer.is_alive() or self.aws_db_sync.is_alive() or self.blob_gc.is_alive()
 
     @activity_trigger
     def start_observer(self):
         pref = latus.preferences.Preferences(self.app_data_folder)
         logger.log.info('%s : starting observer : %s' % (pref.get_node_id(), self.latus_folder))
+        self.coalescer.start()
         self.observer.start()
 
     @activity_trigger
@@ -196,7 +202,7 @@ class Sync(watchdog.events.FileSystemEventHandler):
     def on_deleted(self, watchdog_event):
         latus.logger.log.info('%s : local on_deleted event : %s' % (self.get_node_id(), str(watchdog_event)))
         if not g_event_filter.test_event(watchdog_event):
-            # todo: remove from cache
+            # the file's blob stays in the cache - latus.blob_gc removes it once nothing refers to it
             self._write_db(watchdog_event.src_path, None, LatusFileSystemEvent.deleted, DetectionSource.watchdog, None, watchdog_event.is_directory)
 
     @activity_trigger
@@ -225,32 +231,40 @@ class Sync(watchdog.events.FileSystemEventHandler):
             self._write_db(watchdog_event.dest_path, src_path, LatusFileSystemEvent.moved, DetectionSource.watchdog, file_hash, watchdog_event.is_directory)
 
     # todo: encrypt the hash?
-    def _write_db(self, full_path, src_path, filesystem_event_type, detection_source, file_hash, is_dir):
+    def _write_db(self, full_path, src_path, filesystem_event_type, detection_source, file_hash, is_dir, node_db_batch=None):
         pref = latus.preferences.Preferences(self.app_data_folder)
         latus_path = full_path.replace(pref.get_latus_folder() + os.sep, '')
         this_node_id = pref.get_node_id()
-        node_db = nodedb.NodeDB(self.app_data_folder, this_node_id)
+        node_db = nodedb.get_node_db(self.app_data_folder, this_node_id)
+        if node_db_batch is None:
+            node_db_writer = node_db
+        else:
+            node_db_writer = node_db_batch
         if os.path.exists(full_path):
             mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(full_path))
             size = os.path.getsize(full_path)
         else:
             mtime = None
             size = None
-        mivui = latus.miv.get_mivui(this_node_id)
-
-        # check that file actually changed
-        logger.log.info("_write_db : %s" % str([this_node_id, mivui, filesystem_event_type, full_path, detection_source, size, file_hash, mtime]))
-        most_recent_hash = node_db.get_most_recent_hash(latus_path)
-        if most_recent_hash != file_hash:
-            partial_path = os.path.relpath(full_path, pref.get_latus_folder())
-            event_table = TableEvents()
-            aws_success = event_table.add(mivui, this_node_id, int(filesystem_event_type), int(detection_source), latus_path, src_path, size, file_hash, mtime)
-            node_db.update(mivui, this_node_id, int(filesystem_event_type), int(detection_source), partial_path, src_path, size, file_hash, mtime, not aws_success)
-
-    def _fill_cache(self, full_path):
+        # Other nodes read our events from the event table by high-water mark, so allocate the mivui and publish it
+        # under the write lock - otherwise a higher mivui from another thread could get there first (see NodeDB.write_lock).
+        with node_db.write_lock:
+            mivui = latus.miv.get_mivui(this_node_id)
+
+            # check that file actually changed
+            logger.log.info("_write_db : %s" % str([this_node_id, mivui, filesystem_event_type, full_path, detection_source, size, file_hash, mtime]))
+            most_recent_hash = node_db.get_most_recent_hash(latus_path)
+            if most_recent_hash != file_hash:
+                partial_path = os.path.relpath(full_path, pref.get_latus_folder())
+                event_table = TableEvents()
+                aws_success = event_table.add(mivui, this_node_id, int(filesystem_event_type), int(detection_source), latus_path, src_path, size, file_hash, mtime)
+                node_db_writer.update(mivui, this_node_id, int(filesystem_event_type), int(detection_source), partial_path, src_path, size, file_hash, mtime, not aws_success)
+
+    def _fill_cache(self, full_path, hash=None, upload=True):
         pref = latus.preferences.Preferences(self.app_data_folder)
         node_id = pref.get_node_id()
-        cache_folder = pref.get_cache_folder()
+        blob_store = latus.blob_store.get_blob_store(pref.get_cache_folder())
+        blob_cache = latus.blob_cache.get_blob_cache(pref.get_cache_folder(), pref.get_cache_max_bytes())
 
         # Currently for AWS we encrypt everything - eventually we'll want to make this a per-folder option
         # that is in a new AWS preferences table.  The csp way stored the folder preferences in the node_db,
@@ -258,7 +272,8 @@ class Sync(watchdog.events.FileSystemEventHandler):
         # todo: move per folder preferences to a new AWS table (not node_db)
         encrypt = True
 
-        hash, _ = latus.hash.calc_sha512(full_path, pref.get_crypto_key())
+        if hash is None:
+            hash, _ = latus.hash.calc_sha512(full_path, pref.get_crypto_key())
         if encrypt:
 
             crypto_key = pref.get_crypto_key()
@@ -269,37 +284,71 @@ class Sync(watchdog.events.FileSystemEventHandler):
                 latus.logger.log.warning('could not get hash for %s' % full_path)
             else:
 
-                # write to local cache
-                os.makedirs(cache_folder, exist_ok=True)
-                cloud_fernet_file = os.path.join(cache_folder, hash + ENCRYPTION_EXTENSION)
+                # write to local cache (pinned until it's uploaded - see _upload())
                 crypto = latus.crypto.Crypto(crypto_key, node_id)
-                if not os.path.exists(cloud_fernet_file):
+                blob_cache.pin(hash, ENCRYPTION_EXTENSION)
+                if blob_cache.get(hash, ENCRYPTION_EXTENSION) is None:  # a hit marks the blob as just used
+                    cloud_fernet_file = blob_store.make_path(hash, ENCRYPTION_EXTENSION)
                     latus.logger.log.info('%s : file_write , %s' % (node_id, cloud_fernet_file))
                     crypto.encrypt_file(full_path, os.path.abspath(cloud_fernet_file))
+                    blob_cache.add(hash, ENCRYPTION_EXTENSION)
 
                 # upload to S3 (if it's not there already)
-                self.s3.upload_file(cloud_fernet_file, hash)
+                if upload:
+                    self._upload(hash)
 
         else:
             raise NotImplemented  # need the new AWS folder preferences table mentioned above
         return hash
 
+    def _upload(self, hash):
+        pref = latus.preferences.Preferences(self.app_data_folder)
+        blob_store = latus.blob_store.get_blob_store(pref.get_cache_folder())
+        self.s3.upload_file(blob_store.find(hash, ENCRYPTION_EXTENSION) or blob_store.get_path(hash, ENCRYPTION_EXTENSION), hash)
+        # S3 has it now, so it can be evicted (if the upload failed it stays pinned)
+        latus.blob_cache.get_blob_cache(pref.get_cache_folder(), pref.get_cache_max_bytes()).unpin(hash, ENCRYPTION_EXTENSION)
+
+    def _hash_and_fill_cache(self, full_path, most_recent_hash):
+        """
+        hash a file and, if it has changed, encrypt it into the local cache (runs on the fs_scan worker threads)
+        """
+        pref = latus.preferences.Preferences(self.app_data_folder)
+        local_hash, _ = latus.hash.calc_sha512(full_path, pref.get_crypto_key())
+        if local_hash and local_hash != most_recent_hash:
+            self._fill_cache(full_path, local_hash, upload=False)
+        return local_hash
+
     @activity_trigger
     def fs_scan(self, detection_source):
         latus.logger.log.info('fs_scan start')
         pref = latus.preferences.Preferences(self.app_data_folder)
         this_node_id = pref.get_node_id()
-        node_db = latus.nodedb.NodeDB(self.app_data_folder, this_node_id)
+        node_db = latus.nodedb.get_node_db(self.app_data_folder, this_node_id)
         local_walker = latus.walker.Walker(pref.get_latus_folder())
-        for partial_path in local_walker:
-            logger.log.info('partial_path : %s' % partial_path)
-            local_full_path = local_walker.full_path(partial_path)
-            logger.log.info('local_full_path : %s' % local_full_path)
-            if os.path.exists(local_full_path):
-                local_hash, _ = latus.hash.calc_sha512(local_full_path, pref.get_crypto_key())
+        # write the stat index only after the DB batch has been written (context managers exit in reverse order)
+        with self.stat_index.scan() as stat_scan, node_db.batch() as node_db_batch:
+
+            def changed_files():
+                # the walk and the DB reads stay on this thread
+                for partial_path in local_walker:
+                    logger.log.info('partial_path : %s' % partial_path)
+                    local_full_path = local_walker.full_path(partial_path)
+                    logger.log.info('local_full_path : %s' % local_full_path)
+                    signature = latus.stat_index.get_stat_signature(local_full_path)
+                    if signature is None:
+                        logger.log.info('not found : %s' % local_full_path)
+                        continue
+                    most_recent_hash = node_db.get_most_recent_hash(partial_path)
+                    if stat_scan.unchanged(partial_path, signature) and most_recent_hash is not None:
+                        logger.log.debug('unchanged : %s' % local_full_path)
+                        continue
+                    yield partial_path, local_full_path, signature, most_recent_hash
+
+            # hash and encrypt on the worker threads, but upload and write the DB on this thread (in walk order)
+            scan_results = latus.pipeline.ordered_map(lambda item: self._hash_and_fill_cache(item[1], item[3]), changed_files())
+            for (partial_path, local_full_path, signature, most_recent_hash), local_hash in scan_results:
                 if local_hash:
                     logger.log.info('local_hash : %s' % local_hash)
-                    most_recent_hash = node_db.get_most_recent_hash(partial_path)
                     if most_recent_hash is None:
                         file_system_event = LatusFileSystemEvent.created
                     else:
@@ -308,17 +357,14 @@ class Sync(watchdog.events.FileSystemEventHandler):
                     if local_hash != most_recent_hash:
                         mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(local_full_path))
                         size = os.path.getsize(local_full_path)
-                        logger.log.info('getting mivui')
-                        mivui = latus.miv.get_mivui(this_node_id)
-                        logger.log.info('sync : %s' % [this_node_id, file_system_event, mivui, partial_path, detection_source, size, local_hash, mtime])
-                        self._fill_cache(local_full_path)
-                        self._write_db(local_full_path, None, file_system_event, detection_source, local_hash, os.path.isdir(local_full_path))
+                        logger.log.info('sync : %s' % [this_node_id, file_system_event, partial_path, detection_source, size, local_hash, mtime])
+                        self._upload(local_hash)
+                        self._write_db(local_full_path, None, file_system_event, detection_source, local_hash, os.path.isdir(local_full_path), node_db_batch)
                     else:
                         logger.log.warn('hashes : %s, %s' % (local_hash, most_recent_hash))
+                    stat_scan.update(partial_path, signature)
                 else:
                     latus.logger.log.warn('%s : could not calculate hash for %s' % (this_node_id, local_full_path))
-            else:
-                logger.log.info('not found : %s' % local_full_path)
         latus.logger.log.info('fs_scan end')
 
 
@@ -341,12 +387,16 @@ class AWSDBSync(threading.Thread):
         while not self.exit_event.is_set():
             self._pull_down_new_db_entries(pref)
             self._sync(pref)
+            nodedb.get_node_db(self.app_data_folder, pref.get_node_id(), True).maybe_compact()
+            blob_cache = latus.blob_cache.get_blob_cache(pref.get_cache_folder(), pref.get_cache_max_bytes())
+            blob_cache.evict()  # in case the budget has been lowered
+            logger.log.info('blob cache : %s' % str(blob_cache.get_stats()))
             self.exit_event.wait(timeout=self.poll_period_sec)
 
     def _pull_down_new_db_entries(self, pref):
 
         this_node_id = pref.get_node_id()
-        node_db = nodedb.NodeDB(self.app_data_folder, this_node_id)
+        node_db = nodedb.get_node_db(self.app_data_folder, this_node_id)
         event_table_resource = self.event_table.get_table_resource()
 
         for node_id in self.node_table.get_all_nodes():
@@ -361,6 +411,7 @@ class AWSDBSync(threading.Thread):
                 query_response = event_table_resource.query(
                     KeyConditionExpression=conditions.Key('originator').eq(node_id) & conditions.Key('mivui').gt(most_recent_local_mivui)
                 )
+                new_infos = []
                 for q in query_response['Items']:
                     logger.log.info('query_response : %s' % str(q))
                     mtime = q['mtime']
@@ -370,19 +421,22 @@ class AWSDBSync(threading.Thread):
                     if size:
                         size = int(size)
                     logger.log.info('new_db_entry : %s' % str(q))
-                    node_db.update(int(q['mivui']), q['originator'], int(q['event_type']), int(q['detection']), q['file_path'],
-                                   q['src_path'], size, q['file_hash'], mtime, False)
+                    new_infos.append({'mivui': int(q['mivui']), 'originator': q['originator'], 'event_type': int(q['event_type']),
+                                      'detection': int(q['detection']), 'file_path': q['file_path'], 'src_path': q['src_path'],
+                                      'size': size, 'file_hash': q['file_hash'], 'mtime': mtime})
+                if len(new_infos) > 0:
+                    latus.miv.observe(max(info['mivui'] for info in new_infos))
+                    node_db.update_many(new_infos, False)
 
     def _sync(self, pref):
         this_node_id = pref.get_node_id()
-        node_db = nodedb.NodeDB(self.app_data_folder, this_node_id)
-        for path in node_db.get_paths():
-            self._one_sync(path, pref)
+        node_db = nodedb.get_node_db(self.app_data_folder, this_node_id)
+        for most_recent in node_db.iter_latest():
+            self._one_sync(most_recent, pref)
 
-    def _one_sync(self, path, pref):
+    def _one_sync(self, most_recent, pref):
         this_node_id = pref.get_node_id()
-        node_db = nodedb.NodeDB(self.app_data_folder, this_node_id)
-        most_recent = node_db.get_most_recent_entry_for_path(path)
+        node_db = nodedb.get_node_db(self.app_data_folder, this_node_id)
         if most_recent['originator'] == this_node_id:
             # this node created the most recent state, so nothing to do
             return
@@ -404,23 +458,35 @@ class AWSDBSync(threading.Thread):
                 crypto = latus.crypto.Crypto(crypto_key, pref.get_node_id())
 
                 if hash_value:
-                    cache_fernet_file = os.path.join(pref.get_cache_folder(), hash_value + ENCRYPTION_EXTENSION)
-                    self.s3.download_file(cache_fernet_file, hash_value)
-                    latus.logger.log.info('originator=%s, event_type=%s, detection=%s, file_path="%s" - propagating to "%s" (file_hash=%s)' %
-                                          (most_recent['originator'], most_recent['event_type'], most_recent['detection'],
-                                           most_recent['file_path'], local_file_path, most_recent['file_hash']))
-                    encrypt, shared, cloud = True, False, True  # todo: get this from pref
-                    if encrypt:
-                        expand_ok = crypto.decrypt_file(cache_fernet_file, local_file_path)
-                        if expand_ok:
-                            mtime = (most_recent['mtime'] - datetime.datetime.utcfromtimestamp(0)).total_seconds()
-                            os.utime(local_file_path, (mtime, mtime))
+                    blob_store = latus.blob_store.get_blob_store(pref.get_cache_folder())
+                    blob_cache = latus.blob_cache.get_blob_cache(pref.get_cache_folder(), pref.get_cache_max_bytes())
+                    blob_cache.pin(hash_value, ENCRYPTION_EXTENSION)  # not evicted while we're using it
+                    try:
+                        cache_fernet_file = blob_cache.get(hash_value, ENCRYPTION_EXTENSION)
+                        cache_hit = cache_fernet_file is not None
+                        if not cache_hit:
+                            cache_fernet_file = blob_store.make_path(hash_value, ENCRYPTION_EXTENSION)
+                            self.s3.download_file(cache_fernet_file, hash_value)
+                            blob_cache.add(hash_value, ENCRYPTION_EXTENSION)
+                        latus.logger.log.info('originator=%s, event_type=%s, detection=%s, file_path="%s" - propagating to "%s" (file_hash=%s)' %
+                                              (most_recent['originator'], most_recent['event_type'], most_recent['detection'],
+                                               most_recent['file_path'], local_file_path, most_recent['file_hash']))
+                        encrypt, shared, cloud = True, False, True  # todo: get this from pref
+                        if encrypt:
+                            expand_ok = crypto.decrypt_file(cache_fernet_file, local_file_path)
+                            if expand_ok:
+                                mtime = (most_recent['mtime'] - datetime.datetime.utcfromtimestamp(0)).total_seconds()
+                                os.utime(local_file_path, (mtime, mtime))
+                            else:
+                                # todo: upgrade to fatal once we quit seeing this error in some tests
+                                latus.logger.log.error('Latus Key Error : %s : %s' % (cache_fernet_file, local_file_path))
+                                if cache_hit:
+                                    blob_store.remove(hash_value, ENCRYPTION_EXTENSION)  # e.g. partly written - download it next time
                         else:
-                            # todo: upgrade to fatal once we quit seeing this error in some tests
-                            latus.logger.log.error('Latus Key Error : %s : %s' % (cache_fernet_file, local_file_path))
-                    else:
-                        cloud_file = os.path.join(pref.get_cache_folder(), most_recent['file_hash'] + UNENCRYPTED_EXTENSION)
-                        shutil.copy2(cloud_file, local_file_path)
+                            cloud_file = blob_store.find(most_recent['file_hash'], UNENCRYPTED_EXTENSION) or blob_store.get_path(most_recent['file_hash'], UNENCRYPTED_EXTENSION)
+                            shutil.copy2(cloud_file, local_file_path)
+                    finally:
+                        blob_cache.unpin(hash_value, ENCRYPTION_EXTENSION)
                     node_db.clear_pending(most_recent)
                 else:
                     latus.logger.log.warning('%s : hash is None for %s' % (pref.get_node_id(), local_file_path))
@@ -0,0 +1,146 @@
+import os
+import collections
+import threading
+
+import latus.logger
+import latus.blob_store
+from latus.const import ENCRYPTION_EXTENSION, CACHE_MAX_BYTES_DEFAULT
+
+
+class BlobCache:
+    """
+    Keeps a BlobStore within a size budget by evicting the least recently used blobs - for a store that is only a copy
+    (e.g. the local AWS cache, where S3 has every blob).  Blobs that are still to be uploaded are pinned, and pinned
+    blobs are never evicted.
+
+    Recency is the blob file's mtime (a hit touches it), so the order carries over to the next run.
+    """
+    def __init__(self, blob_store, max_bytes=CACHE_MAX_BYTES_DEFAULT):
+        self.blob_store = blob_store
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.blobs = collections.OrderedDict()  # (hash, extension) -> size, least recently used first
+        self.total_bytes = 0
+        self.pins = collections.Counter()  # (hash, extension) -> pin count
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        blobs = []
+        for hash_value, extension, path in blob_store.iter_blobs():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            blobs.append((stat.st_mtime, hash_value, extension, stat.st_size))
+        for _, hash_value, extension, size in sorted(blobs):
+            self.blobs[(hash_value, extension)] = size
+            self.total_bytes += size
+
+    def get(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        """
+        :return: path of a cached blob (and it becomes the most recently used), or None on a miss
+        """
+        key = (hash_value, extension)
+        with self.lock:
+            path = self.blob_store.find(hash_value, extension)
+            if path is None:
+                self._drop(key)  # e.g. removed by latus.blob_gc
+                self.misses += 1
+                return None
+            if key not in self.blobs:
+                self._add(key, path)
+            self.blobs.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def add(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        """
+        note a blob that has just been written to the store (then evict, if over budget)
+        """
+        key = (hash_value, extension)
+        path = self.blob_store.find(hash_value, extension)
+        with self.lock:
+            self._drop(key)
+            if path is not None:
+                self._add(key, path)
+        self.evict()
+
+    def pin(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        with self.lock:
+            self.pins[(hash_value, extension)] += 1
+
+    def unpin(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        key = (hash_value, extension)
+        with self.lock:
+            if self.pins[key] > 1:
+                self.pins[key] -= 1
+            elif key in self.pins:
+                del self.pins[key]
+        self.evict()
+
+    def evict(self):
+        """
+        remove least recently used (unpinned) blobs until the cache is within its budget
+        :return: number of blobs evicted
+        """
+        count = 0
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return count
+            for key in [key for key in self.blobs if key not in self.pins]:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                size = self.blobs[key]
+                self._drop(key)
+                if self.blob_store.remove(*key):
+                    count += 1
+                    self.evictions += 1
+                    self.evicted_bytes += size
+        if count > 0:
+            latus.logger.log.info('blob cache : %s : evicted %d blobs' % (self.blob_store.folder, count))
+        return count
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'evicted_bytes': self.evicted_bytes, 'blobs': len(self.blobs), 'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes, 'pinned': len(self.pins)}
+
+    def _add(self, key, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.blobs[key] = size
+        self.total_bytes += size
+
+    def _drop(self, key):
+        size = self.blobs.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+
+g_blob_caches = {}  # abs path of folder -> BlobCache
+g_blob_caches_lock = threading.Lock()
+
+
+def get_blob_cache(folder, max_bytes=CACHE_MAX_BYTES_DEFAULT):
+    """
+    Get the BlobCache for a cache folder.  It's created (from what's already in the folder) on first use, then reused.
+    :param folder: cache folder
+    :param max_bytes: size budget (the preference can change, so this is updated every call)
+    :return: BlobCache
+    """
+    key = os.path.abspath(folder)
+    with g_blob_caches_lock:
+        blob_cache = g_blob_caches.get(key)
+        if blob_cache is None:
+            blob_cache = BlobCache(latus.blob_store.get_blob_store(folder), max_bytes)
+            g_blob_caches[key] = blob_cache
+        blob_cache.max_bytes = max_bytes
+        return blob_cache
@@ -0,0 +1,198 @@
+import os
+import time
+import argparse
+import threading
+
+import sqlalchemy.exc
+
+import latus.logger
+import latus.nodedb
+import latus.preferences
+import latus.blob_store
+import latus.csp.cloud_folders
+import latus.csp.change_log
+from latus.const import BLOB_GC_RETENTION, BLOB_GC_GRACE, BLOB_GC_INTERVAL, BLOB_GC_BATCH_SIZE, BLOB_GC_BATCH_PAUSE, \
+    TIME_OUT
+
+"""
+    Garbage collection of cache blobs that no change refers to any more.
+
+    A blob is live if its hash is the latest state of a path, is in a pending change, or is in a change newer than the
+    retention window, in any of the node DBs.  Anything else (old versions, deleted files) is removed, a batch at a
+    time.  Blobs newer than the grace period are always kept, since a node writes a blob to the cache before its change
+    is in its DB (and before the cloud client has synced that DB to the other nodes).
+"""
+
+
+class BlobGCReport:
+    """
+    what a collection found (and, unless it was a dry run, removed)
+    """
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.live_hashes = 0
+        self.blobs = 0
+        self.blob_bytes = 0
+        self.young = 0  # orphans kept since they're in the grace period
+        self.orphans = 0
+        self.orphan_bytes = 0
+        self.removed = 0
+        self.removed_bytes = 0
+
+    def __str__(self):
+        s = 'blobs : %d (%d bytes) , live hashes : %d , orphans : %d (%d bytes) , in grace period : %d' % \
+            (self.blobs, self.blob_bytes, self.live_hashes, self.orphans, self.orphan_bytes, self.young)
+        if self.dry_run:
+            s += ' , dry run (nothing removed)'
+        else:
+            s += ' , removed : %d (%d bytes)' % (self.removed, self.removed_bytes)
+        return s
+
+
+def get_node_dbs(pref):
+    """
+    :param pref: Preferences
+    :return: list of the NodeDBs whose changes refer to this node's cache
+    """
+    if pref.get_cloud_mode() == 'aws' or latus.csp.change_log.is_log_mode(pref):
+        # other nodes' changes are replicated into ours
+        return [latus.nodedb.get_node_db(pref.get_app_data_folder(), pref.get_node_id())]
+    node_db_folder = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root()).nodes
+    return [latus.nodedb.get_node_db(node_db_folder, node_id) for node_id in sorted(latus.nodedb.get_existing_nodes(node_db_folder))]
+
+
+def get_cache_folder(pref):
+    if pref.get_cloud_mode() == 'aws':
+        return pref.get_cache_folder()
+    return latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root()).cache
+
+
+def get_live_hashes(node_dbs, retention=BLOB_GC_RETENTION):
+    """
+    :return: set of the hashes the node DBs refer to, or None if any of them couldn't be read (then nothing is safe to
+    remove)
+    """
+    live_hashes = set()
+    for node_db in node_dbs:
+        try:
+            live_hashes |= node_db.get_referenced_hashes(retention)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            latus.logger.log.warn('blob gc : could not read %s : %s' % (node_db.get_database_file_abs_path(), str(e)))
+            return None
+    return live_hashes
+
+
+def collect(blob_store, node_dbs, dry_run=False, retention=BLOB_GC_RETENTION, grace=BLOB_GC_GRACE,
+            batch_size=BLOB_GC_BATCH_SIZE, batch_pause=BLOB_GC_BATCH_PAUSE, exit_event=None):
+    """
+    Remove the blobs no change refers to.
+    :param blob_store: BlobStore
+    :param node_dbs: all of the NodeDBs that refer to this store's blobs
+    :param dry_run: True to only report what would be removed
+    :param retention: seconds of superseded changes whose blobs are kept
+    :param grace: seconds - blobs modified more recently than this are kept
+    :param batch_size: blobs removed per batch
+    :param batch_pause: seconds between batches
+    :param exit_event: threading.Event that stops the collection early
+    :return: BlobGCReport, or None if the node DBs couldn't all be read
+    """
+    if len(node_dbs) == 0:
+        latus.logger.log.info('blob gc : no node DBs')
+        return None
+    live_hashes = get_live_hashes(node_dbs, retention)
+    if live_hashes is None:
+        return None
+    report = BlobGCReport(dry_run)
+    report.live_hashes = len(live_hashes)
+    cutoff = time.time() - grace
+    batch = []
+    for hash_value, extension, path in blob_store.iter_blobs():
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # e.g. just removed by another node
+        report.blobs += 1
+        report.blob_bytes += stat.st_size
+        if hash_value in live_hashes:
+            continue
+        if stat.st_mtime > cutoff:
+            report.young += 1
+            continue
+        report.orphans += 1
+        report.orphan_bytes += stat.st_size
+        if not dry_run:
+            batch.append((hash_value, extension, stat.st_size))
+            if len(batch) >= batch_size:
+                _remove_batch(blob_store, node_dbs, batch, report, retention, grace)
+                batch = []
+                if exit_event is None:
+                    time.sleep(batch_pause)
+                elif exit_event.wait(batch_pause):
+                    break
+    _remove_batch(blob_store, node_dbs, batch, report, retention, grace)
+    latus.logger.log.info('blob gc : %s : %s' % (blob_store.folder, str(report)))
+    return report
+
+
+def _remove_batch(blob_store, node_dbs, batch, report, retention, grace):
+    # The live hashes were read at the start of what can be a long collection, so check each blob again right before
+    # it's removed - it may have been written (or reused, which touches it) or referred to since.
+    for hash_value, extension, size in batch:
+        if _is_still_orphan(blob_store, node_dbs, hash_value, extension, retention, grace) and \
+                blob_store.remove(hash_value, extension):
+            report.removed += 1
+            report.removed_bytes += size
+
+
+def _is_still_orphan(blob_store, node_dbs, hash_value, extension, retention, grace):
+    path = blob_store.find(hash_value, extension)
+    try:
+        if path is None or os.path.getmtime(path) > time.time() - grace:
+            return False
+        return not any(node_db.is_hash_referenced(hash_value, retention) for node_db in node_dbs)
+    except (OSError, sqlalchemy.exc.SQLAlchemyError) as e:
+        latus.logger.log.warn('blob gc : keeping %s : %s' % (path, str(e)))
+        return False
+
+
+class BlobGC(threading.Thread):
+    """
+    Runs collect() on a node's cache every interval, in the background.
+    """
+    def __init__(self, app_data_folder, interval=BLOB_GC_INTERVAL):
+        super().__init__()
+        self.app_data_folder = app_data_folder
+        self.interval = interval
+        self.exit_event = threading.Event()
+
+    def run(self):
+        # first wait - right after start up is when the node DBs are most likely to be behind
+        while not self.exit_event.wait(self.interval):
+            try:
+                pref = latus.preferences.Preferences(self.app_data_folder)
+                blob_store = latus.blob_store.get_blob_store(get_cache_folder(pref))
+                collect(blob_store, get_node_dbs(pref), exit_event=self.exit_event)
+            except Exception as e:
+                latus.logger.log.exception('blob gc : %s' % str(e))
+
+    def request_exit(self, time_out=TIME_OUT):
+        """
+        :return: True if the thread has stopped
+        """
+        self.exit_event.set()
+        if self.is_alive():
+            self.join(time_out)
+        return not self.is_alive()
+
+
+if __name__ == '__main__':
+    # Report (or remove) a node's orphaned cache blobs from the command line.
+    parser = argparse.ArgumentParser(description='latus cache garbage collection (a dry run unless --remove is given)')
+    parser.add_argument('-a', '--appdatafolder', required=True, help='app data folder (where preferences are stored)')
+    parser.add_argument('--remove', action='store_true', help='remove the orphaned blobs')
+    args = parser.parse_args()
+    latus.logger.init(os.path.join(args.appdatafolder, 'log'))
+    pref = latus.preferences.Preferences(args.appdatafolder)
+    report = collect(latus.blob_store.get_blob_store(get_cache_folder(pref)), get_node_dbs(pref), dry_run=not args.remove,
+                     batch_pause=0.0)
+    print(report if report is not None else 'could not read the node DBs')
@@ -0,0 +1,135 @@
+import os
+import re
+import threading
+
+import latus.logger
+from latus.const import ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION
+
+# blob file name - the file's hash plus the extension (encrypted or not)
+BLOB_NAME = re.compile(r'^([0-9a-f]{4,})(' + re.escape(ENCRYPTION_EXTENSION) + '|' + re.escape(UNENCRYPTED_EXTENSION) + ')$')
+
+SHARD_LEVELS = 2  # e.g. ab/cd/abcd...
+SHARD_WIDTH = 2  # hex characters per level
+
+
+class BlobStore:
+    """
+    Content addressed store of file contents (blobs), named by their hash.  Blobs are fanned out into sub folders by the
+    leading characters of the hash (e.g. ab/cd/abcd<rest of hash>.fer), so no one folder gets big.
+
+    Blobs in the older flat layout (all in the top folder) are moved into place when the store is opened, and are still
+    found if they show up later (e.g. written to a shared cache by a node running an older version).
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.migrate()
+
+    def get_path(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        """
+        :return: path of a blob in the sharded layout (whether it exists or not)
+        """
+        shards = [hash_value[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(SHARD_LEVELS)]
+        return os.path.join(self.folder, *shards, hash_value + extension)
+
+    def find(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        """
+        :return: path of a blob, or None if it's not in the store
+        """
+        path = self.get_path(hash_value, extension)
+        if os.path.exists(path):
+            return path
+        flat_path = os.path.join(self.folder, hash_value + extension)
+        if os.path.exists(flat_path):
+            return flat_path
+        return None
+
+    def exists(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        return self.find(hash_value, extension) is not None
+
+    def touch(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        """
+        Mark a blob as just used (its mtime is set to now), e.g. when a file's contents are back to those of an old blob,
+        so latus.blob_gc sees it as new rather than as an old orphan.
+        :return: True if the blob is in the store
+        """
+        path = self.find(hash_value, extension)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+        except OSError:
+            return os.path.exists(path)  # e.g. read only, but still there
+        return True
+
+    def make_path(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        """
+        :return: path to write a blob to (its folder is created)
+        """
+        path = self.get_path(hash_value, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def remove(self, hash_value, extension=ENCRYPTION_EXTENSION):
+        """
+        :return: True if the blob was removed
+        """
+        path = self.find(hash_value, extension)
+        if path is None:
+            return False
+        try:
+            os.remove(path)
+        except OSError as e:
+            latus.logger.log.warn('could not remove %s : %s' % (path, str(e)))
+            return False
+        return True
+
+    def iter_blobs(self):
+        """
+        :return: iterator of (hash, extension, path) of every blob in the store
+        """
+        for folder, _, names in os.walk(self.folder):
+            for name in names:
+                match = BLOB_NAME.match(name)
+                if match:
+                    yield match.group(1), match.group(2), os.path.join(folder, name)
+
+    def migrate(self):
+        """
+        move blobs in the flat layout into the sharded layout
+        :return: number of blobs moved
+        """
+        count = 0
+        if not os.path.isdir(self.folder):
+            return count
+        with os.scandir(self.folder) as entries:
+            flat_blobs = [entry.name for entry in entries if entry.is_file() and BLOB_NAME.match(entry.name)]
+        for name in flat_blobs:
+            match = BLOB_NAME.match(name)
+            try:
+                os.replace(os.path.join(self.folder, name), self.make_path(match.group(1), match.group(2)))
+                count += 1
+            except OSError as e:
+                # e.g. another node sharing this cache moved it first
+                latus.logger.log.info('could not migrate %s : %s' % (name, str(e)))
+        if count > 0:
+            latus.logger.log.info('migrated %d blobs to the sharded layout in %s' % (count, self.folder))
+        return count
+
+
+g_blob_stores = {}  # abs path of folder -> BlobStore
+g_blob_stores_lock = threading.Lock()
+
+
+def get_blob_store(folder):
+    """
+    Get the BlobStore for a folder.  It's created (and any flat layout blobs migrated) on first use, then reused.
+    :param folder: cache folder
+    :return: BlobStore
+    """
+    key = os.path.abspath(folder)
+    with g_blob_stores_lock:
+        blob_store = g_blob_stores.get(key)
+        if blob_store is None:
+            blob_store = BlobStore(folder)
+            g_blob_stores[key] = blob_store
+        return blob_store
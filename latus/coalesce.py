@@ -0,0 +1,276 @@
+import os
+import time
+import collections
+import threading
+
+import watchdog.events
+
+import latus.logger
+import latus.util
+from latus.const import COALESCE_QUIET_TIME, COALESCE_MAX_WAIT, CLOUD_SYNC_MIN_INTERVAL
+
+
+# other event types (e.g. opened/closed) are passed straight through
+COALESCED_EVENT_TYPES = {watchdog.events.EVENT_TYPE_CREATED, watchdog.events.EVENT_TYPE_MODIFIED, watchdog.events.EVENT_TYPE_DELETED}
+
+
+class PendingEvent:
+    __slots__ = ['event', 'first_time', 'last_time', 'signature']
+
+    def __init__(self, event, now):
+        self.event = event
+        self.first_time = now
+        self.last_time = now
+        self.signature = _get_signature(event.src_path)
+
+
+def _get_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _merge(pending_event, event):
+    """
+    merge two events for the same file into one
+    """
+    if event.event_type == watchdog.events.EVENT_TYPE_DELETED:
+        return event
+    if pending_event.event_type == watchdog.events.EVENT_TYPE_CREATED:
+        return pending_event  # created then modified is still just created
+    if pending_event.event_type == watchdog.events.EVENT_TYPE_DELETED or event.event_type == watchdog.events.EVENT_TYPE_CREATED:
+        return watchdog.events.FileModifiedEvent(event.src_path)  # e.g. an editor that deletes and re-writes the file
+    return event
+
+
+class EventCoalescer(threading.Thread):
+    """
+    Sits between the watchdog observer and the event handler (schedule this on the observer instead of the handler).
+    A file's events are merged into one, and only handed to the handler once the file has had no events for the quiet
+    time and its size and mtime have stopped changing (or it's waited max_wait).  So a burst of events from an editor
+    or copy doesn't cause the file to be hashed and encrypted over and over, or while it's only partially written.
+    Directory events and moves aren't merged, but a pending event for a move's source is folded into the move (a create
+    then move is a create at the destination, and a modify then move is just the move).
+    All the handler calls are made from this thread, in order.
+    """
+    def __init__(self, handler, active_timer=None, quiet_time=COALESCE_QUIET_TIME, max_wait=COALESCE_MAX_WAIT):
+        """
+        :param handler: watchdog event handler to pass the (merged) events to
+        :param active_timer: ActivityTimer to keep active while there are events waiting to be handled
+        :param quiet_time: seconds a file's events have to be quiet before they're handled
+        :param max_wait: maximum seconds a file's events are held
+        """
+        super().__init__(name='EventCoalescer')
+        self.handler = handler
+        self.active_timer = active_timer
+        self.quiet_time = quiet_time
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()  # path -> PendingEvent
+        self.ready = collections.deque()  # events to hand to the handler now
+        self.busy = False  # there are events pending, ready or being handled
+        self.exit_flag = False
+
+    def dispatch(self, event):
+        """
+        called by the watchdog observer
+        """
+        now = time.time()
+        if not event.is_directory and latus.util.is_temp_file(event.src_path):
+            if event.event_type != watchdog.events.EVENT_TYPE_MOVED or latus.util.is_temp_file(event.dest_path):
+                return  # latus's own temp files (see latus.crypto) are never handed over
+            # a temp file moved into place is, as far as the handler is concerned, a new file at the destination
+            event = watchdog.events.FileCreatedEvent(event.dest_path)
+        with self.condition:
+            if event.event_type == watchdog.events.EVENT_TYPE_MOVED and not event.is_directory:
+                # the source doesn't exist any more, so its pending event is folded into the move rather than handed over
+                src_pending_event = self.pending.pop(event.src_path, None)
+                dest_pending_event = self.pending.pop(event.dest_path, None)
+                if src_pending_event is not None and src_pending_event.event.event_type == watchdog.events.EVENT_TYPE_CREATED:
+                    # e.g. an editor that writes a new file then renames it over the original - just a new file at the
+                    # destination (which replaces whatever was pending for it)
+                    created_event = watchdog.events.FileCreatedEvent(event.dest_path)
+                    self.pending[event.dest_path] = PendingEvent(created_event, now)
+                else:
+                    if dest_pending_event is not None:
+                        self.ready.append(dest_pending_event.event)
+                    if src_pending_event is not None and src_pending_event.event.event_type != watchdog.events.EVENT_TYPE_MODIFIED:
+                        self.ready.append(src_pending_event.event)
+                    # a pending modify of the source is covered by the move (the destination is hashed for it)
+                    self.ready.append(event)
+            elif event.is_directory or event.event_type not in COALESCED_EVENT_TYPES:
+                self.ready.append(event)
+            else:
+                pending_event = self.pending.get(event.src_path)
+                if pending_event is None:
+                    self.pending[event.src_path] = PendingEvent(event, now)
+                else:
+                    pending_event.event = _merge(pending_event.event, event)
+                    pending_event.last_time = now
+            self._set_busy(True)
+            self.condition.notify()
+
+    def _set_busy(self, busy):
+        if busy != self.busy:
+            self.busy = busy
+            if self.active_timer is not None:
+                if busy:
+                    self.active_timer.enter_trigger('coalesce')
+                else:
+                    self.active_timer.exit_trigger('coalesce')
+
+    def _get_ready(self, now):
+        """
+        move the pending events that are ready to the ready queue
+        :return: seconds until the next pending event could be ready (None if nothing is pending)
+        """
+        next_time = None
+        for path, pending_event in list(self.pending.items()):
+            ready_time = min(pending_event.last_time + self.quiet_time, pending_event.first_time + self.max_wait)
+            if now >= ready_time:
+                signature = _get_signature(path)
+                if signature == pending_event.signature or signature is None or now >= pending_event.first_time + self.max_wait:
+                    del self.pending[path]
+                    self.ready.append(pending_event.event)
+                    continue
+                # still being written to
+                pending_event.signature = signature
+                pending_event.last_time = now
+                ready_time = min(now + self.quiet_time, pending_event.first_time + self.max_wait)
+            if next_time is None or ready_time - now < next_time:
+                next_time = ready_time - now
+        return next_time
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.exit_flag:
+                    # hand over everything that's left
+                    self.ready.extend(pending_event.event for pending_event in self.pending.values())
+                    self.pending.clear()
+                else:
+                    wait_time = self._get_ready(time.time())
+                    if len(self.ready) == 0:
+                        if wait_time is None:
+                            self._set_busy(False)
+                        self.condition.wait(wait_time)
+                        continue
+                events = list(self.ready)
+                self.ready.clear()
+            for event in events:
+                try:
+                    self.handler.dispatch(event)
+                except Exception as e:
+                    latus.logger.log.exception('%s : %s' % (str(event), str(e)))
+            if self.exit_flag:
+                with self.condition:
+                    if len(self.ready) == 0 and len(self.pending) == 0:
+                        self._set_busy(False)
+                        break
+
+    def request_exit(self, time_out=None):
+        """
+        handle any events still waiting and stop
+        :return: True if the thread has stopped
+        """
+        with self.condition:
+            self.exit_flag = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join(time_out)
+        return not self.is_alive()
+
+    def is_pending(self):
+        with self.condition:
+            return self.busy
+
+
+class CoalescingTrigger(threading.Thread):
+    """
+    Runs a function (on this thread) when requested, with any number of requests collapsed into one run.  At most one
+    run is in flight, and runs start at least min_interval apart.  A request made while a run is in progress gets one
+    more run after it (since the run in progress may have missed what caused the request).
+    """
+    def __init__(self, function, args=(), min_interval=CLOUD_SYNC_MIN_INTERVAL, active_timer=None):
+        """
+        :param function: function to run
+        :param args: args for the function when it's run for a request
+        :param min_interval: minimum seconds between the start of runs
+        :param active_timer: ActivityTimer to keep active while there's a request waiting
+        """
+        super().__init__(name='CoalescingTrigger')
+        self.function = function
+        self.args = args
+        self.min_interval = min_interval
+        self.active_timer = active_timer
+        self.condition = threading.Condition()
+        self.run_lock = threading.Lock()  # one run at a time
+        self.requested = False
+        self.last_run_time = None  # time.monotonic()
+        self.run_count = 0
+        self.exit_flag = False
+
+    def request(self):
+        with self.condition:
+            if not self.requested and self.active_timer is not None:
+                self.active_timer.enter_trigger('request')
+            self.requested = True
+            self.condition.notify()
+
+    def _clear_request(self):
+        if self.requested and self.active_timer is not None:
+            self.active_timer.exit_trigger('request')
+        self.requested = False
+
+    def run_now(self, *args):
+        """
+        run the function now, on the caller's thread (this also satisfies any request made before it starts)
+        """
+        with self.run_lock:
+            with self.condition:
+                self._clear_request()
+                self.last_run_time = time.monotonic()
+                self.run_count += 1
+            return self.function(*args)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.requested and not self.exit_flag:
+                    self.condition.wait()
+                if self.exit_flag:
+                    self._clear_request()
+                    break
+                if self.last_run_time is not None:
+                    wait_time = self.last_run_time + self.min_interval - time.monotonic()
+                    if wait_time > 0:
+                        self.condition.wait(wait_time)
+                        continue  # check again (we might have been asked to exit)
+            with self.run_lock:
+                with self.condition:
+                    if not self.requested:
+                        continue  # a run_now() got there first
+                    self._clear_request()
+                    self.last_run_time = time.monotonic()
+                    self.run_count += 1
+                try:
+                    self.function(*self.args)
+                except Exception as e:
+                    latus.logger.log.exception('%s : %s' % (str(self.function), str(e)))
+
+    def request_exit(self, time_out=None):
+        """
+        :return: True if the thread has stopped
+        """
+        with self.condition:
+            self.exit_flag = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join(time_out)
+        return not self.is_alive()
+
+    def is_pending(self):
+        with self.condition:
+            return self.requested
@@ -8,6 +8,9 @@ LATUS_KEY_FILE_EXT = '.lky'
 DB_EXTENSION = '.db'
 ENCRYPTION_EXTENSION = '.fer'
 UNENCRYPTED_EXTENSION = '.une'
+TEMP_EXTENSION = '.latustmp'  # files being written by latus itself (e.g. being decrypted) - never synced
+CHANGE_LOG_EXTENSION = '.log'
+ENCRYPTION_CHUNK_SIZE = 1024 * 1024  # plaintext bytes per authenticated chunk in the .fer (v2) format
 DESCRIPTION = 'Secure file sync with low impact to cloud storage.'
 MAIN_FILE = 'main.py'
 
@@ -18,6 +21,7 @@ API_ABEL_CO = 'http://api.abel.co'
 USAGE_API_URL = API_ABEL_CO + '/latus/usage'
 
 BIG_FILE_SIZE = 1024 * 1024
+HASH_CACHE_MAX_ENTRIES = 200000  # maximum number of file hashes kept in the (persistent) hash cache
 MAX_HASH_PERF_VALUES = 10  # determine how many longest hash times to store in the db
 ASYMMETRIC_KEY_LENGTH = 1024  # Asymmetric key size (in bits)
 
@@ -25,6 +29,42 @@ TIME_OUT = 10  # seconds
 
 FILTER_TIME_OUT = 3  # seconds
 
+COALESCE_QUIET_TIME = 0.5  # seconds a file's events have to be quiet before they're handled
+COALESCE_MAX_WAIT = 2.0  # seconds - handle a file's events after this long even if it's still changing
+CLOUD_SYNC_MIN_INTERVAL = 1.0  # seconds between cloud syncs triggered by cloud file system events
+
+DB_BATCH_SIZE = 1000  # number of changes per transaction (commit) for bulk node DB writes
+DB_MAX_PARAMETERS = 500  # most bound parameters in one statement (older SQLite builds allow only 999)
+DB_POOL_SIZE = 5  # SQLite connections kept open per DB (more are opened, then closed, when more threads need one)
+
+# node DB compaction (see NodeDB.compact())
+COMPACTION_HISTORY = 30 * 24 * 60 * 60.0  # seconds of superseded changes to keep
+COMPACTION_INTERVAL = 24 * 60 * 60.0  # seconds between compactions
+DB_MAINTENANCE_PERIOD = 60 * 60.0  # seconds between checks whether it's time to compact (or publish a snapshot)
+COMPACTION_VACUUM_PAGES = 1000  # free pages given back to the file system per compaction
+
+# cache blob garbage collection (see latus.blob_gc)
+BLOB_GC_RETENTION = 30 * 24 * 60 * 60.0  # seconds - contents of superseded changes are kept this long
+BLOB_GC_GRACE = 24 * 60 * 60.0  # seconds - blobs newer than this are kept (their change may not have replicated yet)
+BLOB_GC_INTERVAL = 24 * 60 * 60.0  # seconds between collections
+BLOB_GC_BATCH_SIZE = 100  # blobs removed per batch
+BLOB_GC_BATCH_PAUSE = 1.0  # seconds between batches (removals are uploads for the cloud client)
+
+CACHE_MAX_BYTES_DEFAULT = 2 * 1024 * 1024 * 1024  # bytes - budget of the local AWS blob cache (see latus.blob_cache)
+
+# MIV leases (see latus.miv.MivAllocator)
+MIV_LEASE_COUNT = 10000  # mivuis handed out per server request
+MIV_LEASE_TIME = 60.0  # seconds before the server is asked again
+MIV_OFFLINE_LEASE_TIME = 5 * 60.0  # seconds before the server is asked again if it couldn't be reached
+MIV_REQUEST_TIMEOUT = 2.0  # seconds
+MIV_MODE_DEFAULT = 'server'  # 'server' or 'hlc'
+MIV_HLC_MAX_DRIFT = 24 * 60 * 60.0  # seconds - observed mivuis further ahead of our clock than this are ignored
+
+# CSP replication (see latus.csp.change_log)
+REPLICATION_DEFAULT = 'db'  # 'db' (node DBs in the cloud folder) or 'log' (change log segments in the cloud folder)
+CHANGE_LOG_SEGMENT_SIZE = 256 * 1024  # bytes - a new segment is started once the current one is this big
+SNAPSHOT_INTERVAL = 24 * 60 * 60.0  # seconds between publishing snapshots of the latest state (see latus.csp.snapshot)
+
 FOLDER_PREFERENCE_DEFAULTS = (True, False, False)  # encrypt, shared, cloud
 
 
@@ -1,11 +1,42 @@
 
 import os
 import json
+import base64
+import struct
 import datetime
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import cryptography.exceptions
 import latus.util
 import latus.logger
+import latus.const
+
+# .fer v3 : a header followed by length prefixed AES-GCM chunks, so files can be encrypted and decrypted in constant
+# memory.  The header has a random salt, and each file's AES-GCM key is derived (HKDF) from the latus key and that salt,
+# so no two files share a key (and the number of files doesn't eat into the nonce space).  Each chunk's nonce is the
+# header's random nonce prefix, the chunk counter and a 'last chunk' flag, and the header is the associated data of
+# every chunk, so chunks can't be reordered, dropped, truncated or mixed between files.
+# v2 is the same, except it has no salt and all files share one derived key.  It's still read, but no longer written.
+# v1 is a plain Fernet token (which always starts with 'gAAAAA'), so it can't be confused with the v2/v3 magic.
+FER_MAGIC = b'LATUSFER'
+FER_VERSION = 3
+FER_SALT_SIZE = 16
+FER_NONCE_PREFIX_SIZE = 7
+FER_HEADER_START = struct.Struct('>8sB')  # magic, version
+FER_HEADERS = {
+    2: struct.Struct('>8sBI%ds' % FER_NONCE_PREFIX_SIZE),  # magic, version, chunk size, nonce prefix
+    3: struct.Struct('>8sBI%ds%ds' % (FER_SALT_SIZE, FER_NONCE_PREFIX_SIZE)),  # ... chunk size, salt, nonce prefix
+}
+FER_CHUNK_LENGTH = struct.Struct('>I')
+FER_TAG_SIZE = 16
+FER_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # sanity check on the header (so a corrupt file can't make us allocate a lot)
+
+
+class FerFormatError(Exception):
+    pass
 
 
 def new_key():
@@ -17,42 +48,182 @@ class Crypto:
         self.__key = key
         self.__node_id = node_id
         self.__fernet = Fernet(self.__key)
+        self.__aesgcm = None
+
+    def _get_aesgcm(self, salt):
+        """
+        The AES-GCM keys are derived from the latus (Fernet) key so the user still only has one key.
+        :param salt: the file's salt (v3), or None for the one key all v2 files share
+        :return: AESGCM for the file
+        """
+        if salt is None:
+            if self.__aesgcm is None:
+                self.__aesgcm = AESGCM(self._derive_key(None, b'latus .fer v2'))
+            return self.__aesgcm
+        return AESGCM(self._derive_key(salt, b'latus .fer v3'))
 
-    def encrypt_file(self, in_path, out_path):
-        token = None
+    def _derive_key(self, salt, info):
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info, backend=default_backend())
+        return hkdf.derive(base64.urlsafe_b64decode(self.__key))
+
+    def encrypt_file(self, in_path, out_path, chunk_size=latus.const.ENCRYPTION_CHUNK_SIZE):
         latus.logger.log.info('%s : encrypt : %s to %s' % (self.__node_id, in_path, out_path))
+        success = False
         if os.path.exists(in_path):
-            with open(in_path, 'rb') as in_file:
-                try:
-                    token = self.__fernet.encrypt(in_file.read())
-                except cryptography.exceptions.UnsupportedAlgorithm as e:
-                    latus.logger.log.error('%s : %s %s' % (e, in_path, out_path))
-                if token:
-                    with open(out_path, 'wb') as out_file:
-                        out_file.write(token)
+            temp_path = None
+            try:
+                with open(in_path, 'rb') as in_file:
+                    out_file, temp_path = _make_temp_file(out_path)
+                    with out_file:
+                        self._encrypt_stream(in_file, out_file, chunk_size)
+                os.replace(temp_path, out_path)
+                temp_path = None
+                success = True
+            except cryptography.exceptions.UnsupportedAlgorithm as e:
+                latus.logger.log.error('%s %s %s' % (e, in_path, out_path))
+            except IOError as e:
+                latus.logger.log.error('%s %s %s' % (e, in_path, out_path))
+            finally:
+                _remove_temp_file(temp_path)
         else:
             latus.logger.log.error('does not exist : %s' % in_path)
+        return success
 
     def decrypt_file(self, in_path, out_path):
+        """
+        Decrypt a .fer file (v3, or legacy v2 or Fernet).  The output is only moved to out_path once it has been completely
+        decrypted and authenticated.
+        :param in_path: .fer file
+        :param out_path: decrypted file
+        """
         latus.logger.log.info('%s : decrypt : %s to %s' % (self.__node_id, in_path, out_path))
         success = False
         if os.path.exists(in_path):
-            with open(in_path, 'rb') as in_file:
-                b = None
-                try:
-                    b = self.__fernet.decrypt(in_file.read())
-                except InvalidToken as e:
-                    latus.logger.log.error('InvalidToken (possible key error) %s : %s %s' % (str(e), in_path, out_path))
-                except cryptography.exceptions.UnsupportedAlgorithm as e:
-                    latus.logger.log.error('UnsupportedAlgorithm %s : %s %s' % (str(e), in_path, out_path))
-                if b:
-                    with open(out_path, 'wb') as out_file:
-                        out_file.write(b)
-                        success = True
+            temp_path = None
+            try:
+                with open(in_path, 'rb') as in_file:
+                    # write to a temp file next to out_path (so the final move is atomic) and move it into place when
+                    # done, so a partially decrypted (or unauthenticated) file is never seen at out_path
+                    out_file, temp_path = _make_temp_file(out_path)
+                    with out_file:
+                        if in_file.read(len(FER_MAGIC)) == FER_MAGIC:
+                            in_file.seek(0)
+                            self._decrypt_stream(in_file, out_file)
+                        else:
+                            # legacy (v1) Fernet token - has to be done in memory
+                            in_file.seek(0)
+                            out_file.write(self.__fernet.decrypt(in_file.read()))
+                os.replace(temp_path, out_path)
+                temp_path = None
+                success = True
+            except InvalidToken as e:
+                latus.logger.log.error('InvalidToken (possible key error) %s : %s %s' % (str(e), in_path, out_path))
+            except cryptography.exceptions.InvalidTag as e:
+                latus.logger.log.error('InvalidTag (possible key error or corrupt file) %s : %s %s' % (str(e), in_path, out_path))
+            except FerFormatError as e:
+                latus.logger.log.error('FerFormatError %s : %s %s' % (str(e), in_path, out_path))
+            except cryptography.exceptions.UnsupportedAlgorithm as e:
+                latus.logger.log.error('UnsupportedAlgorithm %s : %s %s' % (str(e), in_path, out_path))
+            except IOError as e:
+                latus.logger.log.error('%s : %s %s' % (str(e), in_path, out_path))
+            finally:
+                _remove_temp_file(temp_path)
         else:
             latus.logger.log.warn('does not exist : %s' % in_path)
         return success
 
+    def _encrypt_stream(self, in_file, out_file, chunk_size):
+        salt = os.urandom(FER_SALT_SIZE)
+        nonce_prefix = os.urandom(FER_NONCE_PREFIX_SIZE)
+        aesgcm = self._get_aesgcm(salt)
+        header = FER_HEADERS[FER_VERSION].pack(FER_MAGIC, FER_VERSION, chunk_size, salt, nonce_prefix)
+        out_file.write(header)
+        counter = 0
+        chunk = in_file.read(chunk_size)
+        while True:
+            # read ahead one chunk so we know if this is the last one (an empty file is one empty chunk)
+            next_chunk = in_file.read(chunk_size)
+            last = len(next_chunk) == 0
+            encrypted_chunk = aesgcm.encrypt(_chunk_nonce(nonce_prefix, counter, last), chunk, header)
+            out_file.write(FER_CHUNK_LENGTH.pack(len(encrypted_chunk)))
+            out_file.write(encrypted_chunk)
+            if last:
+                break
+            chunk = next_chunk
+            counter += 1
+
+    def _decrypt_stream(self, in_file, out_file):
+        header = in_file.read(FER_HEADER_START.size)
+        if len(header) != FER_HEADER_START.size:
+            raise FerFormatError('truncated header')
+        version = FER_HEADER_START.unpack(header)[1]
+        if version not in FER_HEADERS:
+            raise FerFormatError('unsupported version %d' % version)
+        header_struct = FER_HEADERS[version]
+        header += in_file.read(header_struct.size - len(header))
+        if len(header) != header_struct.size:
+            raise FerFormatError('truncated header')
+        if version == 2:
+            magic, version, chunk_size, nonce_prefix = header_struct.unpack(header)
+            salt = None
+        else:
+            magic, version, chunk_size, salt, nonce_prefix = header_struct.unpack(header)
+        if chunk_size > FER_MAX_CHUNK_SIZE:
+            raise FerFormatError('chunk size %d too large' % chunk_size)
+        aesgcm = self._get_aesgcm(salt)
+        counter = 0
+        while True:
+            length_bytes = in_file.read(FER_CHUNK_LENGTH.size)
+            if len(length_bytes) != FER_CHUNK_LENGTH.size:
+                raise FerFormatError('truncated (no last chunk)')
+            length = FER_CHUNK_LENGTH.unpack(length_bytes)[0]
+            if length > chunk_size + FER_TAG_SIZE:
+                raise FerFormatError('chunk length %d too large' % length)
+            encrypted_chunk = in_file.read(length)
+            if len(encrypted_chunk) != length:
+                raise FerFormatError('truncated chunk')
+            # the 'last' flag is authenticated, so first try the common (not last) case
+            try:
+                chunk = aesgcm.decrypt(_chunk_nonce(nonce_prefix, counter, False), encrypted_chunk, header)
+                last = False
+            except cryptography.exceptions.InvalidTag:
+                chunk = aesgcm.decrypt(_chunk_nonce(nonce_prefix, counter, True), encrypted_chunk, header)
+                last = True
+            out_file.write(chunk)
+            if last:
+                if len(in_file.read(1)) != 0:
+                    raise FerFormatError('data after last chunk')
+                break
+            counter += 1
+
     def get_key(self):
         return self.__key
 
+
+def _chunk_nonce(nonce_prefix, counter, last):
+    return nonce_prefix + struct.pack('>IB', counter, int(last))
+
+
+def _make_temp_file(path):
+    """
+    Make a temp file in the same folder as path.  It's named so it isn't synced (see latus.util.is_temp_file()), and
+    it gets the usual (umask) permissions, since it becomes the file at path.
+    :return: open (binary) file, temp file path
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    while True:
+        temp_path = os.path.join(folder, '.' + os.urandom(8).hex() + latus.const.TEMP_EXTENSION)
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        except FileExistsError:
+            continue
+        return os.fdopen(fd, 'wb'), temp_path
+
+
+def _remove_temp_file(temp_path):
+    if temp_path is not None:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
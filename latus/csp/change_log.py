@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import datetime
+import itertools
+import threading
+
+import latus.logger
+import latus.miv
+import latus.nodedb
+import latus.csp.cloud_folders
+from latus.const import CHANGE_LOG_EXTENSION, CHANGE_LOG_SEGMENT_SIZE, DB_BATCH_SIZE
+
+"""
+    Change log replication - an alternative to keeping every node's SQLite DB in the cloud folder.
+
+    Each node appends its own changes, one JSON line per change, to log segments in its folder under
+    CloudFolders.logs.  A segment is named by the mivui of its first change, and once it reaches the segment size a new
+    one is started, so older segments never change again.  The node DB itself is kept locally (in the app data folder)
+    and peers ingest only the changes above their high-water mark for each node, so a change costs the cloud client an
+    append of a few hundred bytes instead of re-uploading a DB.
+"""
+
+SEGMENT_NAME = re.compile(r'^(\d{20})' + re.escape(CHANGE_LOG_EXTENSION) + '$')  # anything else (e.g. a conflicted copy) is ignored
+
+# change info keys that are replicated (the rest are local to each node DB)
+RECORD_KEYS = ['mivui', 'originator', 'event_type', 'detection', 'file_path', 'src_path', 'size', 'file_hash', 'mtime']
+
+
+def is_log_mode(pref):
+    return pref.get_replication() == 'log'
+
+
+def get_node_db_folder(pref):
+    """
+    :param pref: Preferences
+    :return: the folder this node's DB is in - the cloud folder, unless the change log is used for replication
+    """
+    if is_log_mode(pref):
+        return pref.app_data_folder
+    return latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root()).nodes
+
+
+def get_log_node_ids(log_folder):
+    """
+    :param log_folder: CloudFolders.logs
+    :return: set of the node IDs that have a change log
+    """
+    if not os.path.isdir(log_folder):
+        return set()
+    return set(d for d in os.listdir(log_folder) if os.path.isdir(os.path.join(log_folder, d)))
+
+
+def get_node_ids(pref):
+    """
+    :param pref: Preferences
+    :return: set of the IDs of the nodes sharing this cloud folder - by their change logs, or their node DBs if the
+    change log isn't used
+    """
+    cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
+    if is_log_mode(pref):
+        return get_log_node_ids(cloud_folders.logs)
+    return latus.nodedb.get_existing_nodes(cloud_folders.nodes)
+
+
+def get_node_id_from_log_path(log_folder, path):
+    """
+    :return: node ID of a path in the change log folder (None if it's not in a node's folder)
+    """
+    relative_path = os.path.relpath(path, log_folder)
+    if relative_path.startswith(os.pardir) or relative_path == os.curdir:
+        return None
+    return relative_path.split(os.sep)[0]
+
+
+def to_line(info):
+    record = {key: info[key] for key in RECORD_KEYS}
+    if record['mtime'] is not None:
+        record['mtime'] = record['mtime'].isoformat()
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def from_line(line):
+    record = json.loads(line)
+    if record['mtime'] is not None:
+        mtime = record['mtime']
+        record['mtime'] = datetime.datetime.strptime(mtime, '%Y-%m-%dT%H:%M:%S.%f' if '.' in mtime else '%Y-%m-%dT%H:%M:%S')
+    return record
+
+
+def get_segments(node_log_folder):
+    """
+    :return: list of (first mivui, segment path) for a node's log, in order
+    """
+    segments = []
+    if os.path.isdir(node_log_folder):
+        for name in os.listdir(node_log_folder):
+            match = SEGMENT_NAME.match(name)
+            if match:
+                segments.append((int(match.group(1)), os.path.join(node_log_folder, name)))
+    return sorted(segments)
+
+
+class ChangeLogWriter:
+    """
+    Appends this node's changes to its change log.
+    """
+    def __init__(self, log_folder, node_id, segment_size=CHANGE_LOG_SEGMENT_SIZE):
+        self.node_id = node_id
+        self.folder = os.path.join(log_folder, node_id)
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.last_mivui = None  # most senior mivui in the log
+        self.segment_path = None  # segment being appended to
+        os.makedirs(self.folder, exist_ok=True)
+        segments = get_segments(self.folder)
+        if len(segments) > 0:
+            self.segment_path = segments[-1][1]
+            for record in ChangeLogReader(os.path.dirname(self.folder), node_id).read_after(segments[-1][0] - 1):
+                self.last_mivui = record['mivui']
+        # publish() only appends what's after the end of the log, so our new mivuis have to be too (e.g. if the node DB
+        # has been rebuilt and is behind the log)
+        latus.miv.set_floor(self.last_mivui)
+
+    def publish(self, node_db):
+        """
+        append this node's changes that are in the node DB but not yet in the log (our mivuis are committed in order -
+        see NodeDB.write_lock - so the changes after the end of the log are all the ones not in it)
+        :return: number of changes appended
+        """
+        with self.lock:
+            watermarks = node_db.get_watermarks()
+            if self.node_id not in watermarks or (self.last_mivui is not None and watermarks[self.node_id] <= self.last_mivui):
+                return 0
+            # the other originators are at their marks, so only our own changes come back
+            if self.last_mivui is None:
+                del watermarks[self.node_id]
+            else:
+                watermarks[self.node_id] = self.last_mivui
+            lines = []
+            count = 0
+            for info in node_db.iter_infos_after(watermarks):
+                lines.append(to_line(info))
+                count += 1
+                if len(lines) >= DB_BATCH_SIZE:
+                    self._append(lines, info['mivui'])
+                    lines = []
+            if len(lines) > 0:
+                self._append(lines, info['mivui'])
+            latus.logger.log.info('%s : change log : published %d' % (self.node_id, count))
+            return count
+
+    def _append(self, lines, last_mivui):
+        data = ''.join(lines).encode()
+        if self.segment_path is None or os.path.getsize(self.segment_path) >= self.segment_size:
+            first_mivui = json.loads(lines[0])['mivui']
+            self.segment_path = os.path.join(self.folder, '%020d%s' % (first_mivui, CHANGE_LOG_EXTENSION))
+            latus.logger.log.info('%s : change log : new segment %s' % (self.node_id, self.segment_path))
+        # one write, so a reader (or the cloud client) sees whole lines as often as possible
+        with open(self.segment_path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_mivui = last_mivui
+
+
+class ChangeLogReader:
+    """
+    Reads a node's change log.  Remembers how far into each segment it has read, so reading again only reads what has
+    been appended since.
+    """
+    def __init__(self, log_folder, node_id):
+        self.node_id = node_id
+        self.folder = os.path.join(log_folder, node_id)
+        self.offsets = {}  # segment path -> bytes read (always at the end of a line)
+
+    def read_after(self, watermark):
+        """
+        :param watermark: mivui - changes at or below it are skipped (None for all changes)
+        :return: iterator of change infos, in mivui order
+        """
+        segments = get_segments(self.folder)
+        for segment_index, (first_mivui, segment_path) in enumerate(segments):
+            next_first_mivui = segments[segment_index + 1][0] if segment_index + 1 < len(segments) else None
+            if watermark is not None and next_first_mivui is not None and next_first_mivui <= watermark + 1:
+                continue  # everything in this segment is at or below the watermark
+            offset = self.offsets.get(segment_path, 0)
+            try:
+                if os.path.getsize(segment_path) < offset:
+                    offset = 0  # the segment has been replaced
+                with open(segment_path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            except OSError as e:
+                latus.logger.log.warn('%s : change log : %s' % (self.node_id, str(e)))
+                continue
+            # the last line may not be all there yet (it's being written, or the cloud client hasn't synced all of it)
+            end = data.rfind(b'\n') + 1
+            self.offsets[segment_path] = offset + end
+            for line in data[:end].splitlines():
+                try:
+                    record = from_line(line.decode())
+                except (ValueError, KeyError, TypeError) as e:
+                    latus.logger.log.warn('%s : change log : bad line in %s : %s' % (self.node_id, segment_path, str(e)))
+                    continue
+                if record['originator'] == self.node_id and (watermark is None or record['mivui'] > watermark):
+                    yield record
+
+
+class ChangeLogIngester:
+    """
+    Brings the changes in the other nodes' change logs into this node's DB.
+    """
+    def __init__(self, log_folder, node_id):
+        self.log_folder = log_folder
+        self.node_id = node_id
+        self.readers = {}  # node ID -> ChangeLogReader
+
+    def ingest(self, node_db):
+        """
+        :param node_db: this node's DB
+        :return: number of changes added (they are marked as pending)
+        """
+        count = 0
+        watermarks = node_db.get_watermarks()
+        for log_node_id in sorted(get_log_node_ids(self.log_folder)):
+            if log_node_id == self.node_id:
+                continue
+            reader = self.readers.setdefault(log_node_id, ChangeLogReader(self.log_folder, log_node_id))
+            records = reader.read_after(watermarks.get(log_node_id))
+            # a chunk at a time, so a long log (e.g. a new node's first ingest) isn't all in memory
+            infos = list(itertools.islice(records, DB_BATCH_SIZE))
+            while len(infos) > 0:
+                latus.miv.observe(infos[-1]['mivui'])
+                count += node_db.update_many(infos, True)
+                infos = list(itertools.islice(records, DB_BATCH_SIZE))
+        return count
@@ -21,3 +21,13 @@ class CloudFolders:
         # file system database
         return os.path.join(self.__latus_cloud_folder, '.nodes')
 
+
+    @property
+    def logs(self):
+        # change log segments, one folder per node (see latus.csp.change_log)
+        return os.path.join(self.__latus_cloud_folder, '.logs')
+
+    @property
+    def snapshots(self):
+        # snapshots of each node's latest state, for bootstrapping new nodes (see latus.csp.snapshot)
+        return os.path.join(self.__latus_cloud_folder, '.snapshots')
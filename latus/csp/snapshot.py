@@ -0,0 +1,145 @@
+import os
+import gzip
+import json
+import time
+import zlib
+import datetime
+import tempfile
+
+import latus.logger
+import latus.miv
+from latus.const import LatusFileSystemEvent, SNAPSHOT_INTERVAL
+from latus.csp.change_log import to_line, from_line
+
+"""
+    Snapshots of the latest state of each path, so a new node doesn't have to replay the whole change history.
+
+    Each node periodically publishes a snapshot of its node DB's latest table, along with the high-water marks the
+    snapshot covers, to the cloud folder.  A new node (one with an empty node DB) loads the newest snapshot as pending
+    changes - one per path - and then replicates only the changes above the snapshot's marks.
+
+    A snapshot is gzipped JSON lines: a header, one change per path (in the change log's format), and a trailer with the
+    count so a partly synced snapshot can be told apart from a complete one.
+"""
+
+SNAPSHOT_EXTENSION = '.snapshot.gz'
+SNAPSHOT_VERSION = 1
+
+
+def get_snapshot_path(snapshot_folder, node_id):
+    return os.path.join(snapshot_folder, node_id + SNAPSHOT_EXTENSION)
+
+
+def write_snapshot(node_db, path):
+    """
+    write a snapshot of a node DB (written to a temp file first, then moved into place)
+    :return: number of paths in the snapshot
+    """
+    # read the marks first - changes that come in while the latest table is being read are then above the marks
+    # (and are replicated again, which is harmless) rather than missed
+    header = {'version': SNAPSHOT_VERSION, 'node_id': node_db.node_id, 'watermarks': node_db.get_watermarks(),
+              'created': datetime.datetime.utcnow().isoformat()}
+    count = 0
+    moves = set()  # a move is the latest state of both its source and destination, but is only written once
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        with gzip.open(temp_path, 'wt') as f:
+            f.write(json.dumps(header) + '\n')
+            for info in node_db.iter_latest():
+                if info['event_type'] == int(LatusFileSystemEvent.moved):
+                    if info['mivui'] in moves:
+                        continue
+                    moves.add(info['mivui'])
+                    # there's nothing to move on a new node - it just needs the destination
+                    info = info.to_dict()
+                    info['event_type'] = int(LatusFileSystemEvent.created)
+                    info['src_path'] = None
+                f.write(to_line(info))
+                count += 1
+            f.write(json.dumps({'count': count}) + '\n')
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return count
+
+
+def read_snapshot(path):
+    """
+    :return: the snapshot's header (None if it can't be read)
+    """
+    try:
+        with gzip.open(path, 'rt') as f:
+            return json.loads(f.readline())
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        latus.logger.log.warn('could not read snapshot %s : %s' % (path, str(e)))
+        return None
+
+
+def iter_snapshot(path):
+    """
+    :return: iterator of the changes in a snapshot (raises ValueError if the snapshot is incomplete)
+    """
+    with gzip.open(path, 'rt') as f:
+        f.readline()  # header
+        count = 0
+        for line in f:
+            record = json.loads(line)
+            if 'count' in record and 'mivui' not in record:
+                if record['count'] != count:
+                    raise ValueError('snapshot has %d changes, expected %d' % (count, record['count']))
+                return
+            yield from_line(line)
+            count += 1
+    raise ValueError('snapshot is incomplete')
+
+
+def maybe_publish(node_db, snapshot_folder, interval=SNAPSHOT_INTERVAL):
+    """
+    publish a snapshot of this node's DB, if ours is older than the interval and the DB has changed since
+    :return: number of paths in the snapshot (None if it wasn't time)
+    """
+    path = get_snapshot_path(snapshot_folder, node_db.node_id)
+    if os.path.exists(path):
+        if time.time() - os.path.getmtime(path) < interval:
+            return None
+        header = read_snapshot(path)
+        if header is not None and header['watermarks'] == node_db.get_watermarks():
+            os.utime(path)  # nothing new - check again after another interval
+            return None
+    count = write_snapshot(node_db, path)
+    latus.logger.log.info('%s : published snapshot of %d paths' % (node_db.node_id, count))
+    return count
+
+
+def bootstrap(node_db, snapshot_folder):
+    """
+    If this node's DB is new, load the newest snapshot from another node into it.
+    :return: number of changes loaded
+    """
+    if len(node_db.get_watermarks()) > 0 or not os.path.isdir(snapshot_folder):
+        return 0
+    newest = None
+    for name in os.listdir(snapshot_folder):
+        if name.endswith(SNAPSHOT_EXTENSION) and name != os.path.basename(get_snapshot_path(snapshot_folder, node_db.node_id)):
+            path = os.path.join(snapshot_folder, name)
+            header = read_snapshot(path)
+            if header is not None and header.get('version') == SNAPSHOT_VERSION and (newest is None or header['created'] > newest[1]['created']):
+                newest = (path, header)
+    if newest is None:
+        return 0
+    path, header = newest
+    latus.logger.log.info('%s : bootstrapping from %s' % (node_db.node_id, path))
+    try:
+        count = node_db.update_many(iter_snapshot(path), True)  # mark as pending
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        # what was loaded is still good, but without the marks the history is replicated as usual
+        latus.logger.log.warn('%s : could not bootstrap from %s : %s' % (node_db.node_id, path, str(e)))
+        return 0
+    # only now that all of the snapshot is in the DB
+    node_db.set_watermark_floor(header['watermarks'])
+    if len(header['watermarks']) > 0:
+        latus.miv.observe(max(header['watermarks'].values()))
+    latus.logger.log.info('%s : bootstrapped %d paths' % (node_db.node_id, count))
+    return count
@@ -1,9 +1,8 @@
 
 import os
 import shutil
-import time
 import datetime
-import collections
+import threading
 from functools import wraps
 
 import watchdog.observers
@@ -13,22 +12,30 @@ import send2trash
 import latus.logger
 import latus.util
 import latus.const
-from latus.const import LatusFileSystemEvent, DetectionSource, ChangeAttributes, TIME_OUT, FILTER_TIME_OUT, ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION
+from latus.const import LatusFileSystemEvent, DetectionSource, ChangeAttributes, TIME_OUT, ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION, \
+    DB_MAINTENANCE_PERIOD
 import latus.preferences
 import latus.walker
+import latus.event_filter
+import latus.coalesce
+from latus.event_filter import watchdog_to_latus_events
+import latus.stat_index
 import latus.hash
+import latus.blob_store
+import latus.blob_gc
 import latus.crypto
+import latus.pipeline
 from latus import nodedb
 import latus.miv
 import latus.csp.cloud_folders
+import latus.csp.change_log
+import latus.csp.snapshot
 import latus.key_management
 import latus.gui
 import latus.activity_timer
 import latus.usage
 
 
-FilterEvent = collections.namedtuple('FilterEvent', ['path', 'event', 'timestamp'])
-
 # todo: would it be better to use watchdog.events.LoggingEventHandler instead of FileSystemEventHandler?
 
 
@@ -51,6 +58,7 @@ class SyncBase(watchdog.events.FileSystemEventHandler):
         self.filter_events = filter_events
 
         self.observer = watchdog.observers.Observer()
+        self.coalescer = None  # if set, the observer's events go through this (see latus.coalesce)
         # used to determine of this sync node is currently considered active
         pref = latus.preferences.Preferences(self.app_data_folder)
 
@@ -71,10 +79,11 @@ class SyncBase(watchdog.events.FileSystemEventHandler):
         except SystemError as e:
             latus.logger.log.exception('error stopping observer : %s' % str(self.get_type()))
         self.observer.join(TIME_OUT)
+        if self.coalescer is not None and not self.coalescer.request_exit(TIME_OUT):
+            latus.logger.log.error('%s - %s - request_exit failed to stop coalescer' % (pref.get_node_id(), self.get_type()))
 
-        if len(self.filter_events) > 0:
-            for filter_event in self.filter_events:
-                latus.logger.log.warn('%s : remaining filter event : %s' % (pref.get_node_id(), str(filter_event)))
+        for filter_event in self.filter_events.get_all():
+            latus.logger.log.warn('%s : remaining filter event : %s' % (pref.get_node_id(), str(filter_event)))
 
         latus.logger.log.info('%s - %s - request_exit end' % (pref.get_node_id(), self.get_type()))
         if self.observer.is_alive():
@@ -87,46 +96,29 @@ class SyncBase(watchdog.events.FileSystemEventHandler):
     def start_observer(self):
 
         # clear any pending filter events
-        for event in self.filter_events:
-            try:
-                self.filter_events.remove(event)
-            except ValueError:
-                latus.logger.log.info('error in clearing events : %s' % str(event))
+        self.filter_events.clear()
 
+        if self.coalescer is not None:
+            self.coalescer.start()
         self.observer.start()
 
     def add_filter_event(self, path, latus_file_system_event):
         pref = latus.preferences.Preferences(self.app_data_folder)
         latus.logger.log.info('%s : add_filter_event : %s : %s' % (pref.get_node_id(), path, str(latus_file_system_event)))
-        self.filter_events.append(FilterEvent(path, latus_file_system_event, time.time()))
+        self.filter_events.add(path, latus_file_system_event)
 
-    # Returns True if path is found in the filter list.  Also removes that path entry from the filter list.
+    # Returns True if path is found in the filter events.  Also removes that path entry from the filter events.
     def filtered(self, watchdog_event):
-        now = time.time()
         pref = latus.preferences.Preferences(self.app_data_folder)
 
         # remove any old events that somehow timed out
-        events_to_remove = []
-        for filter_event in self.filter_events:
-            if now > filter_event.timestamp + FILTER_TIME_OUT:
-                events_to_remove.append(filter_event)
-        for event_to_remove in events_to_remove:
-            latus.logger.log.warn('%s : filter event timed out %s' % (pref.get_node_id(), str(event_to_remove)))
-            try:
-                self.filter_events.remove(event_to_remove)
-            except ValueError:
-                # it's possible another thread had removed this
-                latus.logger.log.info('%s already removed' % str(event_to_remove))
+        for expired_event in self.filter_events.expire():
+            latus.logger.log.warn('%s : filter event timed out %s' % (pref.get_node_id(), str(expired_event)))
 
         # Look for this path in events.  If found, remove it and return True.
-        event_to_remove = None
-        for filter_event in self.filter_events:
-            if os.path.normpath(filter_event.path) == os.path.normpath(watchdog_event.src_path):
-                event_to_remove = filter_event
-                break
-        if event_to_remove is not None:
-            latus.logger.log.info('filtered : %s : %s' % (pref.get_node_id(), str(event_to_remove)))
-            self.filter_events.remove(event_to_remove)
+        filter_event = self.filter_events.test(watchdog_event.src_path, watchdog_to_latus_events.get(watchdog_event.event_type))
+        if filter_event is not None:
+            latus.logger.log.info('filtered : %s : %s' % (pref.get_node_id(), str(filter_event)))
             return True
 
         return False
@@ -148,7 +140,15 @@ class LocalSync(SyncBase):
         pref = latus.preferences.Preferences(app_data_folder)
         self.latus_folder = pref.get_latus_folder()
         latus.util.make_dir(self.latus_folder)
-        self.observer.schedule(self, self.latus_folder, recursive=True)
+        self.stat_index = latus.stat_index.StatIndex(app_data_folder)
+        if latus.csp.change_log.is_log_mode(pref):
+            cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
+            self.change_log_writer = latus.csp.change_log.ChangeLogWriter(cloud_folders.logs, pref.get_node_id())
+        else:
+            self.change_log_writer = None  # the node DB itself is in the cloud folder
+        # merge bursts of events for a file before they get to our on_* handlers
+        self.coalescer = latus.coalesce.EventCoalescer(self, self.active_timer)
+        self.observer.schedule(self.coalescer, self.latus_folder, recursive=True)
 
     def get_type(self):
         return 'local'
@@ -177,7 +177,7 @@ class LocalSync(SyncBase):
                 latus.logger.log.info('%s : filtered local on_deleted event : %s' % (self.get_node_id(), str(watchdog_event)))
             else:
                 latus.logger.log.info('%s : local on_deleted event : %s' % (self.get_node_id(), str(watchdog_event)))
-                # todo: remove from cache
+                # the file's blob stays in the cache (other nodes may not have it yet) - latus.blob_gc removes it later
                 self.__write_db(watchdog_event.src_path, None, LatusFileSystemEvent.deleted, DetectionSource.watchdog, None)
 
     @activity_trigger
@@ -212,14 +212,15 @@ class LocalSync(SyncBase):
                 file_hash, _ = latus.hash.calc_sha512(watchdog_event.dest_path, pref.get_crypto_key())
                 self.__write_db(watchdog_event.dest_path, src_path, LatusFileSystemEvent.moved, DetectionSource.watchdog, file_hash)
 
-    def __fill_cache(self, full_path):
+    def __fill_cache(self, full_path, hash=None):
         pref = latus.preferences.Preferences(self.app_data_folder)
         node_id = pref.get_node_id()
         cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
-        node_db = nodedb.NodeDB(cloud_folders.nodes, node_id)
+        node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), node_id)
         partial_path = os.path.relpath(full_path, pref.get_latus_folder())
         encrypt, shared, cloud = node_db.get_folder_preferences_from_path(partial_path)
-        hash, _ = latus.hash.calc_sha512(full_path, pref.get_crypto_key())
+        if hash is None:
+            hash, _ = latus.hash.calc_sha512(full_path, pref.get_crypto_key())
         if encrypt:
             crypto_key = pref.get_crypto_key()
             if crypto_key is None:
@@ -228,21 +229,21 @@ class LocalSync(SyncBase):
             if hash is None:
                 latus.logger.log.warning('could not get hash for %s' % full_path)
             else:
-                cloud_fernet_file = os.path.join(cloud_folders.cache, hash + ENCRYPTION_EXTENSION)
+                blob_store = latus.blob_store.get_blob_store(cloud_folders.cache)
                 crypto = latus.crypto.Crypto(crypto_key, pref.get_node_id())
-                if not os.path.exists(cloud_fernet_file):
+                if not blob_store.touch(hash, ENCRYPTION_EXTENSION):
+                    cloud_fernet_file = blob_store.make_path(hash, ENCRYPTION_EXTENSION)
                     latus.logger.log.info('%s : file_write , %s' % (node_id, cloud_fernet_file))
                     crypto.encrypt_file(full_path, os.path.abspath(cloud_fernet_file))
         else:
-            destination = os.path.join(cloud_folders.cache, hash + UNENCRYPTED_EXTENSION)
-            if not os.path.exists(destination):
-                shutil.copy2(full_path, destination)
+            blob_store = latus.blob_store.get_blob_store(cloud_folders.cache)
+            if not blob_store.touch(hash, UNENCRYPTED_EXTENSION):
+                shutil.copy2(full_path, blob_store.make_path(hash, UNENCRYPTED_EXTENSION))
         return hash
 
     # todo: encrypt the hash?
     def __write_db(self, full_path, src_path, filesystem_event_type, detection_source, file_hash):
         pref = latus.preferences.Preferences(self.app_data_folder)
-        cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
         latus_path = full_path.replace(pref.get_latus_folder() + os.sep, '')
         node_id = pref.get_node_id()
         if os.path.exists(full_path):
@@ -251,29 +252,44 @@ class LocalSync(SyncBase):
         else:
             mtime = None
             size = None
-        mivui = latus.miv.get_mivui(node_id)
-        self.sync_log(node_id, mivui, filesystem_event_type, full_path, detection_source, size, file_hash, mtime)
-        node_db = nodedb.NodeDB(cloud_folders.nodes, node_id)
-        most_recent_hash = node_db.get_most_recent_hash(latus_path)
+        node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), node_id)
+        with node_db.write_lock:  # so our mivuis are committed in order (see NodeDB.write_lock)
+            mivui = latus.miv.get_mivui(node_id)
+            self.sync_log(node_id, mivui, filesystem_event_type, full_path, detection_source, size, file_hash, mtime)
+            most_recent_hash = node_db.get_most_recent_hash(latus_path)
+            if most_recent_hash != file_hash:
+                node_db.update(mivui, node_id, int(filesystem_event_type), int(detection_source),
+                               latus_path, src_path, size, file_hash, mtime, False)
         if most_recent_hash != file_hash:
-            node_db.update(mivui, node_id, int(filesystem_event_type), int(detection_source),
-                           latus_path, src_path, size, file_hash, mtime, False)
+            self.publish(node_db)
 
     @activity_trigger
     def fs_scan(self, detection_source):
         latus.logger.log.info('starting fs_scan')
         pref = latus.preferences.Preferences(self.app_data_folder)
-        cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
         this_node_id = pref.get_node_id()
-        node_db = nodedb.NodeDB(cloud_folders.nodes, this_node_id)
+        node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), this_node_id)
         local_walker = latus.walker.Walker(pref.get_latus_folder())
         src_path = None  # no moves in file system scan
-        for partial_path in local_walker:
-            local_full_path = local_walker.full_path(partial_path)
-            if os.path.exists(local_full_path):
-                local_hash, _ = latus.hash.calc_sha512(local_full_path, pref.get_crypto_key())
-                if local_hash:
+        # write the stat index only after the DB batch has been written (context managers exit in reverse order)
+        with self.stat_index.scan() as stat_scan, node_db.batch() as node_db_batch:
+
+            def changed_files():
+                # the walk and the DB reads stay on this thread
+                for partial_path in local_walker:
+                    local_full_path = local_walker.full_path(partial_path)
+                    signature = latus.stat_index.get_stat_signature(local_full_path)
+                    if signature is None:
+                        continue  # file went away
                     most_recent_hash = node_db.get_most_recent_hash(partial_path)
+                    if stat_scan.unchanged(partial_path, signature) and most_recent_hash is not None:
+                        continue  # not changed since the last scan, so no need to hash it
+                    yield partial_path, local_full_path, signature, most_recent_hash
+
+            # hash and encrypt on the worker threads, but write the DB on this thread (in walk order)
+            scan_results = latus.pipeline.ordered_map(lambda item: self.__hash_and_fill_cache(item[1], item[3]), changed_files())
+            for (partial_path, local_full_path, signature, most_recent_hash), local_hash in scan_results:
+                if local_hash:
                     if most_recent_hash is None:
                         file_system_event = LatusFileSystemEvent.created
                     else:
@@ -281,14 +297,31 @@ class LocalSync(SyncBase):
                     if local_hash != most_recent_hash:
                         mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(local_full_path))
                         size = os.path.getsize(local_full_path)
-                        mivui = latus.miv.get_mivui(this_node_id)
-                        self.sync_log(this_node_id, file_system_event, mivui, partial_path, detection_source, size, local_hash, mtime)
-                        self.__fill_cache(local_full_path)
-                        self.add_filter_event(node_db.get_database_file_abs_path(), LatusFileSystemEvent.modified)
-                        node_db.update(mivui, this_node_id, int(file_system_event),
-                                       int(detection_source), partial_path, src_path, size, local_hash, mtime, False)
+                        # the mivui is allocated when the batch is written (see NodeDBBatch)
+                        self.sync_log(this_node_id, file_system_event, None, partial_path, detection_source, size, local_hash, mtime)
+                        if node_db_batch.count == 0 and len(node_db_batch.infos) == 0 and self.change_log_writer is None:
+                            self.add_filter_event(node_db.get_database_file_abs_path(), LatusFileSystemEvent.modified)
+                        node_db_batch.update(None, this_node_id, int(file_system_event),
+                                             int(detection_source), partial_path, src_path, size, local_hash, mtime, False)
+                    stat_scan.update(partial_path, signature)
                 else:
                     latus.logger.log.warn('%s : could not calculate hash for %s' % (this_node_id, local_full_path))
+        self.publish(node_db)
+
+    def publish(self, node_db):
+        # put our new changes in the change log (if it's used)
+        if self.change_log_writer is not None:
+            self.change_log_writer.publish(node_db)
+
+    def __hash_and_fill_cache(self, full_path, most_recent_hash):
+        """
+        hash a file and, if it has changed, put it in the cache (runs on the fs_scan worker threads)
+        """
+        pref = latus.preferences.Preferences(self.app_data_folder)
+        local_hash, _ = latus.hash.calc_sha512(full_path, pref.get_crypto_key())
+        if local_hash and local_hash != most_recent_hash:
+            self.__fill_cache(full_path, local_hash)
+        return local_hash
 
     # todo: get rid of this - it makes the line number irrelevant
     def sync_log(self, node_id, file_system_event, miv, file_path, detection_source, size, local_hash, mtime):
@@ -314,17 +347,40 @@ class CloudSync(SyncBase):
         latus.util.make_dir(cloud_folders.latus, True)
         latus.util.make_dir(cloud_folders.nodes, True)
         latus.util.make_dir(cloud_folders.cache, True)
+        latus.util.make_dir(cloud_folders.snapshots, True)
+        latus.blob_store.get_blob_store(cloud_folders.cache)  # moves an older (flat) cache into the sharded layout
 
         # make the node DB if it isn't already there
         pref = latus.preferences.Preferences(self.app_data_folder)
         node_id = pref.get_node_id()
-        nodedb.NodeDB(cloud_folders.nodes, node_id, True)
+        nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), node_id, True)
+
+        if latus.csp.change_log.is_log_mode(pref):
+            latus.util.make_dir(cloud_folders.logs, True)
+            self.change_log_ingester = latus.csp.change_log.ChangeLogIngester(cloud_folders.logs, node_id)
+            self.observer.schedule(self, cloud_folders.logs, recursive=True)
+        else:
+            self.change_log_ingester = None
+            self.observer.schedule(self, cloud_folders.nodes, recursive=True)
 
-        self.observer.schedule(self, cloud_folders.nodes, recursive=True)
+        # a single DB write causes several events, and other nodes can write a lot, so collapse the cloud syncs
+        self.sync_trigger = latus.coalesce.CoalescingTrigger(self.cloud_sync, (DetectionSource.watchdog,),
+                                                             active_timer=self.active_timer)
 
     def get_type(self):
         return 'cloud'
 
+    def start_observer(self):
+        self.sync_trigger.start()
+        return super().start_observer()
+
+    def request_exit(self):
+        timed_out = super().request_exit()
+        if not self.sync_trigger.request_exit(TIME_OUT):
+            latus.logger.log.error('%s - %s - request_exit failed to stop sync trigger' % (self.get_node_id(), self.get_type()))
+            timed_out = True
+        return timed_out
+
     @activity_trigger
     def on_any_event(self, event):
         pref = latus.preferences.Preferences(self.app_data_folder)
@@ -333,23 +389,28 @@ class CloudSync(SyncBase):
         else:
             latus.logger.log.info('%s : cloud on_any_event : %s' % (pref.get_node_id(), str(event)))
             cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
-            this_node_db = nodedb.NodeDB(cloud_folders.nodes, pref.get_node_id())
-            event_node_id = nodedb.get_node_id_from_db_file_path(event.src_path)
-            # if this dispatch was caused by an event on our own DB, ignore it
-            if not event.is_directory and event_node_id != this_node_db.get_node_id() and 'db-journal' not in event.src_path:
+            if self.change_log_ingester is None:
+                event_node_id = nodedb.get_node_id_from_db_file_path(event.src_path)
+            else:
+                event_node_id = latus.csp.change_log.get_node_id_from_log_path(cloud_folders.logs, event.src_path)
+            # if this dispatch was caused by an event on our own DB (or change log), ignore it
+            if not event.is_directory and event_node_id != pref.get_node_id() and 'db-journal' not in event.src_path:
                 latus.logger.log.info('%s : cloud dispatch : event : %s' % (pref.get_node_id(), event))
-                self.cloud_sync(DetectionSource.watchdog)
+                self.sync_trigger.request()
 
     @activity_trigger
     def cloud_sync(self, detection_source):
         pref = latus.preferences.Preferences(self.app_data_folder)
         cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
-        this_node_db = nodedb.NodeDB(cloud_folders.nodes, pref.get_node_id())
+        this_node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), pref.get_node_id())
 
-        # ensure this node's DB has all the entries that other node's DBs have
-        for db_node_id in nodedb.get_existing_nodes(cloud_folders.nodes):
-            if db_node_id != this_node_db.get_node_id():
-                nodedb.sync_dbs(cloud_folders.nodes, db_node_id, this_node_db.get_node_id())
+        # ensure this node's DB has all the entries that other node's DBs (or change logs) have
+        if self.change_log_ingester is None:
+            for db_node_id in nodedb.get_existing_nodes(cloud_folders.nodes):
+                if db_node_id != this_node_db.get_node_id():
+                    nodedb.sync_dbs(cloud_folders.nodes, db_node_id, this_node_db.get_node_id())
+        else:
+            self.change_log_ingester.ingest(this_node_db)
 
         for info in this_node_db.get_last_mivuis_info():
             local_file_path = os.path.join(pref.get_latus_folder(), info['path'])
@@ -368,8 +429,8 @@ class CloudSync(SyncBase):
                     crypto = latus.crypto.Crypto(crypto_key, pref.get_node_id())
 
                     if info['hash']:
-                        cloud_fernet_file = os.path.join(cloud_folders.cache,
-                                                         info['hash'] + ENCRYPTION_EXTENSION)
+                        blob_store = latus.blob_store.get_blob_store(cloud_folders.cache)
+                        cloud_fernet_file = blob_store.find(info['hash'], ENCRYPTION_EXTENSION) or blob_store.get_path(info['hash'], ENCRYPTION_EXTENSION)
                         latus.logger.log.info('%s : %s : %s %s %s - propagating to %s %s' %
                                               (pref.get_node_id(), info['detection'], info['originator'], info['event'], info['path'],
                                                local_file_path, info['hash']))
@@ -383,7 +444,7 @@ class CloudSync(SyncBase):
                             else:
                                 latus.logger.log.fatal('Latus Key Error - please reinitialize the Latus Key : %s : %s' % (cloud_fernet_file, local_file_path))
                         else:
-                            cloud_file = os.path.join(cloud_folders.cache, info['hash'] + UNENCRYPTED_EXTENSION)
+                            cloud_file = blob_store.find(info['hash'], UNENCRYPTED_EXTENSION) or blob_store.get_path(info['hash'], UNENCRYPTED_EXTENSION)
                             shutil.copy2(cloud_file, local_file_path)
                         this_node_db.clear_pending(info)
                     else:
@@ -421,6 +482,43 @@ class CloudSync(SyncBase):
         pass
 
 
+class DBMaintenance(threading.Thread):
+    """
+    Compacts this node's DB and publishes its snapshot, in the background.  Both keep track of when they were last
+    done, so this only checks (at start up, then every period) whether it's time.
+    """
+    def __init__(self, app_data_folder, period=DB_MAINTENANCE_PERIOD):
+        super().__init__()
+        self.app_data_folder = app_data_folder
+        self.period = period
+        self.exit_event = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.maintain()
+            except Exception as e:
+                latus.logger.log.exception('db maintenance : %s' % str(e))
+            if self.exit_event.wait(self.period):
+                break
+
+    def maintain(self):
+        pref = latus.preferences.Preferences(self.app_data_folder)
+        cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
+        node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), pref.get_node_id(), True)
+        node_db.maybe_compact()
+        latus.csp.snapshot.maybe_publish(node_db, cloud_folders.snapshots)
+
+    def request_exit(self, time_out=TIME_OUT):
+        """
+        :return: True if the thread has stopped
+        """
+        self.exit_event.set()
+        if self.is_alive():
+            self.join(time_out)
+        return not self.is_alive()
+
+
 class Sync:
     def __init__(self, app_data_folder):
         self.app_data_folder = app_data_folder
@@ -432,11 +530,23 @@ class Sync:
         latus.logger.log.info('crypto_key : %s , %s' % (node_id, pref.get_crypto_key()))
         latus.logger.log.info('cloud_root : %s , %s' % (node_id, pref.get_cloud_root()))
 
-        self.filter_events = []
+        self.filter_events = latus.event_filter.FilterStore()  # shared by local and cloud sync
 
+        latus.hash.init_cache(self.app_data_folder)
         self.local_sync = LocalSync(self.app_data_folder, self.filter_events)
         self.cloud_sync = CloudSync(self.app_data_folder, self.filter_events)
 
+        # a new node starts from another node's snapshot rather than replaying all of the history
+        cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
+        node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), node_id)
+        latus.csp.snapshot.bootstrap(node_db, cloud_folders.snapshots)
+
+        self.blob_gc = latus.blob_gc.BlobGC(self.app_data_folder)
+        self.db_maintenance = DBMaintenance(self.app_data_folder)
+
+        latus.miv.set_mode(pref.get_miv_mode())
+        latus.miv.init_from_watermarks(node_id, node_db.get_watermarks())
+
         if pref.get_upload_logs():
             self.usage_uploader = latus.usage.LatusUsageUploader(60*60)  # todo: make usage upload period a preference variable
             latus.logger.add_http_handler()
@@ -450,21 +560,30 @@ class Sync:
         self.cloud_sync.cloud_sync(DetectionSource.initial_scan)
         self.local_sync.start_observer()
         self.cloud_sync.start_observer()
+        self.blob_gc.start()
+        self.db_maintenance.start()
 
     def poll(self):
         self.local_sync.fs_scan(DetectionSource.periodic_poll)
-        self.cloud_sync.cloud_sync(DetectionSource.periodic_poll)
+        self.cloud_sync.sync_trigger.run_now(DetectionSource.periodic_poll)
+        self.db_maintenance.maintain()
 
     def request_exit(self):
         if self.usage_uploader:
             self.usage_uploader.request_exit()
         pref = latus.preferences.Preferences(self.app_data_folder)
-        cloud_folder = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
         node_id = pref.get_node_id()
-        node = nodedb.NodeDB(cloud_folder.nodes, node_id)
+        node = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), node_id)
         latus.logger.log.info('%s - sync - request_exit begin' % node_id)
         timed_out = self.local_sync.request_exit()
         timed_out |= self.cloud_sync.request_exit()
+        if not self.blob_gc.request_exit():
+            latus.logger.log.error('%s - sync - request_exit failed to stop blob gc' % node_id)
+            timed_out = True
+        if not self.db_maintenance.request_exit():
+            latus.logger.log.error('%s - sync - request_exit failed to stop db maintenance' % node_id)
+            timed_out = True
+        latus.hash.flush_cache()
         node.set_login(False)
         latus.logger.log.info('%s - sync - request_exit end' % node_id)
         return timed_out
@@ -0,0 +1,123 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+
+import watchdog.events
+
+from latus.const import LatusFileSystemEvent, FILTER_TIME_OUT
+
+watchdog_to_latus_events = {watchdog.events.EVENT_TYPE_MOVED: LatusFileSystemEvent.moved,
+                            watchdog.events.EVENT_TYPE_DELETED: LatusFileSystemEvent.deleted,
+                            watchdog.events.EVENT_TYPE_CREATED: LatusFileSystemEvent.created,
+                            watchdog.events.EVENT_TYPE_MODIFIED: LatusFileSystemEvent.modified}
+
+
+class FilterEvent:
+    """
+    a file system event we expect to see because we caused it
+    """
+    __slots__ = ['path', 'event', 'timestamp', 'seen_count', 'removed']
+
+    def __init__(self, path, event, timestamp):
+        self.path = path
+        self.event = event
+        self.timestamp = timestamp
+        self.seen_count = 0
+        self.removed = False
+
+    def __str__(self):
+        return 'FilterEvent(path=%s, event=%s, timestamp=%s, seen_count=%d)' % (self.path, str(self.event), self.timestamp, self.seen_count)
+
+
+class FilterStore:
+    """
+    Thread safe store of the file system events that this node causes itself (e.g. writing a file that came from
+    another node), so the watchdog handlers can filter them out.  Indexed by normalized path (and then event type), with
+    a heap for expiry, so the cost per watchdog event doesn't depend on how many filter events there are.
+    """
+    def __init__(self, time_out=FILTER_TIME_OUT, consume=True):
+        """
+        :param time_out: seconds a filter event lasts
+        :param consume: True if a filter event is removed when it filters a watchdog event, False if it filters all
+        the events for its path until it times out
+        """
+        self.time_out = time_out
+        self.consume = consume
+        self.lock = threading.Lock()
+        self.events = {}  # normalized path -> list of FilterEvent (oldest first)
+        self.expiry = []  # heap of (expiration time, sequence number, FilterEvent)
+        self.sequence = itertools.count()
+        self.count = 0
+
+    def add(self, path, event, now=None):
+        if now is None:
+            now = time.time()
+        filter_event = FilterEvent(path, event, now)
+        with self.lock:
+            self.events.setdefault(os.path.normpath(path), []).append(filter_event)
+            heapq.heappush(self.expiry, (now + self.time_out, next(self.sequence), filter_event))
+            self.count += 1
+        return filter_event
+
+    def test(self, path, event=None):
+        """
+        Test if a watchdog event should be filtered out.
+        :param path: path of the watchdog event
+        :param event: LatusFileSystemEvent of the watchdog event (None if not known)
+        :return: the FilterEvent that filters it, or None if it shouldn't be filtered
+        """
+        with self.lock:
+            filter_events = self.events.get(os.path.normpath(path))
+            if not filter_events:
+                return None
+            # prefer a filter event of the same type, then one for any type, otherwise take the oldest
+            filter_event = next((e for e in filter_events if e.event == event), None) or \
+                next((e for e in filter_events if e.event == LatusFileSystemEvent.any), filter_events[0])
+            filter_event.seen_count += 1
+            if self.consume:
+                self._remove(filter_event)
+            return filter_event
+
+    def expire(self, now=None):
+        """
+        remove filter events that have timed out
+        :return: list of the FilterEvents removed
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        with self.lock:
+            while len(self.expiry) > 0 and self.expiry[0][0] <= now:
+                filter_event = heapq.heappop(self.expiry)[2]
+                if not filter_event.removed:
+                    self._remove(filter_event)
+                    expired.append(filter_event)
+        return expired
+
+    def _remove(self, filter_event):
+        path = os.path.normpath(filter_event.path)
+        filter_events = self.events[path]
+        filter_events.remove(filter_event)  # usually only one or two per path
+        if len(filter_events) == 0:
+            del self.events[path]
+        filter_event.removed = True
+        self.count -= 1
+        # removed events are left in the expiry heap and skipped over, but don't let them build up
+        if len(self.expiry) > 2 * self.count + 100:
+            self.expiry = [e for e in self.expiry if not e[2].removed]
+            heapq.heapify(self.expiry)
+
+    def get_all(self):
+        with self.lock:
+            return [filter_event for filter_events in self.events.values() for filter_event in filter_events]
+
+    def clear(self):
+        with self.lock:
+            self.events = {}
+            self.expiry = []
+            self.count = 0
+
+    def __len__(self):
+        return self.count
@@ -1,6 +1,7 @@
 
 import collections
 import datetime
+import functools
 import logging
 import os
 import shutil
@@ -15,15 +16,21 @@ import latus.key_management
 import latus.logger
 import latus.preferences
 import latus.csp.cloud_folders
+import latus.csp.change_log
 from latus import nodedb
 import latus.util
 
 
 class ForgetButton(QPushButton):
-    def __init__(self, node, node_db, row_widgets):
+    def __init__(self, node, forget, row_widgets):
+        """
+        :param node: node ID
+        :param forget: function that removes the node's DB (or change log) from the cloud folder
+        :param row_widgets: the node's row in the dialog
+        """
         super().__init__('Forget')
         self.node = node
-        self.node_db = node_db
+        self.forget = forget
         self.row_widgets = row_widgets
         self.clicked.connect(self.do_forget)
 
@@ -34,7 +41,7 @@ class ForgetButton(QPushButton):
                                            QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
             latus.logger.log.info('forgetting : %s' % self.node)
-            self.node_db.delete()  # the database (file)
+            self.forget()
             self.hide()  # this button
             for row_widget in self.row_widgets[2:4]:
                 row_widget.setText('< Forgotten >')  # the rest of the row
@@ -46,17 +53,28 @@ class ManagementDialog(QDialog):
         super().__init__()
 
         pref = latus.preferences.Preferences(latus_app_data_folder)
-        cloud_folders = latus.folders.CloudFolders(pref.get_cloud_root())
+        cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
+        log_mode = latus.csp.change_log.is_log_mode(pref)
 
         grid_layout = QGridLayout()
         cells = [[QLabel('User Name'), QLabel('Computer Name'), QLabel('Latus Node ID'),
                   QLabel('How Long Since Last Seen'), QLabel(''), datetime.timedelta.max]]
 
-        for node in nodedb.get_existing_nodes(cloud_folders.nodes):
-            node_db = nodedb.NodeDB(cloud_folders.nodes, node)
-            row_widgets = [QLineEdit(node_db.get_user()), QLineEdit(node_db.get_computer()),
-                           QLineEdit(node)]
-            button = ForgetButton(node, node_db, row_widgets)
+        for node in sorted(latus.csp.change_log.get_node_ids(pref)):
+            if log_mode:
+                # only the change logs are in the cloud folder, so we only know who we are
+                if node == pref.get_node_id():
+                    node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), node)
+                    user, computer = node_db.get_user(), node_db.get_computer()
+                else:
+                    user, computer = '', ''
+                forget = functools.partial(shutil.rmtree, os.path.join(cloud_folders.logs, node), True)
+            else:
+                node_db = nodedb.get_node_db(cloud_folders.nodes, node)
+                user, computer = node_db.get_user(), node_db.get_computer()
+                forget = node_db.delete  # the database (file)
+            row_widgets = [QLineEdit(user), QLineEdit(computer), QLineEdit(node)]
+            button = ForgetButton(node, forget, row_widgets)
             row_widgets += [button]
             cells.append(row_widgets)
 
@@ -88,10 +106,9 @@ def main():
     latus_key = 'my_secret_latus_key'
 
     log_folder = os.path.join(root, 'log')
-    latus.util.make_dirs(log_folder)
+    os.makedirs(log_folder, exist_ok=True)
     latus.logger.init(log_folder)
     cloud_folder = os.path.join(root, 'cloud')
-    cloud_folders = latus.folders.CloudFolders(cloud_folder)
 
     preferences = {}
     node_dbs = {}
@@ -102,8 +119,9 @@ def main():
         node_id = latus.util.new_node_id()
         preferences[node].set_node_id(node_id)
         preferences[node].set_cloud_root(cloud_folder)
-        latus.util.make_dirs(cloud_folders.nodes)
-        node_dbs[node] = latus.nodedb.NodeDB(cloud_folders.nodes, node_id, True)
+        db_folder = latus.csp.change_log.get_node_db_folder(preferences[node])
+        os.makedirs(db_folder, exist_ok=True)
+        node_dbs[node] = nodedb.get_node_db(db_folder, node_id, True)
         node_dbs[node].set_user('user_' + node)  # essentially override defaults
         node_dbs[node].set_computer('computer_' + node)  # essentially override defaults
     preferences['a'].set_crypto_key(latus_key)  # a has the latus key, b and c want it
@@ -16,7 +16,7 @@ import latus.util
 import latus.crypto
 import latus.gui_wizard
 from latus import nodedb
-import latus.csp.cloud_folders
+import latus.csp.change_log
 
 
 class LineUI:
@@ -49,8 +49,7 @@ class PreferencesDialog(QDialog):
 
         # todo: self.pref and preferences are redundant - get rid of one
         self.pref = latus.preferences.Preferences(latus_appdata_folder)
-        cloud_folders = latus.csp.cloud_folders.CloudFolders(self.pref.get_cloud_root())
-        self.node_db = nodedb.NodeDB(cloud_folders.nodes, self.pref.get_node_id())
+        self.node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(self.pref), self.pref.get_node_id())
 
         super().__init__()
         self.blank = QLabel('')
@@ -13,6 +13,7 @@ import latus.preferences
 import latus.gui
 import latus.csp.sync_csp
 import latus.csp.cloud_folders
+import latus.csp.change_log
 import latus.logger
 import latus.crypto
 import latus.util
@@ -64,8 +65,7 @@ class GUIWizard(QWizard):
         pref.set_upload_logs(False)
         pref.set_upload_usage(False)
 
-        folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
-        node = nodedb.NodeDB(folders.nodes, pref.get_node_id(), write_flag=True)
+        node = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), pref.get_node_id(), write_flag=True)
         node.set_all(pref.get_node_id())
 
         # todo: write node info out to 'state' that this node is on Latus, even if it hasn't sync'd yet
@@ -247,7 +247,8 @@ class LatusKeyPage(QWizardPage):
 
         cloud_folder_field = self.field(CLOUD_FOLDER_FIELD_STRING)
         cloud_folders = latus.csp.cloud_folders.CloudFolders(cloud_folder_field)
-        existing_nodes = nodedb.get_existing_nodes(cloud_folders.nodes)
+        # (no preferences yet, so count the nodes with either a node DB or a change log in the cloud folder)
+        existing_nodes = nodedb.get_existing_nodes(cloud_folders.nodes) | latus.csp.change_log.get_log_node_ids(cloud_folders.logs)
         latus.logger.log.info('existing nodes: %s' % str(existing_nodes))
         if len(existing_nodes) > 0:
             first_time = False
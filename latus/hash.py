@@ -1,8 +1,159 @@
+import os
 import hashlib
 import time
+import threading
+import collections
 
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.pool
+
+import latus.const
+import latus.stat_index
 from latus import logger
 
+HASH_CACHE_FILE = 'hashcache' + latus.const.DB_EXTENSION
+HASH_CACHE_FLUSH_COUNT = 1000  # write the cache to disk after this many changes ...
+HASH_CACHE_FLUSH_PERIOD = 10.0  # ... or this many seconds
+
+# Reading a large buffer at a time keeps us in SHA-512 rather than in the interpreter loop (see
+# tools/benchmark_hash.py).  Each thread reuses its own buffer, and slicing the memoryview doesn't copy.
+HASH_BUFFER_SIZE = 1024 * 1024
+
+g_hash_cache = None  # see init_cache()
+g_buffers = threading.local()
+
+
+class HashCache:
+    """
+    Persistent memo of file identity to hash, so an unchanged file doesn't have to be read again to get its hash.  The
+    identity is the file's device, inode, size, mtime and ctime (plus the latus key, since that's part of the hash).
+    Size bounded - the least recently used entries are evicted.
+    """
+    def __init__(self, app_data_folder, max_entries=latus.const.HASH_CACHE_MAX_ENTRIES):
+        self.app_data_folder = app_data_folder
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(app_data_folder, exist_ok=True)
+        self.db_path = os.path.abspath(os.path.join(app_data_folder, HASH_CACHE_FILE))
+        self.db_engine = sqlalchemy.create_engine('sqlite:///' + self.db_path, poolclass=sqlalchemy.pool.QueuePool,
+                                                  pool_size=latus.const.DB_POOL_SIZE, max_overflow=-1,
+                                                  connect_args={'check_same_thread': False})
+        self.sa_metadata = sqlalchemy.MetaData()
+        self.hash_table = sqlalchemy.Table('hash', self.sa_metadata,
+                                           sqlalchemy.Column('identity', sqlalchemy.String, primary_key=True),
+                                           sqlalchemy.Column('sha512', sqlalchemy.String),
+                                           sqlalchemy.Column('last_used', sqlalchemy.Float),
+                                           )
+        self.sa_metadata.create_all(self.db_engine)
+
+        # identity -> sha512, in least to most recently used order
+        self.hashes = collections.OrderedDict()
+        with self.db_engine.connect() as conn:
+            command = self.hash_table.select().order_by(self.hash_table.c.last_used.desc()).limit(self.max_entries)
+            for row in reversed(conn.execute(command).fetchall()):
+                self.hashes[row['identity']] = row['sha512']
+
+        self.dirty = set()  # identities to write
+        self.evicted = set()  # identities to delete
+        self.last_flush = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, identity):
+        with self.lock:
+            sha512 = self.hashes.get(identity)
+            if sha512 is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.hashes.move_to_end(identity)
+            return sha512
+
+    def put(self, identity, sha512):
+        with self.lock:
+            self.hashes[identity] = sha512
+            self.hashes.move_to_end(identity)
+            self.dirty.add(identity)
+            self.evicted.discard(identity)
+            while len(self.hashes) > self.max_entries:
+                evicted_identity, _ = self.hashes.popitem(last=False)
+                self.dirty.discard(evicted_identity)
+                self.evicted.add(evicted_identity)
+            flush_needed = len(self.dirty) + len(self.evicted) >= HASH_CACHE_FLUSH_COUNT or \
+                time.time() - self.last_flush > HASH_CACHE_FLUSH_PERIOD
+        if flush_needed:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            now = time.time()
+            rows = [{'identity': identity, 'sha512': self.hashes[identity], 'last_used': now} for identity in self.dirty]
+            evicted = list(self.evicted)
+            self.dirty = set()
+            self.evicted = set()
+            self.last_flush = now
+        if len(rows) > 0 or len(evicted) > 0:
+            try:
+                with self.db_engine.connect() as conn:
+                    with conn.begin():
+                        # chunked, to stay under SQLite's limit on the number of parameters in a statement
+                        identities = evicted + [row['identity'] for row in rows]
+                        for start in range(0, len(identities), latus.const.DB_MAX_PARAMETERS):
+                            chunk = identities[start:start + latus.const.DB_MAX_PARAMETERS]
+                            conn.execute(self.hash_table.delete().where(self.hash_table.c.identity.in_(chunk)))
+                        if len(rows) > 0:
+                            conn.execute(self.hash_table.insert(), rows)
+            except sqlalchemy.exc.OperationalError as e:
+                logger.log.warn('hash cache flush : %s' % str(e))
+
+
+def init_cache(app_data_folder, max_entries=latus.const.HASH_CACHE_MAX_ENTRIES):
+    """
+    Use a persistent hash cache (in this app data folder) for calc_sha512()
+    """
+    global g_hash_cache
+    if g_hash_cache is None or g_hash_cache.app_data_folder != app_data_folder:
+        flush_cache()
+        g_hash_cache = HashCache(app_data_folder, max_entries)
+    return g_hash_cache
+
+
+def flush_cache():
+    if g_hash_cache is not None:
+        g_hash_cache.flush()
+
+
+def hash_file(f, this_hash):
+    """
+    feed an open (binary, preferably unbuffered) file into a hashlib hash
+    """
+    buffer = getattr(g_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+        g_buffers.buffer = buffer
+    size = f.readinto(buffer)
+    while size:
+        this_hash.update(buffer[:size])
+        size = f.readinto(buffer)
+
+
+def _get_identity(path, latus_key):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    key_fingerprint = hashlib.sha256(latus_key).hexdigest()[:16] if latus_key else ''
+    # ctime as well as mtime, since a write can put the mtime back (e.g. a copy that preserves times) but not the ctime
+    if stat.st_ino:
+        identity = '%d:%d:%d:%d:%d:%s' % (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns,
+                                          key_fingerprint)
+    else:
+        # file system without inode numbers - fall back to the path
+        identity = '%s:%d:%d:%d:%s' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns,
+                                       key_fingerprint)
+    return identity, max(stat.st_mtime_ns, stat.st_ctime_ns)
+
 
 def calc_sha512(path, latus_key, time_it=False):
     if time_it:
@@ -19,27 +170,37 @@ def calc_sha512(path, latus_key, time_it=False):
             latus_key = latus_key.encode()
         this_hash.update(latus_key)
 
+    hash_cache = g_hash_cache
+    identity = None
+    if hash_cache is not None:
+        identity, changed_ns = _get_identity(path, latus_key)
+        if identity is not None:
+            sha512_val = hash_cache.get(identity)
+            if sha512_val is not None:
+                if time_it:
+                    return sha512_val, time.time() - start_time
+                return sha512_val, None
+
     # execution times on sample 'big file':
     # sha512 : 0.5 sec
     # sha256 : 0.75 sec
     # md5 : 0.35 sec
     # generally SHA512 is 1.4-1.5x MD5 (experiment done on a variety of files and sizes)
 
-    # it's a lot faster taking a buffer at a time vs 1 byte at a time (2 orders of magnitude faster)
-    bucket_size = 4096 # just a guess ...
     try:
-        f = open(path, "rb")
-        val = f.read(bucket_size)
-        while len(val):
-            this_hash.update(val)
-            val = f.read(bucket_size)
-        f.close()
+        with open(path, 'rb', buffering=0) as f:
+            hash_file(f, this_hash)
     except IOError:
         logger.log.warn('hash: could not read "%s"', path)
         return None, None
 
     sha512_val = this_hash.hexdigest()
 
+    # only cache if the file didn't change while we read it, and isn't so new it could still change unnoticed
+    if identity is not None and _get_identity(path, latus_key)[0] == identity and \
+            time.time() - changed_ns / 1E9 >= latus.stat_index.RACY_TIME:
+        hash_cache.put(identity, sha512_val)
+
     if time_it:
         elapsed_time = time.time() - start_time
     else:
@@ -48,4 +209,3 @@ def calc_sha512(path, latus_key, time_it=False):
     logger.log.debug('%s : %s' % (path, sha512_val))
 
     return sha512_val, elapsed_time
-
@@ -6,7 +6,9 @@ import logging
 import logging.handlers
 import subprocess
 import shutil
-import copy
+import queue
+import threading
+import atexit
 
 import requests
 
@@ -22,6 +24,9 @@ import latus.preferences
 
 LOGGER_NAME_BASE = 'latus'
 LOG_FILE_NAME = LOGGER_NAME_BASE + '.log'
+HTTP_LOG_QUEUE_SIZE = 1000  # records waiting to go to the log server - any more are dropped
+HTTP_LOG_BATCH_SIZE = 100  # records sent per session (connection) to the log server
+HTTP_LOG_TIME_OUT = 10  # seconds
 
 log = None  # code that uses this module uses this logger
 
@@ -30,22 +35,47 @@ g_ch = None  # console handler
 g_dh = None  # dialog handler
 g_hh = None  # HTTP (log server) handler
 g_sh = None  # Sentry handler
+g_qh = None  # queue handler (the file and console handlers are run by g_listener on its own thread)
+g_queue = None
+g_listener = None
 g_appdata_folder = None
+g_node_id = None  # node_id for the log records (cached - see _get_node_id())
+g_node_id_folder = None  # appdata folder g_node_id came from
 g_base_log_file_path = None  # 'base' since the file rotator can create files based on this file name
 g_sentry_client = None
 
 
+def _get_node_id():
+    """
+    Get the node_id for log records.  It's read from the preferences once and then kept up to date via a preferences
+    change callback, so logging doesn't do a preferences lookup per record.
+    """
+    global g_node_id, g_node_id_folder
+    appdata_folder = g_appdata_folder
+    if g_node_id_folder != appdata_folder:
+        g_node_id = None
+        if latus.preferences.preferences_db_exists(appdata_folder):
+            pref = latus.preferences.Preferences(appdata_folder)
+
+            def preference_changed(key, value):
+                global g_node_id
+                if key == 'nodeid' and g_node_id_folder == appdata_folder:
+                    g_node_id = value
+
+            pref.add_change_callback(preference_changed)
+            g_node_id = pref.get_node_id()
+            g_node_id_folder = appdata_folder
+    return g_node_id
+
+
 class LatusFormatter(logging.Formatter):
     def format(self, record):
         """
         adds in the node_id, if available
         """
-        global g_appdata_folder
-        if latus.preferences.preferences_db_exists(g_appdata_folder):
-            pref = latus.preferences.Preferences(g_appdata_folder)
-            node_id = pref.get_node_id()
-            if node_id:
-                return node_id + ' : ' + super().format(record)
+        node_id = _get_node_id()
+        if node_id:
+            return node_id + ' : ' + super().format(record)
         return super().format(record)
 
 g_formatter = LatusFormatter('%(asctime)s - %(name)s - %(filename)s - %(lineno)s - %(funcName)s - %(levelname)s - %(message)s')
@@ -62,27 +92,58 @@ class DialogBoxHandlerAndExit(logging.Handler):
 class LatusHttpHandler(logging.Handler):
     """
     send the log up to the log server
+
+    Records are queued and sent by a background thread, so the caller never waits on the network.  If the queue is
+    full (e.g. the server is slow or unreachable) records are dropped - they're still in the log file.
     """
-    def __init__(self, latus_logging_url):
+    def __init__(self, latus_logging_url, max_queue_size=HTTP_LOG_QUEUE_SIZE):
         self.latus_logging_url = latus_logging_url
         super().__init__()
+        self.queue = queue.Queue(max_queue_size)
+        self.dropped_count = 0
+        self.thread = threading.Thread(target=self._send_records, name='LatusHttpHandler', daemon=True)
+        self.thread.start()
 
     def emit(self, record):
+        # record.__dict__ is essentially what HTTPHandler uses (doesn't use the string formatter)
+        info = dict(record.__dict__)
+        info['msg'] = record.getMessage()
+        info['args'] = None
+        if record.exc_info:
+            info['exc_text'] = logging.Formatter().formatException(record.exc_info)
+        info['exc_info'] = None
+        try:
+            self.queue.put_nowait(info)
+        except queue.Full:
+            self.dropped_count += 1
+
+    def _send_records(self):
+        while True:
+            infos = [self.queue.get()]
+            # send whatever else has queued up over the same connection
+            while len(infos) < HTTP_LOG_BATCH_SIZE:
+                try:
+                    infos.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with requests.Session() as session:
+                for info in infos:
+                    if info is None:
+                        return  # close()
+                    info['nodeid'] = _get_node_id()
+                    try:
+                        session.post(self.latus_logging_url, data=info, timeout=HTTP_LOG_TIME_OUT)
+                    except requests.RequestException:
+                        # drop the log on the floor if we have connection problems (it's still in the log file)
+                        pass
+
+    def close(self):
         try:
-            info = copy.deepcopy(record.__dict__)
-        except TypeError:
-            info = None
-        if info:
-            try:
-                # record.__dict__ is essentially what HTTPHandler uses
-                # (doesn't use the string formatter)
-                if latus.preferences.preferences_db_exists(g_appdata_folder):
-                    pref = latus.preferences.Preferences(g_appdata_folder)
-                    info['nodeid'] = pref.get_node_id()
-                requests.post(self.latus_logging_url, data=info)
-            except requests.ConnectionError:
-                # drop the log on the floor if we have connection problems (it's still in the log file)
-                pass
+            self.queue.put(None, timeout=HTTP_LOG_TIME_OUT)
+        except queue.Full:
+            pass
+        self.thread.join(HTTP_LOG_TIME_OUT)
+        super().close()
 
 
 def init_from_args(args):
@@ -111,7 +172,7 @@ def init(log_folder=None, delete_existing_log_files=False, backup_count=3, node_
     :param node_id: node_id
     :return: the log folder to be used
     """
-    global g_fh, g_ch, g_dh, log, g_base_log_file_path, g_appdata_folder
+    global g_fh, g_ch, g_dh, g_qh, g_queue, g_listener, log, g_base_log_file_path, g_appdata_folder
 
     if not log_folder:
         log_folder = appdirs.user_log_dir(latus.__application_name__, latus.__author__)
@@ -123,6 +184,9 @@ def init(log_folder=None, delete_existing_log_files=False, backup_count=3, node_
     
     log.setLevel(logging.DEBUG)
 
+    # if we're being re-initialized, write out what's already queued and replace the old queue
+    _stop_listener()
+
     # create file handler
     if delete_existing_log_files:
         shutil.rmtree(log_folder, ignore_errors=True)
@@ -136,14 +200,21 @@ def init(log_folder=None, delete_existing_log_files=False, backup_count=3, node_
     g_fh.setFormatter(g_formatter)
     # see fh.setLevel() below for final level - we set this so we can put the log file path in the log file itself
     g_fh.setLevel(logging.INFO)
-    log.addHandler(g_fh)
 
     # create console handler
     g_ch = logging.StreamHandler()
     g_ch.setFormatter(g_formatter)
     # see ch.setLevel() below for final level - we set this so we can display the log file path on the screen for debug
     g_ch.setLevel(logging.INFO)
-    log.addHandler(g_ch)
+
+    # The file and console handlers (and the formatting) run on the listener's thread, so logging on the sync threads
+    # is just a queue put.
+    g_queue = queue.Queue()
+    g_qh = logging.handlers.QueueHandler(g_queue)
+    g_listener = logging.handlers.QueueListener(g_queue, g_fh, g_ch, respect_handler_level=True)
+    g_listener.start()
+    _set_queue_level()
+    log.addHandler(g_qh)
 
     # create dialog box handler
     g_dh = DialogBoxHandlerAndExit()
@@ -163,10 +234,40 @@ def init(log_folder=None, delete_existing_log_files=False, backup_count=3, node_
     return log_folder
 
 
+def _stop_listener():
+    global g_qh, g_listener
+    if g_listener is not None:
+        log.removeHandler(g_qh)
+        g_listener.stop()  # processes everything already queued
+        g_fh.close()
+        g_listener = None
+        g_qh = None
+
+
+def _set_queue_level():
+    # don't bother queuing records that none of the queued handlers will write
+    if g_qh:
+        g_qh.setLevel(min(g_fh.level, g_ch.level))
+
+
+def flush():
+    """
+    wait until all the log records so far have been written to the file and console
+    """
+    if g_queue is not None and g_listener is not None:
+        g_queue.join()
+
+
+atexit.register(_stop_listener)  # registered after logging's own atexit, so this runs first
+
+
 def add_http_handler():
     global g_hh
     url = 'http://api.abel.co/latus/log'
     log.info('adding http handler %s' % url)
+    if g_hh is not None:
+        log.removeHandler(g_hh)
+        g_hh.close()
     g_hh = LatusHttpHandler(url)
     g_hh.setLevel(logging.ERROR)
     log.addHandler(g_hh)
@@ -192,6 +293,7 @@ def set_file_log_level(new_level):
         # log the new level twice so we will likely see one of them, regardless if it's going up or down
         log.info('setting file logging to %s' % logging.getLevelName(new_level))
         g_fh.setLevel(new_level)
+        _set_queue_level()
         log.info('setting file logging to %s' % logging.getLevelName(new_level))
 
 
@@ -200,6 +302,7 @@ def set_console_log_level(new_level):
         # log the new level twice so we will likely see one of them, regardless if it's going up or down
         log.info('setting console logging to %s' % logging.getLevelName(new_level))
         g_ch.setLevel(new_level)
+        _set_queue_level()
         log.info('setting console logging to %s' % logging.getLevelName(new_level))
 
 
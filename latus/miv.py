@@ -1,11 +1,13 @@
-
 import requests
 import requests.exceptions
 import time
 import logging
 import json
+import threading
 
 import latus.logger
+from latus.const import MIV_LEASE_COUNT, MIV_LEASE_TIME, MIV_OFFLINE_LEASE_TIME, MIV_REQUEST_TIMEOUT, MIV_MODE_DEFAULT, \
+    MIV_HLC_MAX_DRIFT
 
 
 """
@@ -13,15 +15,14 @@ import latus.logger
 """
 
 
-g_prior_miv = None
 g_miv_count = 0
 
 
 def _get_mivui(node_id):
     """
-    get miv as a string
+    get miv from the server
     :param node_id: node ID, mainly for debug
-    :return: miv as an integer
+    :return: miv as an integer, or None if the server couldn't be reached
     """
     global g_miv_count
     # todo: Make this https.  I get this error with https:
@@ -41,8 +42,8 @@ def _get_mivui(node_id):
         r = None
         latus.logger.log.debug('%s : starting %s' % (node_id, server))
         try:
-            r = requests.get(server)
-        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
+            r = requests.get(server, timeout=MIV_REQUEST_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
             latus.logger.log.warn(str(e))
         latus.logger.log.debug('%s : end %s' % (node_id, server))
         if r and r.status_code == 200:
@@ -58,38 +59,176 @@ def _get_mivui(node_id):
                 latus.logger.log.warn('%s : try %d : unexpected text from %s : %s' % (node_id, tries, server, json_text))
         tries += 1
     if json_text:
-        json_miv = json.loads(json_text)
-        mivui = json_miv['mivui']
+        try:
+            mivui = int(json.loads(json_text)['mivui'])
+        except (ValueError, KeyError, TypeError) as e:
+            latus.logger.log.warn('%s : bad miv from %s : %s : %s' % (node_id, server, json_text, str(e)))
 
     if mivui is None:
-        # the monotonic value from the server is based on time(), so if we can't use the server then use our local time
-        mivui = int(round(time.time() * 1E6))
-        latus.logger.log.warn('%s : could not get miv from %s - using local time() : %d' % (node_id, server, mivui))
+        latus.logger.log.warn('%s : could not get miv from %s' % (node_id, server))
 
     g_miv_count += 1
     return mivui
 
 
+class MivAllocator:
+    """
+    Hands out mivuis from a lease, so we don't have to go to the server for every event.
+
+    The server's miv is based on time (in microseconds), so a lease is the server's miv plus the (local, monotonic)
+    time elapsed since we got it.  A lease is renewed after a number of mivuis or a period of time, so we stay close to
+    the server's clock.  If the server can't be reached we lease from our local time, and don't ask the server again
+    for a while (so an offline server doesn't stall every event).  Values are strictly increasing regardless.
+    """
+    def __init__(self, lease_count=MIV_LEASE_COUNT, lease_time=MIV_LEASE_TIME, offline_lease_time=MIV_OFFLINE_LEASE_TIME,
+                 get_server_mivui=_get_mivui):
+        self.lease_count = lease_count
+        self.lease_time = lease_time
+        self.offline_lease_time = offline_lease_time
+        self.get_server_mivui = get_server_mivui
+        self.lock = threading.Lock()
+        self.prior_mivui = None
+        self.lease_base = None  # mivui at the start of the lease
+        self.lease_start = None  # time.monotonic() at the start of the lease
+        self.lease_end = None  # time.monotonic() when the lease expires
+        self.lease_remaining = 0  # mivuis left in the lease
+        self.leases = 0  # number of leases taken (mainly for testing)
+
+    def _new_lease(self, node_id):
+        mivui = self.get_server_mivui(node_id)
+        self.lease_start = time.monotonic()
+        if mivui is None:
+            # the monotonic value from the server is based on time(), so if we can't use the server then use our local time
+            mivui = int(round(time.time() * 1E6))
+            latus.logger.log.warn('%s : using local time() for miv lease : %d' % (node_id, mivui))
+            self.lease_end = self.lease_start + self.offline_lease_time
+        else:
+            self.lease_end = self.lease_start + self.lease_time
+        self.lease_base = mivui
+        self.lease_remaining = self.lease_count
+        self.leases += 1
+
+    def set_floor(self, mivui):
+        """
+        only hand out mivuis after this one (e.g. the most senior of ours from a prior run)
+        """
+        with self.lock:
+            if mivui is not None and (self.prior_mivui is None or mivui > self.prior_mivui):
+                self.prior_mivui = mivui
+
+    def get_mivui(self, node_id):
+        with self.lock:
+            if self.lease_remaining <= 0 or time.monotonic() >= self.lease_end:
+                self._new_lease(node_id)
+            self.lease_remaining -= 1
+            mivui = self.lease_base + int(round((time.monotonic() - self.lease_start) * 1E6))
+            # make sure we are actually monotonically increasing (e.g. the server's clock may be behind ours)
+            if self.prior_mivui is not None and mivui <= self.prior_mivui:
+                mivui = self.prior_mivui + 1
+            self.prior_mivui = mivui
+            return mivui
+
+
+class HybridLogicalClock:
+    """
+    Hybrid logical clock mivuis - no server needed.  A mivui is our physical time in microseconds, unless that isn't
+    greater than the last mivui we handed out or the highest mivui we've seen from other nodes, in which case it's one
+    more than that (the logical part).  So our events are ordered after any event we've seen, even if our clock is
+    behind, and the values stay close to real time (well within an int64).
+    """
+    def __init__(self, max_drift=MIV_HLC_MAX_DRIFT):
+        self.max_drift = max_drift
+        self.lock = threading.Lock()
+        self.last_mivui = 0
+
+    def get_mivui(self, node_id):
+        with self.lock:
+            self.last_mivui = max(int(round(time.time() * 1E6)), self.last_mivui + 1)
+            return self.last_mivui
+
+    def set_floor(self, mivui):
+        """
+        only hand out mivuis after this one (e.g. the most senior of ours from a prior run) - unlike observe(), however
+        far ahead of our clock it is
+        """
+        with self.lock:
+            if mivui is not None and mivui > self.last_mivui:
+                self.last_mivui = mivui
+
+    def observe(self, mivui):
+        """
+        merge in a mivui from another node
+        """
+        with self.lock:
+            if mivui is None or mivui <= self.last_mivui:
+                return
+            drift = mivui / 1E6 - time.time()
+            if drift > self.max_drift:
+                # otherwise one node with a bad clock would drag everyone's mivuis forward (possibly a long way)
+                latus.logger.log.warn('ignoring mivui %d - %.0f seconds ahead of our clock' % (mivui, drift))
+            else:
+                self.last_mivui = mivui
+
+
+g_miv_allocator = MivAllocator()
+g_hlc = HybridLogicalClock()
+g_miv_mode = MIV_MODE_DEFAULT
+
+
+def set_mode(mode):
+    """
+    :param mode: 'server' to lease mivuis from the miv server, or 'hlc' to use a hybrid logical clock
+    """
+    global g_miv_mode
+    if mode not in ('server', 'hlc'):
+        latus.logger.log.error('unknown miv mode %s - using %s' % (mode, MIV_MODE_DEFAULT))
+        mode = MIV_MODE_DEFAULT
+    g_miv_mode = mode
+
+
+def get_mode():
+    return g_miv_mode
+
+
+def observe(mivui):
+    """
+    Tell the clock about a mivui seen from another node.  Only the hybrid logical clock uses this, but it's always
+    tracked so changing the mode keeps the ordering.
+    """
+    g_hlc.observe(mivui)
+
+
+def set_floor(mivui):
+    """
+    Tell both clocks about the most senior mivui this node has already used (e.g. in a prior run).  Other nodes read
+    our changes by high-water mark, so a new mivui at or below it would never be read - and the server's clock may be
+    behind, or a prior run may have leased from our local time.
+    """
+    g_miv_allocator.set_floor(mivui)
+    g_hlc.set_floor(mivui)
+
+
+def init_from_watermarks(node_id, watermarks):
+    """
+    at start up - order our new mivuis after everything we already have (matters for the hybrid logical clock mode),
+    and always after our own
+    :param node_id: this node's ID
+    :param watermarks: our node DB's high-water marks (originator -> most senior mivui)
+    """
+    if len(watermarks) > 0:
+        observe(max(watermarks.values()))
+    set_floor(watermarks.get(node_id))
+
+
 def get_mivui(node_id):
     """
     get miv
     :param node_id: node ID, mainly for debugging
     :return: mivui as an integer
     """
-    # make sure we are actually monotonically increasing
-    global g_prior_miv
-    mivui = _get_mivui(node_id)
-    retry_count = 10
-    while g_prior_miv and mivui <= g_prior_miv and retry_count > 0:
-        time.sleep(1)
-        latus.logger.log.warn('%s : miv retry' % node_id)
-        mivui = _get_mivui(node_id)
-        retry_count -= 1
-    if retry_count <= 0:
-        mivui = None
-        latus.logger.log.fatal('%s : miv fatal' % node_id)
-    g_prior_miv = mivui
-    return mivui
+    if g_miv_mode == 'hlc':
+        return g_hlc.get_mivui(node_id)
+    return g_miv_allocator.get_mivui(node_id)
 
 if __name__ == '__main__':
     test_node_id = 'xyz'
@@ -1,17 +1,24 @@
 
 import os
+import json
 import datetime
 import platform
 import getpass
 import glob
 import time
+import sqlite3
+import threading
 
 import sqlalchemy
 import sqlalchemy.exc
+import sqlalchemy.pool
+import sqlalchemy.util
 
-from latus.const import DB_EXTENSION, ChangeAttributes
+from latus.const import DB_EXTENSION, DB_BATCH_SIZE, DB_POOL_SIZE, ChangeAttributes, LatusFileSystemEvent, COMPACTION_HISTORY, \
+    COMPACTION_INTERVAL, COMPACTION_VACUUM_PAGES, BLOB_GC_RETENTION
 import latus.logger
 import latus.util
+import latus.miv
 import latus.const
 
 # DB schema version is the latus version where this schema was first introduced.  If your DB schema is earlier
@@ -20,6 +27,119 @@ import latus.const
 __db_version__ = '0.0.3'
 
 
+g_metadata = sqlalchemy.MetaData()
+
+# general key/value store
+general_table = sqlalchemy.Table('general', g_metadata,
+                                 sqlalchemy.Column('key', sqlalchemy.String, primary_key=True),
+                                 sqlalchemy.Column('value', sqlalchemy.String),
+                                 sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
+                                 )
+
+change_table = sqlalchemy.Table('change', g_metadata,
+                                sqlalchemy.Column('index', sqlalchemy.Integer, primary_key=True),
+                                sqlalchemy.Column('mivui', sqlalchemy.Integer, index=True),
+                                sqlalchemy.Column('originator', sqlalchemy.String),
+                                sqlalchemy.Column('event_type', sqlalchemy.Integer),
+                                sqlalchemy.Column('detection', sqlalchemy.Integer),
+                                sqlalchemy.Column('file_path', sqlalchemy.String, index=True),
+                                sqlalchemy.Column('src_path', sqlalchemy.String),  # source path for moves
+                                sqlalchemy.Column('size', sqlalchemy.Integer),
+                                sqlalchemy.Column('file_hash', sqlalchemy.String, index=True),
+                                sqlalchemy.Column('mtime', sqlalchemy.DateTime),
+                                sqlalchemy.Column('pending', sqlalchemy.Boolean),
+                                sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
+                                )
+
+# per-originator lookups (e.g. the most recent entry from a given node)
+sqlalchemy.Index('ix_change_originator_mivui', change_table.c.originator, change_table.c.mivui)
+
+# what superseded a change (see NodeDB.compact()) - later changes to the same path, and moves away from it
+sqlalchemy.Index('ix_change_file_path_mivui', change_table.c.file_path, change_table.c.mivui)
+sqlalchemy.Index('ix_change_src_path_mivui', change_table.c.src_path, change_table.c.mivui)
+
+# pending work (see get_last_mivuis_info()) - a partial index, so it only holds the (usually few) pending rows
+sqlalchemy.Index('ix_change_pending', change_table.c.file_path, change_table.c.mivui, sqlite_where=change_table.c.pending)
+
+# The latest state of each path - one row per path, maintained by NodeDB.update() in the same transaction as the change
+# table.  The winning state for a path is the change with the highest mivui.  A move is the latest state of both its
+# destination (file_path) and its source (src_path).  Other than the 'path' key the columns are those of the change
+# table.
+latest_table = sqlalchemy.Table('latest', g_metadata,
+                                sqlalchemy.Column('path', sqlalchemy.String, primary_key=True),
+                                sqlalchemy.Column('index', sqlalchemy.Integer),  # index of the change row
+                                sqlalchemy.Column('mivui', sqlalchemy.Integer),
+                                sqlalchemy.Column('originator', sqlalchemy.String),
+                                sqlalchemy.Column('event_type', sqlalchemy.Integer),
+                                sqlalchemy.Column('detection', sqlalchemy.Integer),
+                                sqlalchemy.Column('file_path', sqlalchemy.String),
+                                sqlalchemy.Column('src_path', sqlalchemy.String),
+                                sqlalchemy.Column('size', sqlalchemy.Integer),
+                                sqlalchemy.Column('file_hash', sqlalchemy.String),
+                                sqlalchemy.Column('mtime', sqlalchemy.DateTime),
+                                sqlalchemy.Column('pending', sqlalchemy.Boolean),
+                                sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
+                                )
+
+folders_table = sqlalchemy.Table('folders', g_metadata,
+                                 sqlalchemy.Column('name', sqlalchemy.String, primary_key=True),
+                                 sqlalchemy.Column('encrypt', sqlalchemy.Boolean),
+                                 sqlalchemy.Column('shared', sqlalchemy.Boolean),
+                                 sqlalchemy.Column('cloud', sqlalchemy.Boolean),
+                                 sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
+                                 )
+
+
+class ChangeRecord:
+    """
+    A change (row of the change table).  The attributes are those of latus.const.ChangeAttributes, and it can also be
+    read like a change info dict (record['file_path']), including by the older names 'path', 'srcpath', 'hash' and
+    'event'.  Slotted, since replication can read a lot of these (see tools/benchmark_change_record.py).
+    """
+    __slots__ = [attribute.name for attribute in ChangeAttributes]
+    aliases = {'path': 'file_path', 'srcpath': 'src_path', 'hash': 'file_hash', 'event': 'event_type'}
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :param row: DB row with the change table's columns (in order) first
+        :return: ChangeRecord, or None if row is None
+        """
+        if row is None:
+            return None
+        return cls(*row[:len(cls.__slots__)])
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, self.aliases.get(key, key))
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self.aliases.get(key, key) in self.__slots__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, ChangeRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return 'ChangeRecord(%s)' % ', '.join('%s=%s' % (name, repr(getattr(self, name))) for name in self.__slots__)
+
+
 # A note on OS interoperability on paths:
 # We store paths in the DB MacOS/OSX/*nix style - i.e. with forward slashes
 # External to the NodeDB class the paths are in the format of the OS we are running on (Win or Mac).  They can be
@@ -36,10 +156,14 @@ class NodeDB:
         self._computer_string = 'computer'
         self._login_string = 'login'
         self._heartbeat_string = 'heartbeat'
+        self._compacted_string = 'compacted'
+        self._watermark_floor_string = 'watermarkfloor'
         self._cloud_mode = cloud_mode
 
         self.retry_count = 0
         self.node_id = node_id
+        self.write_flag = write_flag
+        self.file_identity = None
         if cloud_mode == 'csp':
             # The DB file name is based on the node id.  This is important ... this way we never have a conflict
             # writing to the DB since there is only one writer.
@@ -49,6 +173,9 @@ class NodeDB:
         else:
             raise NotImplementedError
         self.sqlite_file_path = os.path.join(db_folder, self.database_file_name)
+        # Held while allocating our own mivuis and writing them, so they're committed in mivui order.  Other nodes read
+        # this DB by high-water mark, so a mivui committed after a higher one would never be read.
+        self.write_lock = _get_write_lock(self.sqlite_file_path)
 
         if not os.path.exists(self.sqlite_file_path) and not write_flag:
             latus.logger.log.error('DB does not exist and write_flag not set, can not initialize : %s' % self.sqlite_file_path)
@@ -61,41 +188,31 @@ class NodeDB:
             except PermissionError as e:
                 latus.logger.log.error('%s : %s (%s)' % (str(e), db_folder, os.path.abspath(db_folder)))
 
-        # the 'bind' and 'connection' seem to be redundant - what do I really need????
-        # (I seem to need the bind, so perhaps I can get rid of the connection?)
-        self.db_engine = sqlalchemy.create_engine('sqlite:///' + os.path.abspath(self.sqlite_file_path))  # , echo=True)
-        self.sa_metadata = sqlalchemy.MetaData()
-        self.sa_metadata.bind = self.db_engine
-
-        # general key/value store
-        self.general_table = sqlalchemy.Table('general', self.sa_metadata,
-                                              sqlalchemy.Column('key', sqlalchemy.String, primary_key=True),
-                                              sqlalchemy.Column('value', sqlalchemy.String),
-                                              sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
-                                              )
-
-        self.change_table = sqlalchemy.Table('change', self.sa_metadata,
-                                             sqlalchemy.Column('index', sqlalchemy.Integer, primary_key=True),
-                                             sqlalchemy.Column('mivui', sqlalchemy.Integer, index=True),
-                                             sqlalchemy.Column('originator', sqlalchemy.String),
-                                             sqlalchemy.Column('event_type', sqlalchemy.Integer),
-                                             sqlalchemy.Column('detection', sqlalchemy.Integer),
-                                             sqlalchemy.Column('file_path', sqlalchemy.String, index=True),
-                                             sqlalchemy.Column('src_path', sqlalchemy.String),  # source path for moves
-                                             sqlalchemy.Column('size', sqlalchemy.Integer),
-                                             sqlalchemy.Column('file_hash', sqlalchemy.String, index=True),
-                                             sqlalchemy.Column('mtime', sqlalchemy.DateTime),
-                                             sqlalchemy.Column('pending', sqlalchemy.Boolean),
-                                             sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
-                                             )
-
-        self.folders_table = sqlalchemy.Table('folders', self.sa_metadata,
-                                              sqlalchemy.Column('name', sqlalchemy.String, primary_key=True),
-                                              sqlalchemy.Column('encrypt', sqlalchemy.Boolean),
-                                              sqlalchemy.Column('shared', sqlalchemy.Boolean),
-                                              sqlalchemy.Column('cloud', sqlalchemy.Boolean),
-                                              sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
-                                              )
+        # One engine per NodeDB.  NodeDB objects are long-lived (see get_node_db()), so keep a pool of open
+        # connections rather than reopening the SQLite file for every statement, and cache the compiled form of the
+        # statements built below.  A connection is only used by one thread at a time (however many threads use the
+        # NodeDB), but it may go back to the pool from a different thread than the one it was opened on.
+        self.db_engine = sqlalchemy.create_engine('sqlite:///' + os.path.abspath(self.sqlite_file_path),
+                                                  poolclass=sqlalchemy.pool.QueuePool, pool_size=DB_POOL_SIZE, max_overflow=-1,
+                                                  connect_args={'check_same_thread': False},
+                                                  execution_options={'compiled_cache': sqlalchemy.util.LRUCache(100)})  # , echo=True)
+        self.sa_metadata = g_metadata
+        self.general_table = general_table
+        self.change_table = change_table
+        self.latest_table = latest_table
+        self.folders_table = folders_table
+
+        # prebuilt statements for the most frequent operations
+        self._select_general = self.general_table.select().where(self.general_table.c.key == sqlalchemy.bindparam('b_key'))
+        self._select_change_by_mivui = self.change_table.select().where(self.change_table.c.mivui == sqlalchemy.bindparam('b_mivui'))
+        self._insert_change = self.change_table.insert()
+        # latest table columns in change table order, so rows read from either table look the same
+        self._select_latest = sqlalchemy.select([self.latest_table.c[c.name] for c in self.change_table.columns]).\
+            where(self.latest_table.c.path == sqlalchemy.bindparam('b_path'))
+        self._select_latest_mivui = sqlalchemy.select([self.latest_table.c.mivui]).\
+            where(self.latest_table.c.path == sqlalchemy.bindparam('b_path'))
+        self._insert_latest = self.latest_table.insert()
+        self._update_latest_state = self.latest_table.update().where(self.latest_table.c.path == sqlalchemy.bindparam('b_path'))
 
         if write_flag:
             new_schema = False
@@ -113,16 +230,96 @@ class NodeDB:
             if new_schema:
                 latus.logger.log.info('%s : start creating node DB version %s' % (node_id, __db_version__))
                 try:
-                    self.sa_metadata.drop_all()
-                    self.sa_metadata.create_all()
+                    self.sa_metadata.drop_all(self.db_engine)
+                    self.sa_metadata.create_all(self.db_engine)
                 except sqlalchemy.exc.OperationalError as e:
                     latus.logger.log.fatal(str(e))
                 self.set_all(node_id)
                 self._set_general('version', __db_version__)  # keep track of this DB version as it was created
                 latus.util.make_hidden(self.sqlite_file_path)
                 latus.logger.log.info('%s : end creating node DB version %s' % (node_id, __db_version__))
+            else:
+                self._upgrade_schema()
+
+        try:
+            self._has_latest = self.db_engine.has_table('latest')
+        except sqlalchemy.exc.OperationalError:
+            self._has_latest = False
+        self.file_identity = _get_file_identity(self.sqlite_file_path)
+
+    def _upgrade_schema(self):
+        # add what later versions added to this schema version, without losing the change history
+        if not self.db_engine.has_table('latest'):
+            latus.logger.log.info('%s : adding latest table' % self.node_id)
+            self.sa_metadata.create_all(self.db_engine, tables=[self.latest_table])
+            with self.db_engine.connect() as conn:
+                self._execute_with_retry(conn, sqlalchemy.text('CREATE INDEX IF NOT EXISTS ix_change_originator_mivui ON change (originator, mivui)'),
+                                         'upgrade_schema_index')
+            self.rebuild_latest()
+        with self.db_engine.connect() as conn:
+            self._execute_with_retry(conn, sqlalchemy.text('CREATE INDEX IF NOT EXISTS ix_change_pending ON change (file_path, mivui) WHERE pending'),
+                                     'upgrade_schema_pending_index')
+            self._execute_with_retry(conn, sqlalchemy.text('CREATE INDEX IF NOT EXISTS ix_change_file_path_mivui ON change (file_path, mivui)'),
+                                     'upgrade_schema_file_path_index')
+            self._execute_with_retry(conn, sqlalchemy.text('CREATE INDEX IF NOT EXISTS ix_change_src_path_mivui ON change (src_path, mivui)'),
+                                     'upgrade_schema_src_path_index')
+
+    def rebuild_latest(self):
+        """
+        (Re)build the latest table from the change table.
+        """
+        with self.db_engine.connect() as conn:
+            with conn.begin():
+                self._execute_with_retry(conn, self.latest_table.delete(), 'rebuild_latest_delete')
+                result = self._execute_with_retry(conn, self.change_table.select().order_by(self.change_table.c.mivui), 'rebuild_latest_select')
+                for row in result.fetchall():
+                    self._update_latest(conn, dict(row))
+
+    def _update_latest(self, conn, values):
+        """
+        update the latest table with a new change (call within the transaction that inserts the change)
+        :param conn: DB connection
+        :param values: the change row's values (including its 'index')
+        """
+        paths = [values['file_path']]
+        if values['event_type'] == int(LatusFileSystemEvent.moved) and values['src_path'] and values['src_path'] != values['file_path']:
+            paths.append(values['src_path'])
+        for path in paths:
+            row = self._execute_with_retry(conn, self._select_latest_mivui, 'update_latest_select', {'b_path': path}).fetchone()
+            latest_values = dict(values, path=path)
+            if row is None:
+                self._execute_with_retry(conn, self._insert_latest, 'update_latest_insert', latest_values)
+            elif row[0] is None or row[0] < values['mivui']:
+                latest_values['b_path'] = path
+                self._execute_with_retry(conn, self._update_latest_state, 'update_latest_update', latest_values)
+
+    def _get_latest_row(self, conn, file_path, msg):
+        # file_path must already be normalized
+        if self._has_latest:
+            result = self._execute_with_retry(conn, self._select_latest, msg, {'b_path': file_path})
+        else:
+            # a DB from an older version (e.g. another node's) - take the most senior change for this path
+            command = self.change_table.select().where(sqlalchemy.or_(self.change_table.c.file_path == file_path,
+                                                                      self.change_table.c.src_path == file_path)).\
+                order_by(self.change_table.c.mivui.desc()).limit(1)
+            result = self._execute_with_retry(conn, command, msg)
+        return result.fetchone()
+
+    def is_current(self):
+        """
+        True if the DB file is still the one this object opened.  A cloud storage client may replace the file with a new
+        one, and an open connection would keep reading the old (deleted) one.
+        :return: True if the DB file has not been replaced or removed
+        """
+        return self.file_identity is not None and self.file_identity == _get_file_identity(self.sqlite_file_path)
+
+    def dispose(self):
+        if self.db_engine is not None:
+            self.db_engine.dispose()
 
     def delete(self):
+        _forget_node_db(self)
+        self.dispose()
         if os.path.exists(self.sqlite_file_path):
             try:
                 os.remove(self.sqlite_file_path)
@@ -145,43 +342,74 @@ class NodeDB:
         conn = self.db_engine.connect()
         latus.logger.log.info('%s updating %d %s %s %s %s %s %s %s %s %s' % (self.node_id, mivui, originator, event_type, detection,
                                                                              file_path, src_path, size, file_hash, mtime, pending))
-        command = self.change_table.select().where(self.change_table.c.mivui == mivui)
-        result = self._execute_with_retry(conn, command, 'update_select')
-        if not result.fetchone():
-            if mtime:
-                command = self.change_table.insert().values(mivui=mivui, originator=originator, event_type=event_type,
-                                                            detection=detection, file_path=file_path, src_path=src_path,
-                                                            size=size, file_hash=file_hash, mtime=mtime, pending=pending,
-                                                            timestamp=datetime.datetime.utcnow())
-            else:
-                # if file has been deleted, there's no mtime (but we can't pass None into a datetime)
-                command = self.change_table.insert().values(mivui=mivui, originator=originator, event_type=event_type,
-                                                            detection=detection, file_path=file_path, src_path=src_path,
-                                                            pending=pending, timestamp=datetime.datetime.utcnow())
-            result = self._execute_with_retry(conn, command, 'update_insert')
-        else:
-            latus.logger.log.warn('mivui %d already found - not updating' % mivui)
+        with conn.begin():
+            # if file has been deleted, there's no mtime, size or hash (they are NULL)
+            values = {'mivui': mivui, 'originator': originator, 'event_type': event_type, 'detection': detection,
+                      'file_path': file_path, 'src_path': src_path, 'size': size, 'file_hash': file_hash,
+                      'mtime': mtime, 'pending': pending}
+            if not self._insert_change_row(conn, values):
+                latus.logger.log.warn('mivui %d already found - not updating' % mivui)
         conn.close()
 
+    def update_many(self, infos, pending=None, chunk_size=DB_BATCH_SIZE):
+        """
+        Add many changes, committing once per chunk rather than once per change.  Changes whose mivui is already in the
+        DB are skipped.
+        :param infos: iterable of change info (e.g. ChangeRecords)
+        :param pending: pending flag for all the changes (None to use each info's 'pending')
+        :param chunk_size: number of changes per transaction
+        :return: number of changes added
+        """
+        count = 0
+        infos = iter(infos)
+        with self.db_engine.connect() as conn:
+            chunk_done = False
+            while not chunk_done:
+                chunk_done = True
+                with conn.begin():
+                    for info in infos:
+                        values = {'mivui': info['mivui'], 'originator': info['originator'], 'event_type': info['event_type'],
+                                  'detection': info['detection'], 'file_path': norm_latus_path(info['file_path']),
+                                  'src_path': norm_latus_path(info['src_path']), 'size': info['size'],
+                                  'file_hash': info['file_hash'], 'mtime': info['mtime'],
+                                  'pending': info['pending'] if pending is None else pending}
+                        if self._insert_change_row(conn, values):
+                            count += 1
+                            if count % chunk_size == 0:
+                                chunk_done = False
+                                break  # commit this chunk
+            conn.close()
+        latus.logger.log.info('%s : update_many : added %d' % (self.node_id, count))
+        return count
+
+    def batch(self, chunk_size=DB_BATCH_SIZE):
+        """
+        Get a batch writer for this DB.  Use as a context manager - the batch writer's update() has the same parameters
+        as NodeDB.update() and the changes are written in chunks, the rest when the context exits.  A mivui of None is
+        allocated when the change is written (see NodeDBBatch).
+        :param chunk_size: number of changes per transaction
+        :return: NodeDBBatch
+        """
+        return NodeDBBatch(self, chunk_size)
+
+    def _insert_change_row(self, conn, values):
+        # call within a transaction - returns False if this mivui is already in the DB
+        result = self._execute_with_retry(conn, self._select_change_by_mivui, 'update_select', {'b_mivui': values['mivui']})
+        if result.fetchone():
+            return False
+        values['timestamp'] = datetime.datetime.utcnow()
+        result = self._execute_with_retry(conn, self._insert_change, 'update_insert', values)
+        values['index'] = result.inserted_primary_key[0]
+        if self._has_latest:
+            self._update_latest(conn, values)
+        return True
+
     def update_info(self, info, pending):
         self.update(info['mivui'], info['originator'], info['event_type'], info['detection'], info['file_path'], info['src_path'],
                     info['size'], info['file_hash'], info['mtime'], pending)
 
     def db_row_to_info(self, row):
-        entry = {}
-        entry['index'] = row[int(ChangeAttributes.index)]
-        entry['mivui'] = row[int(ChangeAttributes.mivui)]
-        entry['originator'] = row[int(ChangeAttributes.originator)]
-        entry['event_type'] = row[int(ChangeAttributes.event_type)]
-        entry['detection'] = row[int(ChangeAttributes.detection)]
-        entry['path'] = row[int(ChangeAttributes.file_path)]
-        entry['src_path'] = row[int(ChangeAttributes.src_path)]
-        entry['size'] = row[int(ChangeAttributes.size)]
-        entry['file_hash'] = row[int(ChangeAttributes.file_hash)]
-        entry['mtime'] = row[int(ChangeAttributes.mtime)]
-        entry['pending'] = row[int(ChangeAttributes.pending)]
-        entry['timestamp'] = row[int(ChangeAttributes.timestamp)]
-        return entry
+        return ChangeRecord.from_row(row)
 
     def get_database_file_name(self):
         return self.database_file_name
@@ -190,8 +418,9 @@ class NodeDB:
         return os.path.abspath(self.sqlite_file_path)
 
     def get_file_info(self, file_path):
+        file_path = norm_latus_path(file_path)
         conn = self.db_engine.connect()
-        command = self.change_table.select().where(self.change_table.c.path == file_path)
+        command = self.change_table.select().where(self.change_table.c.file_path == file_path).order_by(self.change_table.c.mivui)
         result = self._execute_with_retry(conn, command, 'get_file_info')
         updates = []
         for row in result:
@@ -200,104 +429,252 @@ class NodeDB:
         return updates
 
     def get_latest_file_info(self, file_path):
-        conn = self.db_engine.connect()
-        command = self.change_table.select().where(self.change_table.c.path == file_path)
-        result = self._execute_with_retry(conn, command, 'get_latest_file_info')
-        update = None
-        for row in result:
-            update = self.db_row_to_info(row)  # just get last one
-        conn.close()
-        return update
+        file_path = norm_latus_path(file_path)
+        with self.db_engine.connect() as conn:
+            row = self._get_latest_row(conn, file_path, 'get_latest_file_info')
+        if row is None:
+            return None
+        return self.db_row_to_info(row)
 
-    # todo: make an iterator
     def get_paths(self):
-        conn = self.db_engine.connect()
-        file_paths = set()
-        if self.change_table.exists():
-            command = self.change_table.select()
-            result = self._execute_with_retry(conn, command, 'get_paths')
-            for row in result:
-                file_path = row[int(ChangeAttributes.file_path)]
-                if file_path not in file_paths:
-                    # return the file paths in the native OS format
-                    file_paths.add(os.path.normpath(file_path))
+        return set(self.iter_paths())
+
+    def iter_paths(self, chunk_size=DB_BATCH_SIZE):
+        """
+        :param chunk_size: number of paths per query
+        :return: iterator of the (distinct) file paths in the change table, in the native OS format
+        """
+        command = sqlalchemy.select([self.change_table.c.file_path]).distinct()
+        for row in self._iter_pages(command, self.change_table.c.file_path, 'iter_paths', chunk_size):
+            yield os.path.normpath(row[0])
+
+    def iter_latest(self, chunk_size=DB_BATCH_SIZE):
+        """
+        :param chunk_size: number of paths per query
+        :return: iterator of the latest change info for each path (see latest_table), in path order
+        """
+        if self._has_latest:
+            # change table column order (for db_row_to_info()), plus the key
+            command = sqlalchemy.select([self.latest_table.c[c.name] for c in self.change_table.columns] + [self.latest_table.c.path])
+            for row in self._iter_pages(command, self.latest_table.c.path, 'iter_latest', chunk_size):
+                yield self.db_row_to_info(row)
         else:
-            latus.logger.log.warning('change_table does not exist')
-        conn.close()
-        return file_paths
+            for path in self.iter_paths(chunk_size):
+                yield self.db_row_to_info(self.get_most_recent_entry_for_path(path))
+
+    def _iter_pages(self, command, key_column, msg, chunk_size):
+        """
+        Run a select a page at a time, ordered and keyed on a unique column.  Each page is a fresh query on a fresh
+        connection, so no cursor is held open while the caller works on the rows (the caller may well write to this DB,
+        and a cursor left open would hold a read lock on the DB).
+        :param command: select command
+        :param key_column: unique column to order and page by (must be in the select)
+        :param msg: message for _execute_with_retry()
+        :param chunk_size: rows per query
+        :return: iterator of rows
+        """
+        last_key = None
+        while True:
+            page = command
+            if last_key is not None:
+                page = page.where(key_column > last_key)
+            page = page.order_by(key_column).limit(chunk_size)
+            with self.db_engine.connect() as conn:
+                rows = self._execute_with_retry(conn, page, msg).fetchall()
+            yield from rows
+            if len(rows) < chunk_size:
+                break
+            last_key = rows[-1][key_column]
 
     def get_most_recent_hash(self, file_path):
         file_path = norm_latus_path(file_path)
-        conn = self.db_engine.connect()
-        file_hash = None
-        command = self.change_table.select().where(self.change_table.c.file_path == file_path)
-        result = self._execute_with_retry(conn, command, 'get_most_recent_hash')
-        if result:
-            all_hashes = result.fetchall()
-            if all_hashes:
-                file_hash = all_hashes[-1][int(ChangeAttributes.file_hash)]
-        conn.close()
-        return file_hash
+        with self.db_engine.connect() as conn:
+            row = self._get_latest_row(conn, file_path, 'get_most_recent_hash')
+        if row is not None and row[int(ChangeAttributes.file_path)] == file_path:
+            return row[int(ChangeAttributes.file_hash)]
+        return None  # no entry, or the most recent entry is a move away from this path
 
     def get_most_recent_entry_for_path(self, non_norm_file_path):
         # get the most recent entry from either 'path' or 'src_path'
-
-        conn = self.db_engine.connect()
         file_path = norm_latus_path(non_norm_file_path)
-
-        # first the 'path' entry
-        most_recent_path = None
-        command = self.change_table.select().where(self.change_table.c.file_path == file_path)
-        result = self._execute_with_retry(conn, command, 'get_most_recent_path')
-        if result:
-            all_entries = result.fetchall()
-            if all_entries:
-                most_recent_path = all_entries[-1]
-
-        # second the 'src_path' entry
-        most_recent_src_path = None
-        command = self.change_table.select().where(self.change_table.c.src_path == file_path)
-        result = self._execute_with_retry(conn, command, 'get_most_recent_src_path')
-        if result:
-            all_entries = result.fetchall()
-            if all_entries:
-                most_recent_src_path = all_entries[-1]
-
-        conn.close()
-
-        most_recent = most_recent_path
-        if most_recent_src_path is not None and most_recent_path is not None:
-            if most_recent_src_path['mivui'] > most_recent_path['mivui']:
-                most_recent = most_recent_src_path
-
-        return most_recent
+        with self.db_engine.connect() as conn:
+            most_recent = self._get_latest_row(conn, file_path, 'get_most_recent_entry_for_path')
+        return ChangeRecord.from_row(most_recent)
 
     def get_most_recent_entry(self, originator_node_id):
-        conn = self.db_engine.connect()
-        most_recent = None
+        command = self.change_table.select()
         if originator_node_id:
-            command = self.change_table.select().where(self.change_table.c.originator == originator_node_id)
-        else:
-            command = self.change_table.select()
-        result = self._execute_with_retry(conn, command, 'get_most_recent_entry')
-        if result:
-            all_rows = result.fetchall()
-            if all_rows:
-                most_recent = all_rows[-1]
-        conn.close()
-        return most_recent
+            command = command.where(self.change_table.c.originator == originator_node_id)
+        command = command.order_by(self.change_table.c.mivui.desc()).limit(1)
+        with self.db_engine.connect() as conn:
+            most_recent = self._execute_with_retry(conn, command, 'get_most_recent_entry').fetchone()
+        return ChangeRecord.from_row(most_recent)
+
+    def get_watermarks(self):
+        """
+        Get the high-water mark of each originator - the most senior mivui this DB has from that node.  Since each node's
+        mivuis are monotonically increasing, any of a node's changes at or below its mark are already in this DB.
+        :return: dict of originator node ID to mivui
+        """
+        command = sqlalchemy.select([self.change_table.c.originator, sqlalchemy.func.max(self.change_table.c.mivui)]).\
+            group_by(self.change_table.c.originator)
+        with self.db_engine.connect() as conn:
+            result = self._execute_with_retry(conn, command, 'get_watermarks')
+            watermarks = self.get_watermark_floor()
+            for originator, mivui in result.fetchall():
+                watermarks[originator] = max(mivui, watermarks.get(originator, mivui))
+        return watermarks
+
+    def set_watermark_floor(self, watermarks):
+        """
+        Set marks that changes at or below are covered by this DB without being in the change table (e.g. it was
+        bootstrapped from a snapshot of the latest state - see latus.csp.snapshot).  get_watermarks() includes them.
+        :param watermarks: dict of originator node ID to mivui
+        """
+        self._set_general(self._watermark_floor_string, json.dumps(watermarks, sort_keys=True))
+
+    def get_watermark_floor(self):
+        value = self._get_general_if_set(self._watermark_floor_string)
+        if value is None:
+            return {}
+        return json.loads(value)
+
+    def get_infos_after(self, watermarks):
+        return list(self.iter_infos_after(watermarks))
+
+    def iter_infos_after(self, watermarks, chunk_size=DB_BATCH_SIZE):
+        """
+        Get the changes in this DB that are above the given per-originator high-water marks.
+        :param watermarks: dict of originator node ID to mivui (originators not in the dict get all their changes)
+        :param chunk_size: number of changes per query
+        :return: iterator of change infos, in mivui order per originator
+        """
+        for originator, mivui in sorted(self.get_watermarks().items()):
+            watermark = watermarks.get(originator)
+            if watermark is None or mivui > watermark:
+                command = self.change_table.select().where(self.change_table.c.originator == originator)
+                if watermark is not None:
+                    command = command.where(self.change_table.c.mivui > watermark)
+                for row in self._iter_pages(command, self.change_table.c.mivui, 'iter_infos_after', chunk_size):
+                    yield self.db_row_to_info(row)
 
     def get_rows_as_info(self):
-        # todo: make this an interator, DB must stay open so to has to have a conn passed in
-        infos = []
+        return list(self.iter_rows_as_info())
+
+    def iter_rows_as_info(self, chunk_size=DB_BATCH_SIZE):
+        """
+        :param chunk_size: number of changes per query
+        :return: iterator of all the changes, as change infos in index order
+        """
+        for row in self._iter_pages(self.change_table.select(), self.change_table.c.index, 'iter_rows_as_info', chunk_size):
+            yield self.db_row_to_info(row)
+
+    def get_referenced_hashes(self, history=BLOB_GC_RETENTION):
+        """
+        :param history: seconds of superseded changes whose contents are still wanted
+        :return: set of the file hashes referred to by the latest state of each path, pending changes and changes
+        newer than the history window
+        """
+        hashes = set(info['file_hash'] for info in self.iter_latest() if info['file_hash'] is not None)
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=history)
+        command = sqlalchemy.select([self.change_table.c.file_hash]).distinct().where(
+            sqlalchemy.and_(self.change_table.c.file_hash.isnot(None),
+                            sqlalchemy.or_(self.change_table.c.timestamp >= cutoff, self.change_table.c.pending)))
+        for row in self._iter_pages(command, self.change_table.c.file_hash, 'get_referenced_hashes', DB_BATCH_SIZE):
+            hashes.add(row[0])
+        return hashes
+
+    def is_hash_referenced(self, file_hash, history=BLOB_GC_RETENTION):
+        """
+        get_referenced_hashes() for one hash (a quick, indexed, check)
+        :return: True if the hash is in get_referenced_hashes(history)
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=history)
+        command = self.change_table.select().where(self.change_table.c.file_hash == file_hash)
         with self.db_engine.connect() as conn:
-            command = self.change_table.select()
-            result = self._execute_with_retry(conn, command, 'get_rows_as_info')
-            if result:
-                for row in result:
-                    infos.append(self.db_row_to_info(row))
-            conn.close()
-        return infos
+            rows = self._execute_with_retry(conn, command, 'is_hash_referenced').fetchall()
+        for row in rows:
+            info = self.db_row_to_info(row)
+            if info['pending'] or info['timestamp'] is None or info['timestamp'] >= cutoff:
+                return True
+            latest = self.get_latest_file_info(info['file_path'])
+            if latest is not None and latest['mivui'] == info['mivui']:
+                return True
+        return False
+
+    def compact(self, history=COMPACTION_HISTORY, vacuum_pages=COMPACTION_VACUUM_PAGES):
+        """
+        Remove the changes that have been superseded for longer than the history window, then give some of the freed
+        pages back to the file system (the DB file lives in the cloud folder, so its size is upload cost).
+
+        A change is superseded by a later (higher mivui) change to the same path - or a move away from it - and how long
+        it's been superseded goes by when the first of those was written to this DB (or when the change itself was, if
+        it arrived late), so a change that sat as the latest state for a long time isn't removed as soon as it's
+        replaced (a peer may still be about to read it).  Kept are the
+        latest state of each path (see latest_table), pending changes, each originator's most senior change (so the
+        high-water marks, and therefore what replicates, don't change) and anything superseded within the history
+        window.  Other nodes only read this DB, they read it by the high-water marks, and the delete is a single
+        transaction, so a reader sees all of the history or just the compacted form.
+        :param history: seconds of superseded changes to keep
+        :param vacuum_pages: most free pages to give back (0 for all)
+        :return: number of changes removed
+        """
+        if not self.write_flag or not self._has_latest:
+            return 0  # only our own DB, and it needs the latest table to know what's superseded
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=history)
+        latest_indexes = sqlalchemy.select([self.latest_table.c.index]).where(self.latest_table.c.index.isnot(None))
+        watermark_mivuis = sqlalchemy.select([sqlalchemy.func.max(self.change_table.c.mivui)]).group_by(self.change_table.c.originator)
+        # one indexed range (see ix_change_file_path_mivui and ix_change_src_path_mivui) per way a change is superseded
+        superseding = self.change_table.alias('superseding')
+        superseded_by_change = sqlalchemy.exists().where(sqlalchemy.and_(superseding.c.file_path == self.change_table.c.file_path,
+                                                                         superseding.c.mivui > self.change_table.c.mivui,
+                                                                         superseding.c.timestamp < cutoff))
+        superseded_by_move = sqlalchemy.exists().where(sqlalchemy.and_(superseding.c.src_path == self.change_table.c.file_path,
+                                                                       superseding.c.mivui > self.change_table.c.mivui,
+                                                                       superseding.c.timestamp < cutoff))
+        command = self.change_table.delete().where(sqlalchemy.and_(self.change_table.c.timestamp < cutoff,
+                                                                   sqlalchemy.or_(superseded_by_change, superseded_by_move),
+                                                                   sqlalchemy.not_(self.change_table.c.pending),
+                                                                   self.change_table.c.index.notin_(latest_indexes),
+                                                                   self.change_table.c.mivui.notin_(watermark_mivuis)))
+        with self.db_engine.connect() as conn:
+            with conn.begin():
+                removed = self._execute_with_retry(conn, command, 'compact').rowcount
+        self._vacuum(vacuum_pages)
+        self._set_general(self._compacted_string, datetime.datetime.utcnow().isoformat())
+        latus.logger.log.info('%s : compact : removed %d changes' % (self.node_id, removed))
+        return removed
+
+    def maybe_compact(self, interval=COMPACTION_INTERVAL):
+        """
+        compact() if it hasn't been done in the last interval (it rewrites the DB, so don't do it often)
+        :return: number of changes removed (None if it wasn't time)
+        """
+        if not self.write_flag:
+            return None
+        value = self._get_general_if_set(self._compacted_string)
+        if value is not None:
+            try:
+                compacted = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+            except ValueError:
+                compacted = None
+            if compacted is not None and (datetime.datetime.utcnow() - compacted).total_seconds() < interval:
+                return None
+        return self.compact()
+
+    def _vacuum(self, pages):
+        with self.db_engine.connect() as conn:
+            if self._execute_with_retry(conn, sqlalchemy.text('PRAGMA auto_vacuum'), 'vacuum_mode').scalar() != 2:
+                # switching an existing DB to incremental needs one full VACUUM
+                latus.logger.log.info('%s : switching to incremental vacuum' % self.node_id)
+                self._execute_with_retry(conn, sqlalchemy.text('PRAGMA auto_vacuum = INCREMENTAL'), 'vacuum_set_mode')
+                self._execute_with_retry(conn, sqlalchemy.text('VACUUM'), 'vacuum_full')
+            elif self._execute_with_retry(conn, sqlalchemy.text('PRAGMA freelist_count'), 'vacuum_free').scalar() > 0:
+                # run by sqlite3 as a script - executed as a statement the pragma only frees one page
+                try:
+                    conn.connection.executescript('PRAGMA incremental_vacuum(%d)' % pages)
+                except sqlite3.OperationalError as e:
+                    latus.logger.log.warn('%s : incremental vacuum : %s' % (self.node_id, str(e)))
 
     # useful for testing DB access contention
     def get_retry_count(self):
@@ -305,11 +682,14 @@ class NodeDB:
 
     # Tolerate situations where multiple nodes try to access one DB (this will happen, albeit rarely, in
     # normal operation).
-    def _execute_with_retry(self, conn, command, msg=None):
+    def _execute_with_retry(self, conn, command, msg=None, params=None):
         result = None
         while result is None:
             try:
-                result = conn.execute(command)
+                if params is None:
+                    result = conn.execute(command)
+                else:
+                    result = conn.execute(command, params)
             except sqlalchemy.exc.OperationalError:
                 self.retry_count += 1
                 latus.logger.log.info('%s : execute retry : %s : %s : %d' % (self.node_id, str(command), str(msg), self.retry_count))
@@ -327,8 +707,7 @@ class NodeDB:
         conn = self.db_engine.connect()
         val = None
         timestamp = None
-        command = self.general_table.select().where(self.general_table.c.key == key)
-        result = self._execute_with_retry(conn, command, ('node DB get', key))
+        result = self._execute_with_retry(conn, self._select_general, ('node DB get', key), {'b_key': key})
         if result:
             row = result.fetchone()
             if row:
@@ -342,6 +721,14 @@ class NodeDB:
             timestamp = None
         return val, timestamp
 
+    def _get_general_if_set(self, key):
+        # like _get_general(), but a key that hasn't been set is not an error
+        with self.db_engine.connect() as conn:
+            row = self._execute_with_retry(conn, self._select_general, ('node DB get', key), {'b_key': key}).fetchone()
+        if row is None:
+            return None
+        return row[1]
+
     def _set_general(self, key, value):
         # todo: I noticed that sometimes somehow this test for doesn't exist fails - i.e. it says it doesn't
         # exist and it actually does, then the insert() causes a unique key exception.  Somehow this
@@ -350,8 +737,7 @@ class NodeDB:
             latus.logger.log.warn('_set_general: db_engine is None')
             return None
         conn = self.db_engine.connect()
-        select_command = self.general_table.select().where(self.general_table.c.key == key)
-        select_result = self._execute_with_retry(conn, select_command, ('set', key, value))
+        select_result = self._execute_with_retry(conn, self._select_general, ('set', key, value), {'b_key': key})
         do_insert = True
         if select_result:
             row = select_result.fetchone()
@@ -411,49 +797,46 @@ class NodeDB:
         return self._get_general(self._login_string)  # tuple of (is_logged_in, login_timestamp)
 
     def get_last_mivui(self, file_path):
+        file_path = norm_latus_path(file_path)
         with self.db_engine.connect() as conn:
-            q_cmd = self.change_table.select().where(self.change_table.c.path == file_path)
-            q_result = self._execute_with_retry(conn, q_cmd, 'get_last_mivui')
-            all_rows = q_result.fetchall()
-            if all_rows:
-                last = all_rows[-1]
-                last_mivui = last[0]
-            else:
-                last_mivui = -1
-                conn.close()
-            return last_mivui
-
-    def get_last_mivuis_info(self):
-        # todo: make this an interator, DB must stay open so to has to have a conn passed in
-        infos = []
-        with self.db_engine.connect() as conn:
-
-            # get all the paths that have a pending
-            paths_pending = set()
-            cmd = self.change_table.select().where(self.change_table.c.pending).distinct(self.change_table.c.path)
-            result = self._execute_with_retry(conn, cmd, 'get_last_mivuis_info_0')
-            if result:
-                for row in result.fetchall():
-                    paths_pending.add(row[int(ChangeAttributes.path)])
-
-            # get the last entry for each path
-            for path in paths_pending:
-                q_cmd = self.change_table.select().where(sqlalchemy.and_(self.change_table.c.path == path, self.change_table.c.pending))
-                q_result = self._execute_with_retry(conn, q_cmd, 'get_last_mivuis_info_1')
-                all_rows = q_result.fetchall()
-                if all_rows:
-                    # get the most senior miv entry for each path
-                    all_rows = sorted(all_rows, key=lambda x: x[int(ChangeAttributes.mivui)])
-                    last = all_rows[-1]
-                    infos.append(self.db_row_to_info(last))
-            conn.close()
-
-        return infos
+            row = self._get_latest_row(conn, file_path, 'get_last_mivui')
+        if row is None:
+            return -1
+        return row[int(ChangeAttributes.mivui)]
+
+    def get_last_mivuis_info(self, page_size=DB_BATCH_SIZE):
+        """
+        Get the most senior pending change for each path, in path order.  This is an iterator - the DB is read a page at
+        a time (with a fresh query per page, keyed on the last path returned), so the caller can clear pendings as it
+        goes and a large backlog isn't all read into memory.
+        :param page_size: number of paths per query
+        :return: iterator of change infos
+        """
+        # the most senior pending mivui of each path, joined back to the change table to get the rest of the row
+        pending = sqlalchemy.select([self.change_table.c.file_path, sqlalchemy.func.max(self.change_table.c.mivui).label('mivui')]).\
+            where(self.change_table.c.pending).group_by(self.change_table.c.file_path)
+        last_path = None
+        while True:
+            page = pending
+            if last_path is not None:
+                page = page.where(self.change_table.c.file_path > last_path)
+            page = page.order_by(self.change_table.c.file_path).limit(page_size).alias('pending_page')
+            command = sqlalchemy.select([self.change_table]).\
+                select_from(self.change_table.join(page, sqlalchemy.and_(self.change_table.c.file_path == page.c.file_path,
+                                                                         self.change_table.c.mivui == page.c.mivui))).\
+                order_by(self.change_table.c.file_path)
+            with self.db_engine.connect() as conn:
+                rows = self._execute_with_retry(conn, command, 'get_last_mivuis_info').fetchall()
+            for row in rows:
+                yield self.db_row_to_info(row)
+            if len(rows) < page_size:
+                break
+            last_path = rows[-1][int(ChangeAttributes.file_path)]
 
     def get_info_from_path_and_mivui(self, path, mivui):
         with self.db_engine.connect() as conn:
             path = norm_latus_path(path)  # paths are stored in DB as latus normalized paths
-            q_cmd = self.change_table.select().where(sqlalchemy.and_(self.change_table.c.mivui == mivui, self.change_table.c.path == path))
+            q_cmd = self.change_table.select().where(sqlalchemy.and_(self.change_table.c.mivui == mivui, self.change_table.c.file_path == path))
             q_result = self._execute_with_retry(conn, q_cmd, 'get_info_from_path_and_mivui')
             # todo: check that there is indeed only one entry returned
             if q_result:
@@ -467,25 +850,27 @@ class NodeDB:
         return None
 
     def any_pendings(self, path):
+        path = norm_latus_path(path)
         any_pending_flag = False
         with self.db_engine.connect() as conn:
-            cmd = self.change_table.select().where(sqlalchemy.and_(self.change_table.c.path == path, self.change_table.c.pending == True))
+            cmd = self.change_table.select().where(sqlalchemy.and_(self.change_table.c.file_path == path, self.change_table.c.pending == True)).limit(1)
             result = self._execute_with_retry(conn, cmd, 'any_pendings')
-            rows = result.fetchall()
-            if len(rows) > 0:
+            if result.fetchone() is not None:
                 any_pending_flag = True
             conn.close()
         return any_pending_flag
 
     def clear_pending(self, info):
+        # mivui is unique in this DB (see update())
         with self.db_engine.connect() as conn:
-            result = None
-            stmt = self.change_table.update().values(pending=False).where(self.change_table.c.file_path == info['file_path'] and
-                                                                          self.change_table.c.mivui == info['mivui'])
-            result = self._execute_with_retry(conn, stmt, 'clear_pending')
-            if not result:
-                latus.logger.log.error('clear_pending of %s %s failed' % (info['path'], info['mivui']))
-
+            with conn.begin():
+                stmt = self.change_table.update().values(pending=False).where(self.change_table.c.mivui == info['mivui'])
+                result = self._execute_with_retry(conn, stmt, 'clear_pending')
+                if not result:
+                    latus.logger.log.error('clear_pending of %s failed' % info['mivui'])
+                if self._has_latest:
+                    stmt = self.latest_table.update().values(pending=False).where(self.latest_table.c.mivui == info['mivui'])
+                    self._execute_with_retry(conn, stmt, 'clear_pending_latest')
             conn.close()
 
     def get_folder_preferences_from_path(self, partial_path):
@@ -538,6 +923,47 @@ class NodeDB:
         return True
 
 
+class NodeDBBatch:
+    """
+    Collects changes for a NodeDB and writes them with update_many() (see NodeDB.batch()).
+
+    Changes given a mivui of None get one when they're written, under the DB's write_lock - a mivui handed out when the
+    change was collected could be below one that another thread has committed in the meantime (and other nodes, having
+    read up to that, would never read it).
+    """
+    def __init__(self, node_db, chunk_size):
+        self.node_db = node_db
+        self.chunk_size = chunk_size
+        self.infos = []
+        self.count = 0  # number of changes written
+
+    def update(self, mivui, originator, event_type, detection, file_path, src_path, size, file_hash, mtime, pending):
+        self.infos.append({'mivui': mivui, 'originator': originator, 'event_type': event_type, 'detection': detection,
+                           'file_path': file_path, 'src_path': src_path, 'size': size, 'file_hash': file_hash,
+                           'mtime': mtime, 'pending': pending})
+        if len(self.infos) >= self.chunk_size:
+            self.flush()
+
+    def update_info(self, info, pending):
+        self.update(info['mivui'], info['originator'], info['event_type'], info['detection'], info['file_path'], info['src_path'],
+                    info['size'], info['file_hash'], info['mtime'], pending)
+
+    def flush(self):
+        if len(self.infos) > 0:
+            with self.node_db.write_lock:
+                for info in self.infos:
+                    if info['mivui'] is None:
+                        info['mivui'] = latus.miv.get_mivui(info['originator'])
+                self.count += self.node_db.update_many(self.infos, chunk_size=self.chunk_size)
+            self.infos = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+
 def get_existing_nodes(cloud_node_db_folder):
     node_db_files = glob.glob(os.path.join(cloud_node_db_folder, '*' + DB_EXTENSION))
     return set(os.path.basename(p).split('.')[0] for p in node_db_files)
@@ -548,14 +974,81 @@ def get_node_id_from_db_file_path(db_file_path):
     return os.path.basename(db_file_path)[:-ext_len]
 
 
+g_node_dbs = {}  # (db folder, node_id, cloud_mode) -> NodeDB
+g_node_dbs_lock = threading.Lock()
+g_write_locks = {}  # abs path of DB file -> lock (see NodeDB.write_lock) - per file, so it outlives a replaced NodeDB
+g_write_locks_lock = threading.Lock()
+
+
+def _get_write_lock(sqlite_file_path):
+    key = os.path.abspath(sqlite_file_path)
+    with g_write_locks_lock:
+        if key not in g_write_locks:
+            g_write_locks[key] = threading.RLock()
+        return g_write_locks[key]
+
+
+def get_node_db(db_folder, node_id, write_flag=False, cloud_mode='csp'):
+    """
+    Get the long-lived NodeDB for a DB folder and node.  The NodeDB (and its engine) is created on first use and then
+    reused, unless the DB file has since been replaced or removed.
+    :param db_folder: folder the node DB is in
+    :param node_id: node ID
+    :param write_flag: True to create the DB (and tables) if necessary
+    :param cloud_mode: 'csp' or 'aws'
+    :return: a NodeDB
+    """
+    key = (os.path.abspath(db_folder), node_id, cloud_mode)
+    with g_node_dbs_lock:
+        node_db = g_node_dbs.get(key)
+        if node_db is not None and (not node_db.is_current() or (write_flag and not node_db.write_flag)):
+            node_db.dispose()
+            del g_node_dbs[key]
+            node_db = None
+        if node_db is None:
+            node_db = NodeDB(db_folder, node_id, write_flag, cloud_mode)
+            if node_db.db_engine is not None:
+                g_node_dbs[key] = node_db
+        return node_db
+
+
+def _forget_node_db(node_db):
+    with g_node_dbs_lock:
+        for key in [k for k, v in g_node_dbs.items() if v is node_db]:
+            del g_node_dbs[key]
+
+
+def _get_file_identity(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
 def sync_dbs(cloud_node_folder, source_node_id, destination_node_id):
-    source_node_db = NodeDB(cloud_node_folder, source_node_id)
-    destination_node_db = NodeDB(cloud_node_folder, destination_node_id)
-    source_infos = source_node_db.get_rows_as_info()
-    for source_info in source_infos:
-        dest_info = destination_node_db.get_info_from_path_and_mivui(source_info['path'], source_info['mivui'])
-        if dest_info is None:
-            destination_node_db.update_info(source_info, True)  # mark as pending
+    """
+    Copy into the destination node DB the changes from the source node DB that it doesn't have yet.  Only changes above
+    the destination's per-originator high-water marks are read, and they are streamed (and written) in chunks.
+    :return: number of changes copied
+    """
+    source_node_db = get_node_db(cloud_node_folder, source_node_id)
+    destination_node_db = get_node_db(cloud_node_folder, destination_node_id)
+    if source_node_db.db_engine is None or destination_node_db.db_engine is None:
+        return 0
+    max_mivui = None
+
+    def source_infos():
+        nonlocal max_mivui
+        for info in source_node_db.iter_infos_after(destination_node_db.get_watermarks()):
+            if max_mivui is None or info['mivui'] > max_mivui:
+                max_mivui = info['mivui']
+            yield info
+
+    count = destination_node_db.update_many(source_infos(), True)  # mark as pending
+    if max_mivui is not None:
+        latus.miv.observe(max_mivui)
+    return count
 
 
 def norm_latus_path(path):
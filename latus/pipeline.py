@@ -0,0 +1,40 @@
+import os
+import collections
+import concurrent.futures
+
+# hashing (hashlib) and encryption (cryptography) release the GIL, so threads are enough to use all the cores
+SCAN_WORKERS = os.cpu_count() or 1
+SCAN_IN_FLIGHT_PER_WORKER = 4  # bounds memory and how far the walk gets ahead of the workers
+
+
+def ordered_map(function, items, workers=None, max_in_flight=None):
+    """
+    Like map(), except function is run on a thread pool.  Results are yielded in the same order as items, and only a
+    bounded number of items are submitted but not yet yielded, so items can be a (long) generator.  Any exception
+    raised by function is raised here.
+    :param function: called with each item (run on a worker thread)
+    :param items: iterable of items (consumed on the caller's thread)
+    :param workers: number of worker threads (default is the number of cores)
+    :param max_in_flight: maximum number of outstanding items (default is a small multiple of workers)
+    :return: generator of (item, result) tuples
+    """
+    if workers is None:
+        workers = SCAN_WORKERS
+    if max_in_flight is None:
+        max_in_flight = workers * SCAN_IN_FLIGHT_PER_WORKER
+    in_flight = collections.deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in items:
+            in_flight.append((item, executor.submit(function, item)))
+            if len(in_flight) >= max_in_flight:
+                item, future = in_flight.popleft()
+                yield item, future.result()
+        while len(in_flight) > 0:
+            item, future = in_flight.popleft()
+            yield item, future.result()
+    finally:
+        # if the caller stopped early (or there was an exception) don't start any more work
+        for _, future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=True)
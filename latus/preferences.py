@@ -1,6 +1,7 @@
 
 import os
 import datetime
+import threading
 
 import sqlalchemy
 import sqlalchemy.orm
@@ -31,6 +32,95 @@ class PreferencesTable(Base):
     datetime = sqlalchemy.Column(sqlalchemy.DateTime())
 
 
+class _PreferencesStore:
+    """
+    In-memory copy of one preferences DB, shared by every Preferences object for that DB in this process.  The
+    SQLAlchemy engine is created once and the values are read once, then re-read only when the DB file changes on disk
+    (i.e. another process wrote to it).
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.engine = sqlalchemy.create_engine('sqlite:///' + self.db_path)  # , echo=True)
+        self.Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
+        self.lock = threading.RLock()
+        self.values = None  # key -> value, None if not yet loaded
+        self.signature = None  # DB file signature at the time values were loaded
+        self.callbacks = []
+
+    def _get_signature(self):
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _load(self):
+        signature = self._get_signature()
+        values = {}
+        session = self.Session()
+        try:
+            for row in session.query(PreferencesTable):
+                values[row.key] = row.value
+        except sqlalchemy.exc.OperationalError:
+            pass  # no DB (or table) yet
+        session.close()
+        old_values = self.values
+        self.values = values
+        self.signature = signature
+        if old_values is not None:
+            for key in set(old_values) | set(values):
+                if old_values.get(key) != values.get(key):
+                    self._notify(key, values.get(key))
+
+    def _notify(self, key, value):
+        for callback in self.callbacks:
+            try:
+                callback(key, value)
+            except Exception as e:
+                latus.logger.log.warn('preferences change callback error : %s : %s' % (key, str(e)))
+
+    def create_tables(self):
+        with self.lock:
+            Base.metadata.create_all(self.engine)
+            self.signature = None  # force a re-read
+
+    def get(self, key):
+        with self.lock:
+            if self.values is None or self._get_signature() != self.signature:
+                self._load()
+            return self.values.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            session = self.Session()
+            pref_table = PreferencesTable(key=key, value=value, datetime=datetime.datetime.utcnow())
+            q = session.query(PreferencesTable).filter_by(key=key).first()
+            if q:
+                session.delete(q)
+            session.add(pref_table)
+            session.commit()
+            session.close()
+            # write-through: re-read so the cache holds the value as the DB stores it (this also notifies of changes)
+            self._load()
+
+    def add_callback(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+
+g_stores = {}  # preferences DB path -> _PreferencesStore
+g_stores_lock = threading.Lock()
+
+
+def _get_store(db_path):
+    with g_stores_lock:
+        store = g_stores.get(db_path)
+        if store is None:
+            store = _PreferencesStore(db_path)
+            g_stores[db_path] = store
+        return store
+
+
 class Preferences:
 
     def __init__(self, latus_appdata_folder, init=False):
@@ -48,6 +138,9 @@ class Preferences:
         self._upload_logs_string = 'uploadlogs'
         self._version_key_string = 'version'
         self._verbose_string = 'verbose'
+        self._miv_mode_string = 'mivmode'
+        self._replication_string = 'replication'
+        self._cache_max_bytes_string = 'cachemaxbytes'
 
         self._cloud_mode = None
 
@@ -57,41 +150,27 @@ class Preferences:
         self.app_data_folder = latus_appdata_folder
         os.makedirs(self.app_data_folder, exist_ok=True)
         self.__db_path = os.path.abspath(os.path.join(self.app_data_folder, PREFERENCES_FILE))
-        sqlite_path = 'sqlite:///' + self.__db_path
-        self.__db_engine = sqlalchemy.create_engine(sqlite_path)  # , echo=True)
         # todo: check the version in the DB against the current __version__ to see if we need to force a drop table
         # (since this schema is so simple, we probably won't ever have to do this)
+        self.__store = _get_store(self.__db_path)
         if init:
-            Base.metadata.create_all(self.__db_engine)
-        self.__Session = sqlalchemy.orm.sessionmaker(bind=self.__db_engine)
-        if init:
+            self.__store.create_tables()
             latus.logger.log.info('creating preferences DB version %s' % __db_version__)
             self._pref_set(self._version_key_string, __db_version__)
 
     def _pref_set(self, key, value):
         latus.logger.log.debug('pref_set : %s to %s' % (str(key), str(value)))
-        session = self.__Session()
-        pref_table = PreferencesTable(key=key, value=value, datetime=datetime.datetime.utcnow())
-        q = session.query(PreferencesTable).filter_by(key=key).first()
-        if q:
-            session.delete(q)
-        session.add(pref_table)
-        session.commit()
-        session.close()
+        self.__store.set(key, value)
 
     def _pref_get(self, key):
-        # latus.logger.log.debug('pref_get : %s' % str(key))
-        value = None
-        session = self.__Session()
-        try:
-            row = session.query(PreferencesTable).filter_by(key=key).first()
-        except sqlalchemy.exc.OperationalError as e:
-            row = None
-        if row:
-            value = row.value
-        session.close()
-        # latus.logger.log.debug('pref_get : %s' % str(value))
-        return value
+        return self.__store.get(key)
+
+    def add_change_callback(self, callback):
+        """
+        Register a function to be called when a preference changes, either through this process or on disk.
+        :param callback: callable taking (key, value)
+        """
+        self.__store.add_callback(callback)
 
     def set_crypto_key(self, key):
         self._pref_set(self._key_string, key)
@@ -159,6 +238,42 @@ class Preferences:
     def get_node_id(self):
         return self._pref_get(self._id_string)
 
+    def set_miv_mode(self, mode):
+        """
+        :param mode: 'server' (the default) or 'hlc' (see latus.miv)
+        """
+        self._pref_set(self._miv_mode_string, mode)
+
+    def get_miv_mode(self):
+        mode = self._pref_get(self._miv_mode_string)
+        if mode is None:
+            mode = latus.const.MIV_MODE_DEFAULT
+        return mode
+
+    def set_replication(self, replication):
+        """
+        :param replication: 'db' (the default) or 'log' (see latus.csp.change_log)
+        """
+        self._pref_set(self._replication_string, replication)
+
+    def get_replication(self):
+        replication = self._pref_get(self._replication_string)
+        if replication is None:
+            replication = latus.const.REPLICATION_DEFAULT
+        return replication
+
+    def set_cache_max_bytes(self, max_bytes):
+        """
+        :param max_bytes: size budget of the local (AWS mode) blob cache (see latus.blob_cache)
+        """
+        self._pref_set(self._cache_max_bytes_string, str(int(max_bytes)))
+
+    def get_cache_max_bytes(self):
+        max_bytes = self._pref_get(self._cache_max_bytes_string)
+        if max_bytes is None:
+            return latus.const.CACHE_MAX_BYTES_DEFAULT
+        return int(max_bytes)
+
     def get_db_path(self):
         return self.__db_path
 
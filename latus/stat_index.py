@@ -0,0 +1,142 @@
+import os
+import time
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.pool
+
+import latus.logger
+import latus.const
+import latus.nodedb
+
+STAT_INDEX_FILE = 'statindex' + latus.const.DB_EXTENSION
+
+# A file whose mtime is this close to when it was stat'ed may still be written to within the same mtime tick, so its
+# stat can't be trusted to tell us if it has changed later (the "racy" case).
+RACY_TIME = 2.0  # seconds
+
+g_metadata = sqlalchemy.MetaData()
+
+stat_table = sqlalchemy.Table('stat', g_metadata,
+                              sqlalchemy.Column('path', sqlalchemy.String, primary_key=True),
+                              sqlalchemy.Column('size', sqlalchemy.Integer),
+                              sqlalchemy.Column('mtime_ns', sqlalchemy.Integer),
+                              sqlalchemy.Column('inode', sqlalchemy.Integer),
+                              sqlalchemy.Column('ctime_ns', sqlalchemy.Integer),
+                              )
+
+
+def get_stat_signature(full_path):
+    """
+    get the stat values that tell us if a file has changed
+    :param full_path: path to the file
+    :return: tuple of (size, mtime_ns, inode, ctime_ns), or None if the file can't be stat'ed
+    """
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_ctime_ns
+
+
+def is_racy(signature, now=None):
+    """
+    True if the file may have been modified right after this signature was taken without the signature changing
+    :param signature: from get_stat_signature()
+    :param now: time the signature was taken (default is now)
+    :return: True if the signature can't be trusted
+    """
+    if now is None:
+        now = time.time()
+    return now - signature[1] / 1E9 < RACY_TIME
+
+
+class StatIndex:
+    """
+    The stat signature of each file under the latus folder as of the last time it was scanned, so a scan only needs to
+    hash the files whose signature has changed.  This is kept locally (in the app data folder), not in the cloud.
+    """
+    def __init__(self, app_data_folder):
+        os.makedirs(app_data_folder, exist_ok=True)
+        self.db_path = os.path.abspath(os.path.join(app_data_folder, STAT_INDEX_FILE))
+        self.db_engine = sqlalchemy.create_engine('sqlite:///' + self.db_path, poolclass=sqlalchemy.pool.QueuePool,
+                                                  pool_size=latus.const.DB_POOL_SIZE, max_overflow=-1,
+                                                  connect_args={'check_same_thread': False})
+        g_metadata.create_all(self.db_engine)
+
+    def scan(self):
+        """
+        Start a scan.  Use as a context manager - see StatIndexScan.
+        :return: StatIndexScan
+        """
+        return StatIndexScan(self)
+
+    def get_all(self):
+        with self.db_engine.connect() as conn:
+            result = conn.execute(stat_table.select())
+            signatures = {row['path']: (row['size'], row['mtime_ns'], row['inode'], row['ctime_ns']) for row in result.fetchall()}
+        return signatures
+
+    def write(self, signatures, remove_paths):
+        """
+        :param signatures: dict of path to signature to write
+        :param remove_paths: paths to remove from the index
+        """
+        with self.db_engine.connect() as conn:
+            with conn.begin():
+                for path in remove_paths:
+                    conn.execute(stat_table.delete().where(stat_table.c.path == path))
+                if len(signatures) > 0:
+                    paths = list(signatures)
+                    for start in range(0, len(paths), latus.const.DB_MAX_PARAMETERS):
+                        conn.execute(stat_table.delete().where(stat_table.c.path.in_(paths[start:start + latus.const.DB_MAX_PARAMETERS])))
+                    conn.execute(stat_table.insert(), [{'path': path, 'size': s[0], 'mtime_ns': s[1], 'inode': s[2], 'ctime_ns': s[3]}
+                                                       for path, s in signatures.items()])
+
+    def clear(self):
+        with self.db_engine.connect() as conn:
+            conn.execute(stat_table.delete())
+
+
+class StatIndexScan:
+    """
+    One pass over the latus folder.  The index is read once at the start, and the new signatures are written when the
+    context exits (if the scan completed - otherwise nothing is), and entries for files not seen are removed.
+    """
+    def __init__(self, stat_index):
+        self.stat_index = stat_index
+        self.previous = None
+        self.signatures = {}
+        self.seen = set()
+
+    def __enter__(self):
+        self.previous = self.stat_index.get_all()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # e.g. the node DB batch wasn't written, so the changes recorded here may not be in the DB - leave the index
+            # as it was, so the next scan looks at these files again
+            latus.logger.log.warn('stat index : scan failed - not updating the index')
+            return
+        try:
+            self.stat_index.write(self.signatures, set(self.previous) - self.seen)
+        except sqlalchemy.exc.OperationalError as e:
+            latus.logger.log.warn('could not write stat index : %s' % str(e))
+
+    def unchanged(self, partial_path, signature):
+        """
+        True if the file's signature is the same as the last scan's (i.e. it doesn't need to be hashed)
+        :param partial_path: path relative to the latus folder
+        :param signature: from get_stat_signature()
+        """
+        partial_path = latus.nodedb.norm_latus_path(partial_path)
+        self.seen.add(partial_path)
+        return signature is not None and self.previous.get(partial_path) == signature
+
+    def update(self, partial_path, signature):
+        """
+        record the file's signature (call once the file's current state has been recorded in the node DB)
+        """
+        if signature is not None and not is_racy(signature):
+            self.signatures[latus.nodedb.norm_latus_path(partial_path)] = signature
@@ -16,7 +16,7 @@ import latus.logger
 import latus.preferences
 from latus import nodedb
 import latus.util
-import latus.csp.cloud_folders
+import latus.csp.change_log
 
 
 def anonymize(s):
@@ -52,8 +52,7 @@ class LatusUsageInfo:
         yield ('ip', None, None)  # special case - the server side provides the IP address
         pref = latus.preferences.Preferences(self.latus_config_folder)
 
-        cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
-        self.node_db = nodedb.NodeDB(cloud_folders.nodes, pref.get_node_id())
+        self.node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), pref.get_node_id())
         for latus_folder in latus.util.get_latus_folders(pref):
             yield ('folderpref', anonymize(latus_folder), str(self.node_db.get_folder_preferences_from_folder(latus_folder)))
 
@@ -7,6 +7,7 @@ import random
 import time
 
 import latus
+import latus.const
 import latus.logger
 
 
@@ -99,6 +100,13 @@ def make_hidden(in_path):
     # todo: check that the file name does indeed start with a dot
 
 
+def is_temp_file(path):
+    """
+    :return: True if path is a temp file that latus is writing (these are never synced)
+    """
+    return path.endswith(latus.const.TEMP_EXTENSION)
+
+
 def make_dir(path, hidden=False):
     try:
         os.mkdir(path)
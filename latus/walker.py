@@ -49,6 +49,8 @@ class Walker:
                     yield partial_path
 
             for name in filenames:
+                if util.is_temp_file(name):
+                    continue  # being written by latus (e.g. decrypted into place)
                 partial_path = self.create_partial_path(name, dirpath)
                 yield partial_path
 
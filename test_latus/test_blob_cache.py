@@ -0,0 +1,55 @@
+import os
+import time
+import hashlib
+
+import latus.blob_store
+import latus.blob_cache
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_blob_cache_root():
+    return os.path.join(get_data_root(), "test_blob_cache")
+
+
+def test_blob_cache(session_setup, module_setup):
+    root = get_blob_cache_root()
+    logger_init(os.path.join(root, 'log'))
+    blob_store = latus.blob_store.BlobStore(os.path.join(root, 'cache'))
+    hashes = [hashlib.sha512(str(n).encode()).hexdigest() for n in range(6)]
+
+    # blobs already in the cache - oldest first
+    now = time.time()
+    for index, hash_value in enumerate(hashes[:3]):
+        with open(blob_store.make_path(hash_value), 'w') as f:
+            f.write('x' * 100)
+        os.utime(blob_store.get_path(hash_value), (now - 100 + index, now - 100 + index))
+
+    blob_cache = latus.blob_cache.BlobCache(blob_store, 300)
+    assert(blob_cache.get_stats()['bytes'] == 300)
+    assert(blob_cache.get(hashes[0]) == blob_store.get_path(hashes[0]))  # now the most recently used
+    assert(blob_cache.get(hashes[5]) is None)
+
+    # pinned (e.g. not uploaded yet) blobs aren't evicted
+    blob_cache.pin(hashes[1])
+    with open(blob_store.make_path(hashes[3]), 'w') as f:
+        f.write('x' * 100)
+    blob_cache.add(hashes[3])
+    assert(not blob_store.exists(hashes[2]))
+    assert(all(blob_store.exists(hash_value) for hash_value in [hashes[0], hashes[1], hashes[3]]))
+
+    blob_cache.unpin(hashes[1])
+    with open(blob_store.make_path(hashes[4]), 'w') as f:
+        f.write('x' * 100)
+    blob_cache.add(hashes[4])
+    assert(not blob_store.exists(hashes[1]))
+
+    stats = blob_cache.get_stats()
+    assert(stats['hits'] == 1 and stats['misses'] == 1 and stats['evictions'] == 2 and stats['evicted_bytes'] == 200)
+    assert(stats['blobs'] == 3 and stats['bytes'] == 300 and stats['pinned'] == 0)
+
+    # recency carries over to the next run
+    blob_cache = latus.blob_cache.BlobCache(blob_store, 200)
+    blob_cache.evict()
+    assert(not blob_store.exists(hashes[0]))
+    assert(blob_store.exists(hashes[3]) and blob_store.exists(hashes[4]))
@@ -0,0 +1,81 @@
+import os
+import time
+import hashlib
+import datetime
+
+from latus import nodedb
+from latus.const import LatusFileSystemEvent, DetectionSource, ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION
+import latus.blob_store
+import latus.blob_gc
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_blob_gc_root():
+    return os.path.join(get_data_root(), "test_blob_gc")
+
+
+class StaleNodeDB:
+    """
+    a NodeDB whose live hashes were read before its latest changes
+    """
+    def __init__(self, node_db):
+        self.node_db = node_db
+
+    def get_referenced_hashes(self, history):
+        return set()
+
+    def is_hash_referenced(self, file_hash, history):
+        return self.node_db.is_hash_referenced(file_hash, history)
+
+
+def test_blob_gc(session_setup, module_setup):
+    root = get_blob_gc_root()
+    logger_init(os.path.join(root, 'log'))
+    hashes = {name: hashlib.sha512(name.encode()).hexdigest() for name in ['latest', 'old', 'pending', 'orphan', 'young']}
+
+    node_db = nodedb.get_node_db(os.path.join(root, 'a'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    modified = int(LatusFileSystemEvent.modified)
+    watchdog = int(DetectionSource.watchdog)
+    node_db.update(1, 'a', modified, watchdog, 'a.txt', None, 1, hashes['old'], mtime, False)
+    node_db.update(2, 'a', modified, watchdog, 'a.txt', None, 1, hashes['latest'], mtime, False)
+    node_db.update(3, 'b', modified, watchdog, 'b.txt', None, 1, hashes['pending'], mtime, True)
+    node_db.update(4, 'b', int(LatusFileSystemEvent.deleted), watchdog, 'b.txt', None, None, None, None, False)
+
+    # the superseded change is within the default retention window
+    assert(node_db.get_referenced_hashes() == {hashes['old'], hashes['latest'], hashes['pending']})
+    assert(node_db.get_referenced_hashes(0.0) == {hashes['latest'], hashes['pending']})
+
+    blob_store = latus.blob_store.BlobStore(os.path.join(root, 'cache'))
+    long_ago = time.time() - 2 * 24 * 60 * 60
+    for name, hash_value in hashes.items():
+        for extension in [ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION]:
+            with open(blob_store.make_path(hash_value, extension), 'w') as f:
+                f.write(name)
+            if name != 'young':
+                os.utime(blob_store.get_path(hash_value, extension), (long_ago, long_ago))
+
+    report = latus.blob_gc.collect(blob_store, [node_db], dry_run=True, retention=0.0)
+    assert(report.blobs == 10 and report.orphans == 4 and report.young == 2 and report.removed == 0)
+    assert(all(blob_store.exists(hash_value) for hash_value in hashes.values()))
+
+    report = latus.blob_gc.collect(blob_store, [node_db], retention=0.0, batch_size=3, batch_pause=0.0)
+    assert(report.removed == 4 and report.removed_bytes == 2 * (len('old') + len('orphan')))
+    remaining = set(hash_value for hash_value, _, _ in blob_store.iter_blobs())
+    assert(remaining == {hashes['latest'], hashes['pending'], hashes['young']})
+
+    # the live hashes are checked again right before each removal (they may have changed during a long collection)
+    assert(all(node_db.is_hash_referenced(hashes[name], 0.0) for name in ['latest', 'pending']))
+    assert(node_db.is_hash_referenced(hashes['old']) and not node_db.is_hash_referenced(hashes['old'], 0.0))
+    report = latus.blob_gc.collect(blob_store, [StaleNodeDB(node_db)], retention=0.0, grace=1.0, batch_pause=0.0)
+    assert(report.orphans == 4 and report.removed == 0)
+
+    # reusing a blob (a file back to an old version) makes it new again
+    os.utime(blob_store.get_path(hashes['latest']), (long_ago, long_ago))
+    assert(blob_store.touch(hashes['latest']))
+    assert(latus.blob_gc.collect(blob_store, [StaleNodeDB(node_db)], retention=0.0, dry_run=True).young == 3)
+
+    # nothing to tell what's live, so nothing is removed
+    assert(latus.blob_gc.collect(blob_store, [], grace=0.0) is None)
+    assert(set(hash_value for hash_value, _, _ in blob_store.iter_blobs()) == remaining)
@@ -0,0 +1,45 @@
+import os
+import hashlib
+
+import latus.blob_store
+from latus.const import ENCRYPTION_EXTENSION, UNENCRYPTED_EXTENSION
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_blob_store_root():
+    return os.path.join(get_data_root(), "test_blob_store")
+
+
+def test_blob_store(session_setup, module_setup):
+    root = get_blob_store_root()
+    logger_init(os.path.join(root, 'log'))
+    cache = os.path.join(root, 'cache')
+    os.makedirs(cache, exist_ok=True)
+
+    hashes = [hashlib.sha512(str(n).encode()).hexdigest() for n in range(3)]
+
+    # an older, flat, cache
+    for hash_value in hashes[:2]:
+        with open(os.path.join(cache, hash_value + ENCRYPTION_EXTENSION), 'w') as f:
+            f.write(hash_value)
+    with open(os.path.join(cache, 'not_a_blob.txt'), 'w') as f:
+        f.write('x')
+
+    blob_store = latus.blob_store.BlobStore(cache)  # migrates
+    path = blob_store.get_path(hashes[0])
+    assert(path == os.path.join(cache, hashes[0][0:2], hashes[0][2:4], hashes[0] + ENCRYPTION_EXTENSION))
+    assert(os.path.exists(path) and blob_store.find(hashes[0]) == path)
+    assert(not os.path.exists(os.path.join(cache, hashes[0] + ENCRYPTION_EXTENSION)))
+    assert(os.path.exists(os.path.join(cache, 'not_a_blob.txt')))
+
+    # a flat blob that shows up later (e.g. from a node running an older version) is still found
+    flat_path = os.path.join(cache, hashes[2] + UNENCRYPTED_EXTENSION)
+    with open(flat_path, 'w') as f:
+        f.write(hashes[2])
+    assert(blob_store.find(hashes[2], UNENCRYPTED_EXTENSION) == flat_path)
+    assert(not blob_store.exists(hashes[2]))
+
+    assert(sorted(h for h, _, _ in blob_store.iter_blobs()) == sorted(hashes))
+    assert(blob_store.remove(hashes[1]))
+    assert(not blob_store.exists(hashes[1]))
@@ -0,0 +1,115 @@
+import os
+import datetime
+
+from latus import nodedb
+from latus.const import LatusFileSystemEvent, DetectionSource, DB_BATCH_SIZE
+import latus.const
+import latus.miv
+import latus.preferences
+import latus.crypto
+import latus.csp.change_log
+import latus.csp.cloud_folders
+
+from test_latus.tstutil import get_data_root, logger_init, write_preferences
+
+
+def get_change_log_root():
+    return os.path.join(get_data_root(), "test_change_log")
+
+
+def test_change_log(session_setup, module_setup):
+    root = get_change_log_root()
+    logger_init(os.path.join(root, 'log'))
+    log_folder = os.path.join(root, 'logs')
+
+    node_dbs = {node_id: nodedb.get_node_db(os.path.join(root, node_id), node_id, True) for node_id in ['a', 'b']}
+    writer = latus.csp.change_log.ChangeLogWriter(log_folder, 'a', segment_size=1000)
+    ingester = latus.csp.change_log.ChangeLogIngester(log_folder, 'b')
+    mtime = datetime.datetime.utcnow()
+
+    def update(mivui):
+        node_dbs['a'].update(mivui, 'a', int(LatusFileSystemEvent.created), int(DetectionSource.watchdog),
+                             'file_%d.txt' % mivui, None, mivui, 'hash_%d' % mivui, mtime, False)
+
+    for mivui in range(1, 21):
+        update(mivui)
+    assert(writer.publish(node_dbs['a']) == 20)
+    assert(writer.publish(node_dbs['a']) == 0)
+    assert(ingester.ingest(node_dbs['b']) == 20)
+    assert(node_dbs['b'].get_watermarks() == {'a': 20})
+    info = node_dbs['b'].get_latest_file_info('file_3.txt')
+    assert(info['file_hash'] == 'hash_3' and info['mtime'] == mtime and info['pending'])
+
+    # segments roll over by size, and only new changes are ingested
+    for mivui in range(21, 41):
+        update(mivui)
+        writer.publish(node_dbs['a'])
+    segments = latus.csp.change_log.get_segments(os.path.join(log_folder, 'a'))
+    assert(len(segments) > 1 and segments[0][0] == 1)
+    assert(ingester.ingest(node_dbs['b']) == 20)
+    assert(ingester.ingest(node_dbs['b']) == 0)
+
+    # more than a chunk at once
+    for mivui in range(41, 42 + DB_BATCH_SIZE):
+        update(mivui)
+    assert(writer.publish(node_dbs['a']) == DB_BATCH_SIZE + 1)
+    assert(ingester.ingest(node_dbs['b']) == DB_BATCH_SIZE + 1)
+    assert(node_dbs['b'].get_watermarks() == {'a': 41 + DB_BATCH_SIZE})
+
+    # a partly written line is left until it's complete
+    segments = latus.csp.change_log.get_segments(os.path.join(log_folder, 'a'))
+    with open(segments[-1][1], 'ab') as f:
+        f.write(b'{"mivui":%d' % (42 + DB_BATCH_SIZE))
+    assert(ingester.ingest(node_dbs['b']) == 0)
+
+    # a new writer (e.g. after a restart) carries on from the end of the log
+    assert(latus.csp.change_log.ChangeLogWriter(log_folder, 'a').last_mivui == 41 + DB_BATCH_SIZE)
+
+
+def test_change_log_interleaved(session_setup, module_setup):
+    root = os.path.join(get_change_log_root(), 'interleaved')
+    logger_init(os.path.join(get_change_log_root(), 'log'))
+    log_folder = os.path.join(root, 'logs')
+
+    node_dbs = {node_id: nodedb.get_node_db(os.path.join(root, node_id), node_id, True) for node_id in ['a', 'b']}
+    writer = latus.csp.change_log.ChangeLogWriter(log_folder, 'a')
+    ingester = latus.csp.change_log.ChangeLogIngester(log_folder, 'b')
+    mtime = datetime.datetime.utcnow()
+    modified = int(LatusFileSystemEvent.modified)
+    latus.miv.set_mode('hlc')  # no server needed
+    try:
+        with node_dbs['a'].batch() as batch:
+            # e.g. a file system scan
+            for file_number in range(3):
+                batch.update(None, 'a', modified, int(DetectionSource.initial_scan), 'scan_%d.txt' % file_number, None, 1,
+                             'hash_%d' % file_number, mtime, False)
+
+            # meanwhile, a watchdog event is written and published before the scan's batch is
+            with node_dbs['a'].write_lock:
+                node_dbs['a'].update(latus.miv.get_mivui('a'), 'a', modified, int(DetectionSource.watchdog), 'event.txt', None,
+                                     1, 'hash_event', mtime, False)
+            assert(writer.publish(node_dbs['a']) == 1)
+
+        assert(writer.publish(node_dbs['a']) == 3)
+        assert(ingester.ingest(node_dbs['b']) == 4)
+
+        # a restart whose node DB is behind the log still gets mivuis after it (whatever the miv mode)
+        latus.csp.change_log.ChangeLogWriter(log_folder, 'a')
+        assert(latus.miv.g_miv_allocator.prior_mivui >= writer.last_mivui)
+    finally:
+        latus.miv.set_mode(latus.const.MIV_MODE_DEFAULT)
+
+
+def test_change_log_node_ids(session_setup, module_setup):
+    root = os.path.join(get_change_log_root(), 'node_ids')
+    logger_init(os.path.join(get_change_log_root(), 'log'))
+    pref = latus.preferences.Preferences(write_preferences('a', root, latus.crypto.new_key()))
+    cloud_folders = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root())
+    os.makedirs(cloud_folders.nodes)
+    nodedb.get_node_db(cloud_folders.nodes, 'a', True)
+    nodedb.get_node_db(cloud_folders.nodes, 'b', True)
+    latus.csp.change_log.ChangeLogWriter(cloud_folders.logs, 'c')
+
+    assert(latus.csp.change_log.get_node_ids(pref) == {'a', 'b'})
+    pref.set_replication('log')
+    assert(latus.csp.change_log.get_node_ids(pref) == {'c'})
@@ -0,0 +1,111 @@
+import os
+import time
+
+import watchdog.events
+
+import latus.coalesce
+import latus.const
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_coalesce_root():
+    return os.path.join(get_data_root(), "test_coalesce")
+
+
+class RecordingHandler(watchdog.events.FileSystemEventHandler):
+    def __init__(self):
+        self.events = []
+
+    def dispatch(self, event):
+        self.events.append(event)
+
+
+def test_coalesce(session_setup, module_setup):
+    root = get_coalesce_root()
+    logger_init(os.path.join(root, 'log'))
+    os.makedirs(root, exist_ok=True)
+    a = os.path.join(root, 'a.txt')
+    b = os.path.join(root, 'b.txt')
+
+    handler = RecordingHandler()
+    coalescer = latus.coalesce.EventCoalescer(handler, quiet_time=0.2, max_wait=2.0)
+    coalescer.start()
+
+    # a burst of events for one file becomes one event
+    with open(a, 'w') as f:
+        f.write('a')
+    coalescer.dispatch(watchdog.events.FileCreatedEvent(a))
+    for _ in range(5):
+        coalescer.dispatch(watchdog.events.FileModifiedEvent(a))
+    assert(coalescer.is_pending())
+    time.sleep(0.1)
+    assert(len(handler.events) == 0)
+    time.sleep(0.5)
+    assert([(e.event_type, e.src_path) for e in handler.events] == [(watchdog.events.EVENT_TYPE_CREATED, a)])
+    assert(not coalescer.is_pending())
+
+    # a pending modify of a move's source is covered by the move
+    handler.events.clear()
+    coalescer.dispatch(watchdog.events.FileModifiedEvent(a))
+    coalescer.dispatch(watchdog.events.FileMovedEvent(a, b))
+    time.sleep(0.1)
+    assert([(e.event_type, e.src_path) for e in handler.events] == [(watchdog.events.EVENT_TYPE_MOVED, a)])
+
+    # a new file renamed over another (e.g. an editor's save) is a new file at the destination
+    handler.events.clear()
+    c = os.path.join(root, 'c.txt')
+    coalescer.dispatch(watchdog.events.FileCreatedEvent(c))
+    coalescer.dispatch(watchdog.events.FileModifiedEvent(c))
+    coalescer.dispatch(watchdog.events.FileMovedEvent(c, b))
+    time.sleep(0.5)
+    assert([(e.event_type, e.src_path) for e in handler.events] == [(watchdog.events.EVENT_TYPE_CREATED, b)])
+
+    # latus's own temp files are never handed over, and one moved into place is a new file
+    handler.events.clear()
+    temp = os.path.join(root, '.0123456789abcdef' + latus.const.TEMP_EXTENSION)
+    coalescer.dispatch(watchdog.events.FileCreatedEvent(temp))
+    coalescer.dispatch(watchdog.events.FileModifiedEvent(temp))
+    coalescer.dispatch(watchdog.events.FileMovedEvent(temp, b))
+    time.sleep(0.5)
+    assert([(e.event_type, e.src_path) for e in handler.events] == [(watchdog.events.EVENT_TYPE_CREATED, b)])
+
+    # pending events are handled on exit
+    handler.events.clear()
+    coalescer.dispatch(watchdog.events.FileDeletedEvent(b))
+    assert(coalescer.request_exit(5.0))
+    assert([e.event_type for e in handler.events] == [watchdog.events.EVENT_TYPE_DELETED])
+
+
+def test_coalescing_trigger(session_setup, module_setup):
+    root = get_coalesce_root()
+    logger_init(os.path.join(root, 'log'))
+
+    runs = []
+
+    def function(source):
+        runs.append(source)
+        time.sleep(0.2)
+
+    trigger = latus.coalesce.CoalescingTrigger(function, ('request',), min_interval=0.5)
+    trigger.start()
+
+    # a burst of requests is one run, plus one more for the requests made while it was running
+    for _ in range(10):
+        trigger.request()
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert(runs == ['request'])
+    trigger.request()
+    assert(trigger.is_pending())
+    time.sleep(1.0)
+    assert(runs == ['request', 'request'])
+    assert(not trigger.is_pending())
+
+    # run_now satisfies a pending request
+    trigger.request()
+    trigger.run_now('now')
+    time.sleep(1.0)
+    assert(runs == ['request', 'request', 'now'])
+
+    assert(trigger.request_exit(5.0))
@@ -0,0 +1,90 @@
+import os
+
+from cryptography.fernet import Fernet
+
+import latus.crypto
+import latus.util
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_crypto_root():
+    return os.path.join(get_data_root(), "test_crypto")
+
+
+def test_crypto_streaming(session_setup, module_setup):
+    root = get_crypto_root()
+    os.makedirs(root, exist_ok=True)
+    logger_init(os.path.join(root, 'log'))
+    key = latus.crypto.new_key()
+    crypto = latus.crypto.Crypto(key)
+
+    in_path = os.path.join(root, 'plain.bin')
+    fer_path = os.path.join(root, 'plain.fer')
+    out_path = os.path.join(root, 'out.bin')
+
+    # sizes around the chunk boundary, including empty
+    chunk_size = 1000
+    for size in [0, 1, chunk_size - 1, chunk_size, chunk_size + 1, 5 * chunk_size]:
+        contents = os.urandom(size)
+        with open(in_path, 'wb') as f:
+            f.write(contents)
+        assert(crypto.encrypt_file(in_path, fer_path, chunk_size))
+        assert(crypto.decrypt_file(fer_path, out_path))
+        with open(out_path, 'rb') as f:
+            assert(f.read() == contents)
+
+    # decrypted next to the output (no temp files left behind) and with the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    assert(os.stat(out_path).st_mode & 0o777 == 0o666 & ~umask)
+    assert(not any(latus.util.is_temp_file(name) for name in os.listdir(root)))
+
+    # truncated (dropped last chunk) and tampered files fail, and don't touch the output
+    with open(fer_path, 'rb') as f:
+        fer = f.read()
+    for bad in [fer[:-(chunk_size + 20)], fer[:100] + bytes([fer[100] ^ 1]) + fer[101:]]:
+        with open(fer_path, 'wb') as f:
+            f.write(bad)
+        assert(not crypto.decrypt_file(fer_path, out_path))
+        with open(out_path, 'rb') as f:
+            assert(f.read() == contents)
+
+    # wrong key
+    assert(crypto.encrypt_file(in_path, fer_path))
+    assert(not latus.crypto.Crypto(latus.crypto.new_key()).decrypt_file(fer_path, out_path))
+
+    # each file gets its own salt (and so its own key), even for the same contents and key
+    other_fer_path = os.path.join(root, 'other.fer')
+    assert(crypto.encrypt_file(in_path, other_fer_path))
+    headers = []
+    for path in [fer_path, other_fer_path]:
+        with open(path, 'rb') as f:
+            headers.append(f.read(latus.crypto.FER_HEADERS[latus.crypto.FER_VERSION].size))
+        assert(crypto.decrypt_file(path, out_path))
+        with open(out_path, 'rb') as f:
+            assert(f.read() == contents)
+    salt_end = -latus.crypto.FER_NONCE_PREFIX_SIZE
+    salt_start = salt_end - latus.crypto.FER_SALT_SIZE
+    assert(headers[0][:salt_start] == headers[1][:salt_start])
+    assert(headers[0][salt_start:salt_end] != headers[1][salt_start:salt_end])
+
+    # legacy v2 files (no salt, one shared key) can still be read
+    v2_key = b'ggoW4ImvSeC3Sae7HY9xa4v5ZRu0DrT0BHtmZ_ckqWg='
+    v2_fer = bytes.fromhex('4c4154555346455202000000047fc2d970a5b45200000014dae8fe94d261f687570e290e62bbf54ca03e04640000'
+                           '0014c57d8994b7025dce7412ec2d56e6a08eb4022921000000112683cd972535ffbf39c47b8c90f228bfb5')
+    v2_path = os.path.join(root, 'v2.fer')
+    with open(v2_path, 'wb') as f:
+        f.write(v2_fer)
+    assert(latus.crypto.Crypto(v2_key).decrypt_file(v2_path, out_path))
+    with open(out_path, 'rb') as f:
+        assert(f.read() == b'legacy v2')
+
+    # legacy (v1) Fernet files can still be read
+    legacy_path = os.path.join(root, 'legacy.fer')
+    with open(legacy_path, 'wb') as f:
+        f.write(Fernet(key).encrypt(b'legacy'))
+    os.remove(out_path)
+    assert(crypto.decrypt_file(legacy_path, out_path))
+    with open(out_path, 'rb') as f:
+        assert(f.read() == b'legacy')
@@ -0,0 +1,39 @@
+import os
+import datetime
+
+from latus import nodedb
+from latus.const import LatusFileSystemEvent, DetectionSource
+import latus.preferences
+import latus.crypto
+import latus.csp.change_log
+import latus.csp.cloud_folders
+import latus.csp.snapshot
+import latus.csp.sync_csp
+
+from test_latus.tstutil import get_data_root, logger_init, write_preferences
+
+
+def get_db_maintenance_root():
+    return os.path.join(get_data_root(), "test_db_maintenance")
+
+
+def test_db_maintenance(session_setup, module_setup):
+    root = get_db_maintenance_root()
+    logger_init(os.path.join(root, 'log'))
+    app_data_folder = write_preferences('a', root, latus.crypto.new_key())
+    pref = latus.preferences.Preferences(app_data_folder)
+    node_db = nodedb.get_node_db(latus.csp.change_log.get_node_db_folder(pref), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    for mivui in range(1, 11):
+        node_db.update(mivui, 'a', int(LatusFileSystemEvent.modified), int(DetectionSource.watchdog), 'file_%d.txt' % (mivui % 2),
+                       None, 1, 'hash_%d' % mivui, mtime, False)
+
+    snapshot_folder = latus.csp.cloud_folders.CloudFolders(pref.get_cloud_root()).snapshots
+    os.makedirs(snapshot_folder)  # (CloudSync makes the cloud folders)
+
+    # runs once at start up, then every period
+    db_maintenance = latus.csp.sync_csp.DBMaintenance(app_data_folder)
+    db_maintenance.start()
+    assert(db_maintenance.request_exit())
+    assert(node_db.maybe_compact() is None)  # just compacted
+    assert(os.path.exists(latus.csp.snapshot.get_snapshot_path(snapshot_folder, 'a')))
@@ -0,0 +1,33 @@
+import os
+
+from latus.const import LatusFileSystemEvent
+import latus.event_filter
+
+
+def test_filter_store():
+    filter_store = latus.event_filter.FilterStore(time_out=3)
+    a = os.path.join('x', 'a.txt')
+    filter_store.add(a, LatusFileSystemEvent.any, now=0)
+    filter_store.add(a, LatusFileSystemEvent.deleted, now=1)
+    filter_store.add(os.path.join('x', 'b.txt'), LatusFileSystemEvent.modified, now=2)
+    assert(len(filter_store) == 3)
+
+    # paths are normalized, the matching event type is preferred, and a filter event is used up when it filters
+    assert(filter_store.test(os.path.join('x', '.', 'a.txt'), LatusFileSystemEvent.deleted).event == LatusFileSystemEvent.deleted)
+    assert(filter_store.test(a, LatusFileSystemEvent.deleted).event == LatusFileSystemEvent.any)
+    assert(filter_store.test(a, LatusFileSystemEvent.deleted) is None)
+
+    # expiry
+    assert(filter_store.expire(now=4.9) == [])
+    assert([e.path for e in filter_store.expire(now=5.0)] == [os.path.join('x', 'b.txt')])
+    assert(len(filter_store) == 0)
+
+
+def test_filter_store_not_consumed():
+    filter_store = latus.event_filter.FilterStore(time_out=3, consume=False)
+    filter_store.add('a.txt', LatusFileSystemEvent.created, now=0)
+    for _ in range(3):
+        assert(filter_store.test('a.txt', LatusFileSystemEvent.modified) is not None)
+    expired = filter_store.expire(now=3)
+    assert(len(expired) == 1 and expired[0].seen_count == 3)
+    assert(filter_store.test('a.txt', LatusFileSystemEvent.modified) is None)
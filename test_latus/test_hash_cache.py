@@ -0,0 +1,58 @@
+import os
+import time
+
+import latus.const
+import latus.hash
+import latus.stat_index
+
+from test_latus.tstutil import get_data_root, logger_init, write_to_file
+
+
+def get_hash_cache_root():
+    return os.path.join(get_data_root(), "test_hash_cache")
+
+
+def test_hash_cache(session_setup, module_setup):
+    logger_init(os.path.join(get_hash_cache_root(), 'log'))
+    app_data_folder = os.path.join(get_hash_cache_root(), 'appdata')
+    file_path = os.path.join(get_hash_cache_root(), 'a.txt')
+    write_to_file(get_hash_cache_root(), 'a.txt', 'test_hash_cache')
+
+    # too new to be cached
+    hash_cache = latus.hash.init_cache(app_data_folder)
+    file_hash, _ = latus.hash.calc_sha512(file_path, b'key')
+    assert(hash_cache.get(latus.hash._get_identity(file_path, b'key')[0]) is None)
+
+    old_time = time.time() - 2 * latus.stat_index.RACY_TIME
+    os.utime(file_path, (old_time, old_time))
+    time.sleep(latus.stat_index.RACY_TIME)  # setting the mtime sets the ctime to now
+    assert(latus.hash.calc_sha512(file_path, b'key')[0] == file_hash)
+    hits = hash_cache.hits
+    assert(latus.hash.calc_sha512(file_path, b'key')[0] == file_hash)
+    assert(hash_cache.hits == hits + 1)
+
+    # the key is part of the hash, so it's part of the cache's key too
+    assert(latus.hash.calc_sha512(file_path, b'other key')[0] != file_hash)
+
+    # survives a restart
+    latus.hash.flush_cache()
+    latus.hash.g_hash_cache = None
+    hash_cache = latus.hash.init_cache(app_data_folder)
+    assert(latus.hash.calc_sha512(file_path, b'key')[0] == file_hash)
+    assert(hash_cache.hits == 1)
+
+    # rewritten (same size) with the mtime put back - the ctime still changes
+    write_to_file(get_hash_cache_root(), 'a.txt', 'TEST_HASH_CACHE')
+    os.utime(file_path, (old_time, old_time))
+    time.sleep(latus.stat_index.RACY_TIME)
+    assert(latus.hash.calc_sha512(file_path, b'key')[0] != file_hash)
+    assert(hash_cache.hits == 1)
+
+    # many entries flushed at once
+    for identity in range(3 * latus.const.DB_MAX_PARAMETERS):
+        hash_cache.put(str(identity), 'hash_%d' % identity)
+    latus.hash.flush_cache()
+    latus.hash.g_hash_cache = None
+    hash_cache = latus.hash.init_cache(app_data_folder)
+    assert(hash_cache.get(str(identity)) == 'hash_%d' % identity)
+    latus.hash.g_hash_cache = None
@@ -0,0 +1,76 @@
+import os
+import time
+
+import latus.miv
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_miv_root():
+    return os.path.join(get_data_root(), "test_miv")
+
+
+def test_miv_lease(session_setup, module_setup):
+    logger_init(os.path.join(get_miv_root(), 'log'))
+    server_calls = []
+
+    def server(node_id):
+        server_calls.append(node_id)
+        return 1000  # a server whose clock is way behind ours, and repeats itself
+
+    allocator = latus.miv.MivAllocator(lease_count=100, lease_time=60.0, get_server_mivui=server)
+    mivuis = [allocator.get_mivui('a') for _ in range(250)]
+    assert(mivuis == sorted(set(mivuis)))  # strictly increasing
+    assert(len(server_calls) == 3)
+
+
+def test_miv_offline(session_setup, module_setup):
+    logger_init(os.path.join(get_miv_root(), 'log'))
+    allocator = latus.miv.MivAllocator(lease_count=100, offline_lease_time=60.0, get_server_mivui=lambda node_id: None)
+    start = time.time()
+    mivuis = [allocator.get_mivui('a') for _ in range(1000)]
+    assert(time.time() - start < 1.0)  # no stalls
+    assert(mivuis == sorted(set(mivuis)))
+    assert(abs(mivuis[0] - time.time() * 1E6) < 60 * 1E6)  # local time
+
+
+def test_miv_hlc(session_setup, module_setup):
+    logger_init(os.path.join(get_miv_root(), 'log'))
+    hlc = latus.miv.HybridLogicalClock(max_drift=60.0)
+    mivuis = [hlc.get_mivui('a') for _ in range(1000)]
+    assert(mivuis == sorted(set(mivuis)))
+    assert(abs(mivuis[0] - time.time() * 1E6) < 1E6)
+
+    # a node whose clock is ahead - our next mivui has to be after its
+    ahead = int((time.time() + 30.0) * 1E6)
+    hlc.observe(ahead)
+    assert(hlc.get_mivui('a') == ahead + 1)
+
+    # too far ahead to be believed
+    hlc.observe(int((time.time() + 3600.0) * 1E6))
+    assert(hlc.get_mivui('a') == ahead + 2)
+
+
+def test_miv_floor(session_setup, module_setup):
+    logger_init(os.path.join(get_miv_root(), 'log'))
+
+    # restarted, with a server whose clock is behind the mivuis we used last run
+    last_run = int((time.time() + 600.0) * 1E6)
+    allocator = latus.miv.MivAllocator(get_server_mivui=lambda node_id: 1000)
+    allocator.set_floor(last_run)
+    allocator.set_floor(1000)  # a lower floor doesn't lower it
+    assert(allocator.get_mivui('a') == last_run + 1)
+
+    # the hybrid logical clock goes past our own mivuis however far ahead they are
+    hlc = latus.miv.HybridLogicalClock(max_drift=60.0)
+    last_run = int((time.time() + 3600.0) * 1E6)
+    hlc.set_floor(last_run)
+    assert(hlc.get_mivui('a') == last_run + 1)
+
+
+def test_miv_init_from_watermarks(session_setup, module_setup):
+    logger_init(os.path.join(get_miv_root(), 'log'))
+    ours = int((time.time() + 3600.0) * 1E6)  # e.g. from a prior run that leased from a fast local clock
+    latus.miv.init_from_watermarks('a', {'a': ours, 'b': 1000})
+    assert(latus.miv.g_miv_allocator.prior_mivui >= ours)
+    assert(latus.miv.g_hlc.last_mivui >= ours)
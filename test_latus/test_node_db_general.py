@@ -1,7 +1,9 @@
 
 import os
+import threading
 
 from latus import nodedb
+from latus.const import DB_POOL_SIZE
 
 import test_latus.tstutil
 
@@ -19,3 +21,27 @@ def test_node_db_general(session_setup, module_setup):
     os.makedirs(general_root, exist_ok=True)
     node_db = nodedb.NodeDB(general_root, node_id, True)
     assert(node_db.get_node_id() == node_id)
+
+    # the registry hands out one long-lived NodeDB per folder and node
+    assert(nodedb.get_node_db(general_root, node_id) is nodedb.get_node_db(general_root, node_id))
+    assert(nodedb.get_node_db(general_root, node_id).get_node_id() == node_id)
+
+
+def test_node_db_many_threads(session_setup, module_setup):
+    # more threads than the pool keeps connections for must not disturb each other's connections
+    root = os.path.join(get_node_db_general_root(), 'many_threads')
+    test_latus.tstutil.logger_init(os.path.join(root, 'log'))
+    node_id = 'b'
+    node_db = nodedb.get_node_db(root, node_id, True)
+
+    with node_db.db_engine.connect() as conn:
+        assert(conn.execute(node_db.general_table.select()).fetchone() is not None)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(node_db.get_node_id())) for _ in range(4 * DB_POOL_SIZE)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert(results == [node_id] * len(threads))
+        # this thread's connection is still open
+        assert(conn.execute(node_db.general_table.select()).fetchone() is not None)
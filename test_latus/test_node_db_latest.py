@@ -0,0 +1,80 @@
+import os
+import datetime
+
+from latus import nodedb
+from latus.const import LatusFileSystemEvent, DetectionSource
+
+import test_latus.tstutil
+
+
+def get_node_db_latest_root():
+    return os.path.join(test_latus.tstutil.get_data_root(), "node_db_latest")
+
+
+def test_node_db_latest(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_latest_root(), 'log'))
+
+    node_db = nodedb.NodeDB(get_node_db_latest_root(), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    created, moved, modified = int(LatusFileSystemEvent.created), int(LatusFileSystemEvent.moved), int(LatusFileSystemEvent.modified)
+    watchdog = int(DetectionSource.watchdog)
+    node_db.update(10, 'a', created, watchdog, 'a.txt', None, 1, 'hash_1', mtime, False)
+    node_db.update(30, 'b', moved, watchdog, 'b.txt', 'a.txt', 1, 'hash_1', mtime, True)
+    node_db.update(20, 'a', modified, watchdog, 'a.txt', None, 2, 'hash_2', mtime, False)  # arrives late
+
+    # the most senior mivui wins, and a move is the latest state of both its source and destination
+    assert(node_db.get_last_mivui('a.txt') == 30)
+    assert(node_db.get_most_recent_hash('a.txt') is None)
+    assert(node_db.get_most_recent_hash('b.txt') == 'hash_1')
+    assert(node_db.get_most_recent_entry_for_path('a.txt')['file_path'] == 'b.txt')
+    assert(node_db.get_most_recent_entry('a')['mivui'] == 20)
+
+    # the full history is still there
+    assert(node_db.get_info_from_path_and_mivui('a.txt', 20)['file_hash'] == 'hash_2')
+    assert(node_db.get_info_from_path_and_mivui('b.txt', 30)['src_path'] == 'a.txt')
+    assert(node_db.get_info_from_path_and_mivui('b.txt', 20) is None)
+
+    node_db.clear_pending(node_db.get_most_recent_entry_for_path('b.txt'))
+    assert(not node_db.get_most_recent_entry_for_path('b.txt')['pending'])
+
+
+def test_node_db_pending(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_latest_root(), 'log'))
+
+    node_db = nodedb.NodeDB(os.path.join(get_node_db_latest_root(), 'pending'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    modified = int(LatusFileSystemEvent.modified)
+    watchdog = int(DetectionSource.watchdog)
+    mivui = 0
+    for path_number in range(5):
+        for _ in range(3):
+            mivui += 1
+            node_db.update(mivui, 'b', modified, watchdog, '%d.txt' % path_number, None, 1, 'hash_%d' % mivui, mtime, True)
+    node_db.update(mivui + 1, 'a', modified, watchdog, '0.txt', None, 1, 'hash_x', mtime, False)  # not pending
+
+    # the most senior pending entry per path, across pages
+    infos = list(node_db.get_last_mivuis_info(page_size=2))
+    assert([(info['file_path'], info['mivui']) for info in infos] == [('%d.txt' % n, 3 * n + 3) for n in range(5)])
+
+    # pendings can be cleared while iterating
+    for info in node_db.get_last_mivuis_info(page_size=2):
+        node_db.clear_pending(info)
+    assert([info['file_path'] for info in node_db.get_last_mivuis_info()] == ['%d.txt' % n for n in range(5)])
+
+
+def test_change_record(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_latest_root(), 'log'))
+
+    node_db = nodedb.NodeDB(os.path.join(get_node_db_latest_root(), 'record'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    node_db.update(10, 'a', int(LatusFileSystemEvent.moved), int(DetectionSource.watchdog), 'b.txt', 'a.txt', 1, 'hash_1', mtime, True)
+
+    record = node_db.get_latest_file_info('b.txt')
+    assert(isinstance(record, nodedb.ChangeRecord))
+    assert(record.mivui == 10 and record['mivui'] == 10)
+    # older key names
+    assert(record['path'] == 'b.txt' and record['srcpath'] == 'a.txt' and record['hash'] == 'hash_1')
+    assert(record['event'] == LatusFileSystemEvent.moved)
+    assert('size' in record and 'not_a_key' not in record and record.get('not_a_key') is None)
+    assert(dict(record) == record.to_dict())
+    assert(record.to_dict()['file_path'] == 'b.txt')
@@ -0,0 +1,191 @@
+import os
+import datetime
+import time
+
+from latus import nodedb
+import latus.const
+import latus.miv
+from latus.const import LatusFileSystemEvent, DetectionSource
+
+import test_latus.tstutil
+
+
+def get_node_db_sync_root():
+    return os.path.join(test_latus.tstutil.get_data_root(), "node_db_sync")
+
+
+def test_node_db_sync(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_sync_root(), 'log'))
+
+    db_folder = os.path.join(get_node_db_sync_root(), 'nodes')
+    source = nodedb.get_node_db(db_folder, 'a', True)
+    destination = nodedb.get_node_db(db_folder, 'b', True)
+    mtime = datetime.datetime.utcnow()
+    for mivui in range(1, 4):
+        source.update(mivui, 'a', int(LatusFileSystemEvent.created), int(DetectionSource.watchdog),
+                      'file_%d.txt' % mivui, None, 1, 'hash_%d' % mivui, mtime, False)
+
+    assert(nodedb.sync_dbs(db_folder, 'a', 'b') == 3)
+    assert(destination.get_watermarks() == {'a': 3})
+    assert(destination.any_pendings('file_1.txt'))
+
+    # only what is above the high-water mark is copied
+    assert(nodedb.sync_dbs(db_folder, 'a', 'b') == 0)
+    source.update(4, 'a', int(LatusFileSystemEvent.modified), int(DetectionSource.watchdog), 'file_1.txt', None, 2, 'hash_4', mtime, False)
+    assert(nodedb.sync_dbs(db_folder, 'a', 'b') == 1)
+    assert(destination.get_most_recent_hash('file_1.txt') == 'hash_4')
+
+
+def test_node_db_batch(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_sync_root(), 'log'))
+
+    node_db = nodedb.get_node_db(os.path.join(get_node_db_sync_root(), 'batch'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    with node_db.batch(chunk_size=10) as node_db_batch:
+        for mivui in range(1, 26):
+            node_db_batch.update(mivui, 'a', int(LatusFileSystemEvent.created), int(DetectionSource.initial_scan),
+                                 'file_%d.txt' % mivui, None, 1, 'hash_%d' % mivui, mtime, False)
+    assert(node_db_batch.count == 25)
+    assert(node_db.get_most_recent_hash('file_25.txt') == 'hash_25')
+
+
+def test_node_db_iterators(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_sync_root(), 'log'))
+
+    node_db = nodedb.get_node_db(os.path.join(get_node_db_sync_root(), 'iterators'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    with node_db.batch() as node_db_batch:
+        for mivui in range(1, 26):
+            node_db_batch.update(mivui, 'a', int(LatusFileSystemEvent.modified), int(DetectionSource.initial_scan),
+                                 'file_%d.txt' % (mivui % 5), None, 1, 'hash_%d' % mivui, mtime, False)
+
+    # small chunks so the iterators have to page
+    assert([info['mivui'] for info in node_db.iter_rows_as_info(chunk_size=4)] == list(range(1, 26)))
+    assert(list(node_db.iter_paths(chunk_size=2)) == ['file_%d.txt' % n for n in range(5)])
+    assert([(info['file_path'], info['mivui']) for info in node_db.iter_latest(chunk_size=2)] ==
+           [('file_%d.txt' % n, 20 + n if n > 0 else 25) for n in range(5)])
+    assert([info['mivui'] for info in node_db.iter_infos_after({'a': 20}, chunk_size=2)] == list(range(21, 26)))
+
+
+def test_node_db_compact(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_sync_root(), 'log'))
+
+    node_db = nodedb.get_node_db(os.path.join(get_node_db_sync_root(), 'compact'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    modified = int(LatusFileSystemEvent.modified)
+    with node_db.batch() as node_db_batch:
+        for mivui in range(1, 1001):
+            node_db_batch.update(mivui, 'a', modified, int(DetectionSource.watchdog), 'file_%d.txt' % (mivui % 10), None, 1000,
+                                 'hash_%d' % mivui, mtime, False)
+    node_db.update(1001, 'b', modified, int(DetectionSource.watchdog), 'file_0.txt', None, 1, 'hash_b', mtime, True)
+    node_db.update(1002, 'b', modified, int(DetectionSource.watchdog), 'file_0.txt', None, 1, 'hash_c', mtime, False)
+    watermarks = node_db.get_watermarks()
+    size = os.path.getsize(node_db.get_database_file_abs_path())
+
+    # everything is in the history window
+    assert(node_db.compact() == 0)
+
+    # latest state of each path, pending changes and the high-water marks are kept
+    assert(node_db.compact(history=0, vacuum_pages=0) == 1000 - 10)
+    assert(sorted(info['mivui'] for info in node_db.iter_rows_as_info()) == list(range(991, 1000)) + [1000, 1001, 1002])
+    assert(node_db.get_watermarks() == watermarks)
+    assert(node_db.get_most_recent_hash('file_0.txt') == 'hash_c')
+    assert(node_db.any_pendings('file_0.txt'))
+    assert(os.path.getsize(node_db.get_database_file_abs_path()) <= size)
+
+    # throttled
+    assert(node_db.maybe_compact() is None)
+    assert(node_db.maybe_compact(interval=0) == 0)
+
+
+def test_node_db_compact_recently_superseded(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_sync_root(), 'log'))
+
+    node_db = nodedb.get_node_db(os.path.join(get_node_db_sync_root(), 'compact_superseded'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    modified = int(LatusFileSystemEvent.modified)
+    for mivui in range(1, 4):
+        node_db.update(mivui, 'a', modified, int(DetectionSource.watchdog), 'file.txt', None, 1, 'hash_%d' % mivui, mtime, False)
+    node_db.update(4, 'a', modified, int(DetectionSource.watchdog), 'other.txt', None, 1, 'hash_4', mtime, False)
+
+    # all written a day ago, except for the change that superseded mivui 2 (just now)
+    day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    with node_db.db_engine.connect() as conn:
+        conn.execute(node_db.change_table.update().values(timestamp=day_ago).where(node_db.change_table.c.mivui != 3))
+
+    # mivui 1 was superseded (by 2) a day ago, but mivui 2 has only just been superseded (by 3)
+    assert(node_db.compact(history=60 * 60, vacuum_pages=0) == 1)
+    assert(sorted(info['mivui'] for info in node_db.iter_rows_as_info()) == [2, 3, 4])
+    assert(node_db.get_most_recent_hash('file.txt') == 'hash_3')
+
+
+def test_node_db_compact_large(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_sync_root(), 'log'))
+
+    node_db = nodedb.get_node_db(os.path.join(get_node_db_sync_root(), 'compact_large'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    row_count, path_count = 20000, 100
+    changes = {}  # mivui -> (file_path, src_path)
+    with node_db.batch() as node_db_batch:
+        for mivui in range(1, row_count + 1):
+            file_path = 'file_%d.txt' % (mivui % path_count)
+            if mivui % 7 == 0:
+                src_path = 'file_%d.txt' % ((mivui + 1) % path_count)
+                event_type = int(LatusFileSystemEvent.moved)
+            else:
+                src_path = None
+                event_type = int(LatusFileSystemEvent.modified)
+            changes[mivui] = (file_path, src_path)
+            node_db_batch.update(mivui, 'a', event_type, int(DetectionSource.watchdog), file_path, src_path, 1, 'hash_%d' % mivui,
+                                 mtime, False)
+
+    # the first half was written a day ago
+    old_mivui = row_count // 2
+    with node_db.db_engine.connect() as conn:
+        conn.execute(node_db.change_table.update().values(timestamp=mtime - datetime.timedelta(days=1)).
+                     where(node_db.change_table.c.mivui <= old_mivui))
+
+    # what should go - old, and superseded by an old change to its path or an old move away from it
+    latest = {}
+    for mivui, (file_path, src_path) in changes.items():
+        for path in (file_path, src_path):
+            if path is not None:
+                latest[path] = mivui
+    expected = [mivui for mivui, (file_path, _) in changes.items()
+                if mivui <= old_mivui and mivui not in latest.values() and
+                any(file_path in changes[later] for later in range(mivui + 1, min(mivui + 2 * path_count, old_mivui + 1)))]
+
+    start = time.time()
+    assert(node_db.compact(history=60 * 60, vacuum_pages=0) == len(expected))
+    assert(time.time() - start < 10.0)  # indexed - a scan per change took tens of seconds at this size
+    remaining = set(info['mivui'] for info in node_db.iter_rows_as_info())
+    assert(remaining == set(changes) - set(expected))
+
+
+def test_node_db_sync_batch_interleaved(session_setup, module_setup):
+    test_latus.tstutil.logger_init(os.path.join(get_node_db_sync_root(), 'log'))
+
+    db_folder = os.path.join(get_node_db_sync_root(), 'interleaved')
+    source = nodedb.get_node_db(db_folder, 'a', True)
+    destination = nodedb.get_node_db(db_folder, 'b', True)
+    mtime = datetime.datetime.utcnow()
+    modified = int(LatusFileSystemEvent.modified)
+    latus.miv.set_mode('hlc')  # no server needed
+    try:
+        with source.batch() as source_batch:
+            # e.g. a file system scan
+            for file_number in range(3):
+                source_batch.update(None, 'a', modified, int(DetectionSource.initial_scan), 'scan_%d.txt' % file_number, None, 1,
+                                    'hash_%d' % file_number, mtime, False)
+
+            # meanwhile, a watchdog event is written (and a peer syncs) before the scan's batch is
+            with source.write_lock:
+                source.update(latus.miv.get_mivui('a'), 'a', modified, int(DetectionSource.watchdog), 'event.txt', None, 1,
+                              'hash_event', mtime, False)
+            assert(nodedb.sync_dbs(db_folder, 'a', 'b') == 1)
+
+        # the scan's changes are after the watchdog event, so the peer still gets them
+        assert(nodedb.sync_dbs(db_folder, 'a', 'b') == 3)
+        assert(destination.get_most_recent_hash('scan_2.txt') == 'hash_2')
+    finally:
+        latus.miv.set_mode(latus.const.MIV_MODE_DEFAULT)
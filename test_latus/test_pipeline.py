@@ -0,0 +1,42 @@
+import time
+import random
+import threading
+
+import pytest
+
+import latus.pipeline
+
+
+def test_ordered_map():
+    in_flight = []
+    max_in_flight = 8
+    lock = threading.Lock()
+
+    def items():
+        for i in range(100):
+            with lock:
+                in_flight.append(i)
+                assert(len(in_flight) <= max_in_flight)
+            yield i
+
+    def square(i):
+        time.sleep(random.random() / 1000.0)  # finish out of order
+        return i * i
+
+    results = []
+    for i, result in latus.pipeline.ordered_map(square, items(), workers=4, max_in_flight=max_in_flight):
+        with lock:
+            in_flight.remove(i)
+        results.append((i, result))
+    assert(results == [(i, i * i) for i in range(100)])
+
+
+def test_ordered_map_exception():
+    def fail_on_3(i):
+        if i == 3:
+            raise ValueError(i)
+        return i
+
+    with pytest.raises(ValueError):
+        for _ in latus.pipeline.ordered_map(fail_on_3, range(10), workers=2):
+            pass
@@ -0,0 +1,34 @@
+import os
+import sqlite3
+import time
+
+import latus.preferences
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_preferences_root():
+    return os.path.join(get_data_root(), "test_preferences")
+
+
+def test_preferences_cache(session_setup, module_setup):
+    logger_init(os.path.join(get_preferences_root(), 'log'))
+    app_data_folder = os.path.join(get_preferences_root(), 'appdata')
+
+    changes = []
+    pref = latus.preferences.Preferences(app_data_folder, True)
+    pref.add_change_callback(lambda key, value: changes.append((key, value)))
+
+    # write-through, and visible to other Preferences objects for the same folder
+    pref.set_node_id('a')
+    assert(latus.preferences.Preferences(app_data_folder).get_node_id() == 'a')
+    assert(('nodeid', 'a') in changes)
+
+    # a change made by some other process is picked up
+    time.sleep(0.1)  # make sure the file's mtime changes
+    conn = sqlite3.connect(pref.get_db_path())
+    conn.execute("UPDATE preferences SET value='b' WHERE key='nodeid'")
+    conn.commit()
+    conn.close()
+    assert(pref.get_node_id() == 'b')
+    assert(('nodeid', 'b') in changes)
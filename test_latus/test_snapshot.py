@@ -0,0 +1,48 @@
+import os
+import datetime
+
+from latus import nodedb
+from latus.const import LatusFileSystemEvent, DetectionSource
+import latus.csp.snapshot
+
+from test_latus.tstutil import get_data_root, logger_init
+
+
+def get_snapshot_root():
+    return os.path.join(get_data_root(), "test_snapshot")
+
+
+def test_snapshot(session_setup, module_setup):
+    root = get_snapshot_root()
+    logger_init(os.path.join(root, 'log'))
+    snapshot_folder = os.path.join(root, 'snapshots')
+    os.makedirs(snapshot_folder, exist_ok=True)
+
+    source = nodedb.get_node_db(os.path.join(root, 'a'), 'a', True)
+    mtime = datetime.datetime.utcnow()
+    watchdog = int(DetectionSource.watchdog)
+    with source.batch() as source_batch:
+        for mivui in range(1, 101):
+            source_batch.update(mivui, 'a', int(LatusFileSystemEvent.modified), watchdog, 'file_%d.txt' % (mivui % 10), None,
+                                mivui, 'hash_%d' % mivui, mtime, False)
+    source.update(101, 'b', int(LatusFileSystemEvent.moved), watchdog, 'moved.txt', 'file_1.txt', 1, 'hash_91', mtime, False)
+    source.update(102, 'b', int(LatusFileSystemEvent.deleted), watchdog, 'file_2.txt', None, None, None, None, False)
+
+    # one change per path
+    assert(latus.csp.snapshot.maybe_publish(source, snapshot_folder) == 10)
+    assert(latus.csp.snapshot.maybe_publish(source, snapshot_folder) is None)  # not time yet
+
+    destination = nodedb.get_node_db(os.path.join(root, 'c'), 'c', True)
+    assert(latus.csp.snapshot.bootstrap(destination, snapshot_folder) == 10)
+    assert(destination.get_watermarks() == {'a': 100, 'b': 102})
+    assert(destination.get_most_recent_hash('file_3.txt') == 'hash_93')
+    moved = destination.get_latest_file_info('moved.txt')
+    assert(moved['event_type'] == int(LatusFileSystemEvent.created) and moved['file_hash'] == 'hash_91' and moved['pending'])
+    assert(destination.get_latest_file_info('file_2.txt')['event_type'] == int(LatusFileSystemEvent.deleted))
+
+    # only what's after the snapshot is replicated
+    source.update(103, 'a', int(LatusFileSystemEvent.modified), watchdog, 'file_3.txt', None, 1, 'hash_103', mtime, False)
+    assert([info['mivui'] for info in source.iter_infos_after(destination.get_watermarks())] == [103])
+
+    # not a new node any more
+    assert(latus.csp.snapshot.bootstrap(destination, snapshot_folder) == 0)
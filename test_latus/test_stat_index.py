@@ -0,0 +1,49 @@
+import os
+import time
+
+import latus.stat_index
+
+from test_latus.tstutil import get_data_root, logger_init, write_to_file
+
+
+def get_stat_index_root():
+    return os.path.join(get_data_root(), "test_stat_index")
+
+
+def test_stat_index(session_setup, module_setup):
+    logger_init(os.path.join(get_stat_index_root(), 'log'))
+    latus_folder = os.path.join(get_stat_index_root(), 'latus')
+    stat_index = latus.stat_index.StatIndex(os.path.join(get_stat_index_root(), 'appdata'))
+
+    paths = {}
+    for file_name in ['a.txt', 'b.txt']:
+        paths[file_name] = write_to_file(latus_folder, file_name, file_name)
+        old_time = time.time() - 2 * latus.stat_index.RACY_TIME
+        os.utime(paths[file_name], (old_time, old_time))
+
+    with stat_index.scan() as stat_scan:
+        for file_name, path in paths.items():
+            signature = latus.stat_index.get_stat_signature(path)
+            assert(not stat_scan.unchanged(file_name, signature))
+            stat_scan.update(file_name, signature)
+
+    # a.txt is unchanged, b.txt is modified
+    write_to_file(latus_folder, 'b.txt', 'modified')
+    with stat_index.scan() as stat_scan:
+        assert(stat_scan.unchanged('a.txt', latus.stat_index.get_stat_signature(paths['a.txt'])))
+        assert(not stat_scan.unchanged('b.txt', latus.stat_index.get_stat_signature(paths['b.txt'])))
+
+    # a scan that fails (e.g. its node DB batch couldn't be written) doesn't change the index
+    old_time = time.time() - 2 * latus.stat_index.RACY_TIME
+    os.utime(paths['b.txt'], (old_time, old_time))
+    try:
+        with stat_index.scan() as stat_scan:
+            signature = latus.stat_index.get_stat_signature(paths['b.txt'])
+            assert(not stat_scan.unchanged('b.txt', signature))
+            stat_scan.update('b.txt', signature)
+            raise IOError('node DB write failed')
+    except IOError:
+        pass
+    with stat_index.scan() as stat_scan:
+        assert(not stat_scan.unchanged('b.txt', latus.stat_index.get_stat_signature(paths['b.txt'])))
+        assert(stat_scan.unchanged('a.txt', latus.stat_index.get_stat_signature(paths['a.txt'])))
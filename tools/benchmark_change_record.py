@@ -0,0 +1,48 @@
+import os
+import sys
+import datetime
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import latus.nodedb
+
+# memory of change infos as dicts (what NodeDB used to return) vs. ChangeRecords
+# (run from the repo root: python tools/benchmark_change_record.py)
+
+count = 100000
+
+
+def as_dict(row):
+    # what db_row_to_info used to do
+    entry = {}
+    for name, value in zip(latus.nodedb.ChangeRecord.__slots__, row):
+        entry[name] = value
+    entry['path'] = entry['file_path']
+    return entry
+
+
+def as_record(row):
+    return latus.nodedb.ChangeRecord.from_row(row)
+
+
+def measure(function, rows):
+    tracemalloc.start()
+    infos = [function(row) for row in rows]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert(len(infos) == len(rows))
+    return size
+
+
+def main():
+    mtime = datetime.datetime.utcnow()
+    rows = [(index, 1500000000000000 + index, 'node_a', 2, 1, 'folder/file_%d.txt' % index, None, index, 'hash_%d' % index,
+             mtime, False, mtime) for index in range(count)]
+    for function in [as_dict, as_record]:
+        size = measure(function, rows)
+        print('%10s : %6.1f MB total, %5d bytes per change' % (function.__name__, size / (1024 * 1024), size / count))
+
+
+if __name__ == '__main__':
+    main()
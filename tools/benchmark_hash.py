@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import mmap
+import hashlib
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import latus.hash
+
+# micro-benchmark of ways to feed a file into SHA-512 (run from the repo root: python tools/benchmark_hash.py)
+
+sizes = [4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024]
+
+
+def read_4k(path):
+    # what calc_sha512 used to do
+    this_hash = hashlib.sha512()
+    with open(path, 'rb') as f:
+        val = f.read(4096)
+        while len(val):
+            this_hash.update(val)
+            val = f.read(4096)
+    return this_hash.hexdigest()
+
+
+def readinto_buffer(path):
+    # what calc_sha512 does now
+    this_hash = hashlib.sha512()
+    with open(path, 'rb', buffering=0) as f:
+        latus.hash.hash_file(f, this_hash)
+    return this_hash.hexdigest()
+
+
+def memory_map(path):
+    this_hash = hashlib.sha512()
+    with open(path, 'rb') as f:
+        if os.path.getsize(path) > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                this_hash.update(m)
+    return this_hash.hexdigest()
+
+
+def benchmark(function, path, size):
+    # repeat small files so each measurement is at least ~64 MB of hashing
+    repeats = max(1, (64 * 1024 * 1024) // size)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        digest = function(path)
+    elapsed = time.perf_counter() - start
+    return digest, (size * repeats) / elapsed / (1024 * 1024)
+
+
+def main():
+    methods = [read_4k, readinto_buffer, memory_map]
+    print('%12s %s' % ('size', ''.join(['%18s' % m.__name__ for m in methods])))
+    with tempfile.TemporaryDirectory() as temp_folder:
+        for size in sizes:
+            path = os.path.join(temp_folder, 'benchmark_%d' % size)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            digests = set()
+            line = '%12d' % size
+            for method in methods:
+                digest, mb_per_sec = benchmark(method, path, size)
+                digests.add(digest)
+                line += '%13.1f MB/s' % mb_per_sec
+            assert(len(digests) == 1)
+            print(line)
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()